@@ -28,3 +28,7 @@ admin.site.register(Patient)
 admin.site.register(Staff, StaffAdmin)
 admin.site.register(QueueEntry)
 admin.site.register(QueueHistory)
+admin.site.register(QueueDaySummary)
+admin.site.register(TicketSequence)
+admin.site.register(AnalyticsBucket)
+admin.site.register(AnalyticsGap)
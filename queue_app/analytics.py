@@ -0,0 +1,346 @@
+# queue_app/analytics.py
+import logging
+import math
+import os
+import random
+import time
+from datetime import timedelta
+from itertools import chain
+
+from django.db import OperationalError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import history
+from .models import AnalyticsBucket, AnalyticsGap, QueueHistory
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ('hour', 'day')
+SCOPES = ('service', 'counter')
+
+# Quantiles are reported to within this fraction of their true value
+RELATIVE_ACCURACY = 0.02
+
+# Longest range a dashboard query may ask for
+MAX_RANGE_DAYS = 92
+
+# Tries at recording closures before their days are flagged for rebuild()
+RECORD_ATTEMPTS = 3
+
+
+# Quantile sketch
+#
+# Durations go into logarithmic buckets: bucket i holds values in
+# (gamma^(i-1), gamma^i], so any value read back from a bucket is within
+# RELATIVE_ACCURACY of every value in it (the DDSketch scheme). A sketch is
+# a {bucket: count} dict; a day's waits from seconds to hours need at most a
+# few hundred buckets, and two sketches merge by adding their counts, which
+# is what lets hourly and daily buckets be summed into any range.
+
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+
+class QuantileSketch:
+    def __init__(self, counts=None):
+        self.counts = {int(index): count for index, count in (counts or {}).items()}
+
+    @property
+    def count(self):
+        return sum(self.counts.values())
+
+    def add(self, seconds):
+        # Anything under a second is a second; nobody measures queues finer than that
+        index = math.ceil(math.log(max(seconds, 1.0)) / LOG_GAMMA)
+        self.counts[index] = self.counts.get(index, 0) + 1
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        return self
+
+    def quantile(self, q):
+        """Approximate q-quantile in seconds, or None if the sketch is empty"""
+        total = self.count
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen > rank:
+                return 2 * GAMMA ** index / (GAMMA + 1)
+        return 2 * GAMMA ** max(self.counts) / (GAMMA + 1)
+
+    def to_json(self):
+        # JSON object keys are strings
+        return {str(index): count for index, count in self.counts.items()}
+
+
+# Aggregates
+#
+# Every patient leaving a counter (served or skipped) is folded into four
+# AnalyticsBucket rows: the hour and the day, for the service and for the
+# counter. transitions.py calls record_closures() once the history rows are
+# committed, so buckets are always current and a dashboard query reads at
+# most one row per hour or day in its range, however long QueueHistory (or
+# its archive) is. rebuild() recomputes them from QueueHistory and the
+# archive files of the days it covers, so rebuilding archived days is safe.
+#
+# Service rows are shared by every counter of the service, so writes never
+# lock a missing row: that takes gap locks on MySQL, and two counters doing
+# it at once deadlock. Missing rows are inserted first, on their own and
+# ignoring conflicts; the rows are then locked by primary key in key order
+# and updated in place, the counts and sums with F() expressions and the
+# sketches merged under the row lock. A deadlock or a busy database is
+# retried; closures that still cannot be recorded flag their days in
+# AnalyticsGap, which `rebuild_analytics --gaps` replays.
+
+def bucket_start(period, moment):
+    """Start of the local hour or day containing `moment`"""
+    local = timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+    return local if period == 'hour' else local.replace(hour=0)
+
+
+class _Delta:
+    __slots__ = ('completed', 'skipped', 'wait_sum', 'wait_sketch', 'service_sum', 'service_sketch')
+
+    def __init__(self):
+        self.completed = self.skipped = 0
+        self.wait_sum = self.service_sum = 0.0
+        self.wait_sketch = QuantileSketch()
+        self.service_sketch = QuantileSketch()
+
+    def add(self, status, created_at, started_at, completed_at):
+        if status == 'skipped':
+            self.skipped += 1
+        else:
+            self.completed += 1
+        # Entries called before started_at was recorded have no durations
+        if started_at is not None:
+            wait = max((started_at - created_at).total_seconds(), 0)
+            service = max((completed_at - started_at).total_seconds(), 0)
+            self.wait_sum += wait
+            self.wait_sketch.add(wait)
+            self.service_sum += service
+            self.service_sketch.add(service)
+
+
+def _deltas(closures):
+    deltas = {}
+    for service_id, counter_id, status, created_at, started_at, completed_at in closures:
+        for scope, scope_id in (('service', service_id), ('counter', counter_id)):
+            for period in PERIODS:
+                key = (scope, scope_id, period, bucket_start(period, completed_at))
+                delta = deltas.get(key)
+                if delta is None:
+                    delta = deltas[key] = _Delta()
+                delta.add(status, created_at, started_at, completed_at)
+    return deltas
+
+
+def _bucket_ids(keys):
+    """{(scope, scope_id, period, start): pk} for the given bucket keys, inserting the missing rows"""
+    AnalyticsBucket.objects.bulk_create(
+        [AnalyticsBucket(scope=scope, scope_id=scope_id, period=period, start=start)
+         for scope, scope_id, period, start in keys],
+        ignore_conflicts=True
+    )
+    rows = AnalyticsBucket.objects.filter(
+        scope__in={key[0] for key in keys}, scope_id__in={key[1] for key in keys},
+        period__in={key[2] for key in keys}, start__in={key[3] for key in keys}
+    ).values_list('pk', 'scope', 'scope_id', 'period', 'start')
+    wanted = set(keys)
+    ids = {}
+    for pk, scope, scope_id, period, start in rows:
+        key = (scope, scope_id, period, start)
+        if key in wanted:
+            ids[key] = pk
+    return ids
+
+
+def _lock_buckets(ids):
+    """Lock the bucket rows for the rest of the transaction, in primary key order, and return them by pk"""
+    buckets = AnalyticsBucket.objects.filter(pk__in=ids).order_by('pk')
+    if connection.features.has_select_for_update:
+        return {bucket.pk: bucket for bucket in buckets.select_for_update()}
+    # SQLite has no row locks; writing first takes the database write lock up front instead
+    AnalyticsBucket.objects.filter(pk__in=ids).update(completed_count=F('completed_count'))
+    return {bucket.pk: bucket for bucket in buckets}
+
+
+def _apply(deltas):
+    if not deltas:
+        return
+    ids = _bucket_ids(list(deltas))
+    with transaction.atomic():
+        buckets = _lock_buckets(ids.values())
+        for key, delta in sorted(deltas.items(), key=lambda item: ids[item[0]]):
+            bucket = buckets[ids[key]]
+            AnalyticsBucket.objects.filter(pk=bucket.pk).update(
+                completed_count=F('completed_count') + delta.completed,
+                skipped_count=F('skipped_count') + delta.skipped,
+                wait_count=F('wait_count') + delta.wait_sketch.count,
+                wait_sum=F('wait_sum') + delta.wait_sum,
+                wait_sketch=QuantileSketch(bucket.wait_sketch).merge(delta.wait_sketch).to_json(),
+                service_count=F('service_count') + delta.service_sketch.count,
+                service_sum=F('service_sum') + delta.service_sum,
+                service_sketch=QuantileSketch(bucket.service_sketch).merge(delta.service_sketch).to_json(),
+            )
+
+
+def _flag_gaps(closures):
+    days = {timezone.localdate(completed_at) for _, _, _, _, _, completed_at in closures}
+    try:
+        AnalyticsGap.objects.bulk_create([AnalyticsGap(date=day) for day in days], ignore_conflicts=True)
+    except Exception:
+        logger.exception("analytics.gap_flag_failed days=%s", ','.join(sorted(map(str, days))))
+
+
+def record_closures(closures):
+    """
+    Fold closed queue entries into the buckets. closures are
+    (service_id, counter_id, status, created_at, started_at, completed_at)
+    tuples. Runs after the serve/skip has committed, so a failure here does
+    not fail the request: the closures' days are flagged for rebuild().
+    """
+    deltas = _deltas(closures)
+    for attempt in range(RECORD_ATTEMPTS):
+        try:
+            _apply(deltas)
+            return
+        except OperationalError:
+            # A deadlock or a busy database; the next try usually gets through
+            if attempt + 1 < RECORD_ATTEMPTS:
+                time.sleep(0.02 * 2 ** attempt * (1 + random.random()))
+                continue
+            logger.exception("analytics.record_failed entries=%s attempts=%s", len(closures), RECORD_ATTEMPTS)
+        except Exception:
+            logger.exception("analytics.record_failed entries=%s", len(closures))
+        break
+    _flag_gaps(closures)
+
+
+def _parse(value):
+    return parse_datetime(value) if value else None
+
+
+def _archived_closures(start, directory=None):
+    """Closures from the history archive files of the days from `start` on"""
+    day, today = timezone.localdate(start), timezone.localdate()
+    while day <= today:
+        path = history.archive_path(day, directory)
+        if os.path.exists(path):
+            for row in history.read_archive(path):
+                if row['completed_at']:
+                    yield (row['service_id'], row['counter_id'], row['current_status'], _parse(row['created_at']),
+                           _parse(row.get('started_at')), _parse(row['completed_at']))
+        day += timedelta(days=1)
+
+
+def rebuild(since, directory=None):
+    """
+    Recompute every bucket from the local day of `since` on out of
+    QueueHistory and the days already archived from it (in `directory`,
+    default QUEUE_HISTORY_ARCHIVE_DIR), clearing the gaps flagged since.
+    Returns the number of history rows replayed.
+    """
+    start = bucket_start('day', since)
+    rows = QueueHistory.objects.filter(completed_at__gte=start).values_list(
+        'service_id', 'counter_id', 'current_status', 'created_at', 'started_at', 'completed_at'
+    )
+    with transaction.atomic():
+        AnalyticsBucket.objects.filter(start__gte=start).delete()
+        AnalyticsGap.objects.filter(date__gte=timezone.localdate(start)).delete()
+        replayed = 0
+        batch = []
+        for row in chain(_archived_closures(start, directory), rows.iterator(chunk_size=2000)):
+            batch.append(row)
+            if len(batch) == 2000:
+                _apply(_deltas(batch))
+                replayed += len(batch)
+                batch = []
+        _apply(_deltas(batch))
+        replayed += len(batch)
+    return replayed
+
+
+def first_gap():
+    """The earliest day flagged as missing closures, or None"""
+    return AnalyticsGap.objects.order_by('date').values_list('date', flat=True).first()
+
+
+# Reports
+
+def _minutes(seconds):
+    return round(seconds / 60, 1) if seconds is not None else None
+
+
+def _summary(completed, skipped, wait_count, wait_sum, wait_sketch, service_count, service_sum, service_sketch):
+    handled = completed + skipped
+    return {
+        'completed': completed,
+        'skipped': skipped,
+        'skip_rate': round(skipped / handled, 3) if handled else None,
+        'avg_wait_minutes': _minutes(wait_sum / wait_count) if wait_count else None,
+        'p50_wait_minutes': _minutes(wait_sketch.quantile(0.5)),
+        'p90_wait_minutes': _minutes(wait_sketch.quantile(0.9)),
+        'avg_service_minutes': _minutes(service_sum / service_count) if service_count else None,
+        'p50_service_minutes': _minutes(service_sketch.quantile(0.5)),
+        'p90_service_minutes': _minutes(service_sketch.quantile(0.9)),
+    }
+
+
+def _bucket_summary(bucket):
+    return _summary(
+        bucket.completed_count, bucket.skipped_count,
+        bucket.wait_count, bucket.wait_sum, QuantileSketch(bucket.wait_sketch),
+        bucket.service_count, bucket.service_sum, QuantileSketch(bucket.service_sketch)
+    )
+
+
+def report(scope, scope_id, period='day', days=7, now=None):
+    """
+    Throughput, waits, service times and skip rate of one service or counter
+    over the last `days` local days (today included): one entry per hour or
+    day, the whole range merged, and the busiest hour of the day.
+    """
+    if scope not in SCOPES or period not in PERIODS:
+        raise ValueError(f"Unknown scope {scope!r} or period {period!r}")
+    days = max(1, min(days, MAX_RANGE_DAYS))
+    since = bucket_start('day', now or timezone.now()) - timedelta(days=days - 1)
+
+    buckets = list(AnalyticsBucket.objects.filter(
+        scope=scope, scope_id=scope_id, period__in=PERIODS, start__gte=since
+    ).order_by('start'))
+
+    totals = [0, 0, 0, 0.0, QuantileSketch(), 0, 0.0, QuantileSketch()]
+    by_hour = [0] * 24
+    series = []
+    for bucket in buckets:
+        if bucket.period == 'hour':
+            by_hour[timezone.localtime(bucket.start).hour] += bucket.completed_count
+        else:
+            totals[0] += bucket.completed_count
+            totals[1] += bucket.skipped_count
+            totals[2] += bucket.wait_count
+            totals[3] += bucket.wait_sum
+            totals[4].merge(QuantileSketch(bucket.wait_sketch))
+            totals[5] += bucket.service_count
+            totals[6] += bucket.service_sum
+            totals[7].merge(QuantileSketch(bucket.service_sketch))
+        if bucket.period == period:
+            series.append({'start': timezone.localtime(bucket.start).isoformat(), **_bucket_summary(bucket)})
+
+    return {
+        'scope': scope,
+        'id': scope_id,
+        'period': period,
+        'since': timezone.localtime(since).isoformat(),
+        'days': days,
+        'total': _summary(*totals),
+        'peak_hour': max(range(24), key=by_hour.__getitem__) if any(by_hour) else None,
+        'series': series,
+    }
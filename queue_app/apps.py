@@ -4,3 +4,18 @@ from django.apps import AppConfig
 class QueueAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'queue_app'
+
+    def ready(self):
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+
+        # Keep cached staff principals in step with admin edits
+        from . import signals  # noqa: F401
+        # Refuse a per-process cache behind a cross-process channel layer
+        from . import checks  # noqa: F401
+        from .metrics import install_query_timer
+
+        # Per-request query metrics, on connections opened from now on and any already open
+        connection_created.connect(install_query_timer)
+        for connection in connections.all(initialized_only=True):
+            install_query_timer(connection=connection)
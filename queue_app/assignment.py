@@ -0,0 +1,90 @@
+# queue_app/assignment.py
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .estimates import get_service_minutes
+from .models import Counter, Service
+
+
+# Counter assignment
+#
+# Each counter keeps a waiting_count that the transitions maintain (+1 when a
+# ticket is issued, -1 when a patient is called), so picking a counter for a
+# new patient reads the (service, waiting_count) index instead of counting
+# every waiting entry of the service. Assignment locks the service row, so
+# concurrent joins for the same service see each other's increments and
+# spread out instead of piling onto the same "emptiest" counter.
+
+POLICIES = {}
+
+
+def register_policy(name):
+    """Register a function (service, counters) -> Counter as an assignment policy"""
+    def decorator(func):
+        POLICIES[name] = func
+        return func
+    return decorator
+
+
+def get_policy(name=None):
+    name = name or getattr(settings, 'QUEUE_ASSIGNMENT_POLICY', 'least_waiting')
+    try:
+        return POLICIES[name]
+    except KeyError:
+        raise ValueError(f"Unknown queue assignment policy: {name}")
+
+
+@register_policy('least_waiting')
+def least_waiting(service, counters):
+    """The counter with the fewest waiting patients, lowest id on ties"""
+    return counters.order_by('waiting_count', 'counter_id').first()
+
+
+@register_policy('least_estimated_time')
+def least_estimated_time(service, counters):
+    """The counter whose queue should clear soonest, by its average service time"""
+    candidates = list(counters.order_by('counter_id'))
+    if not candidates:
+        return None
+    minutes = get_service_minutes((counter.counter_id, counter.service_id) for counter in candidates)
+    return min(candidates, key=lambda counter: (counter.waiting_count + 1) * minutes[counter.counter_id])
+
+
+@register_policy('round_robin')
+def round_robin(service, counters):
+    """The next counter after the one picked last time, wrapping around"""
+    counter = (
+        counters.filter(counter_id__gt=service.assignment_cursor).order_by('counter_id').first()
+        or counters.order_by('counter_id').first()
+    )
+    if counter:
+        Service.objects.filter(pk=service.pk).update(assignment_cursor=counter.counter_id)
+        service.assignment_cursor = counter.counter_id
+    return counter
+
+
+def lock_service(service_id):
+    """Lock the service row for the rest of the transaction and return it"""
+    if connection.features.has_select_for_update:
+        return Service.objects.select_for_update().get(pk=service_id)
+    # SQLite has no row locks; writing first takes the database write lock up front instead
+    Service.objects.filter(pk=service_id).update(updated_at=timezone.now())
+    return Service.objects.get(pk=service_id)
+
+
+def open_counters(service_id, exclude=()):
+    return Counter.objects.filter(
+        service_id=service_id,
+        is_active=True,
+        current_status__in=['available', 'busy']
+    ).exclude(counter_id__in=list(exclude))
+
+
+def assign_counter(service_id, exclude=(), policy=None):
+    """
+    Pick the counter a new patient of the service should join (call inside a
+    transaction, then issue the ticket there). Returns None if no counter is open.
+    """
+    service = lock_service(service_id)
+    return get_policy(policy)(service, open_counters(service_id, exclude))
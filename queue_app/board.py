@@ -0,0 +1,209 @@
+# queue_app/board.py
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .estimates import get_service_minutes
+from .models import Counter, QueueEntry
+from .outbox import publish
+
+
+def build_board_snapshot(counter_ids=None):
+    """
+    Build the display board (every active counter with its serving patient)
+    in a fixed number of queries, however many counters there are.
+    Pass counter_ids to build only those rows.
+    """
+    counters = Counter.objects.filter(is_active=True).select_related('service').order_by('counter_id')
+    serving_entries = QueueEntry.objects.filter(
+        counter__is_active=True,
+        current_status='serving'
+    ).select_related('patient', 'service').order_by('created_at')
+    if counter_ids is not None:
+        counters = counters.filter(counter_id__in=counter_ids)
+        serving_entries = serving_entries.filter(counter_id__in=counter_ids)
+
+    # One query for every serving entry on the board instead of one per counter
+    serving_by_counter = {}
+    for entry in serving_entries:
+        serving_by_counter.setdefault(entry.counter_id, entry)
+
+    counters = list(counters)
+    service_minutes = get_service_minutes((counter.counter_id, counter.service_id) for counter in counters)
+
+    rows = []
+    for counter in counters:
+        serving_patient = serving_by_counter.get(counter.counter_id)
+        rows.append({
+            'counter_id': counter.counter_id,
+            'counter_name': counter.counter_name,
+            'service_name': counter.service.service_name,
+            'current_status': counter.current_status,
+            'service_minutes': service_minutes[counter.counter_id],
+            'serving_patient': {
+                'queue_id': serving_patient.queue_id,
+                'patient_name': serving_patient.patient.name,
+                'service_name': serving_patient.service.service_name,
+                'announcement_count': serving_patient.announcement_count
+            } if serving_patient else None
+        })
+    return rows
+
+
+DISPLAY_GROUP = 'display_updates'
+
+
+# Board caching
+#
+# Every mutation that can change what a display or staff screen shows bumps a
+# version number in the cache. Serialized payloads are stored under the version
+# they were built for, so a bump is all the invalidation that is needed and
+# idle screens are answered from cache (or with a 304) without touching the DB.
+
+BOARD_VERSION_KEY = 'queue_board:version'
+BOARD_PAYLOAD_KEY = 'queue_board:payload:{version}'
+COUNTER_VERSION_KEY = 'queue_board:counter:{counter_id}:version'
+BOARD_PAYLOAD_TIMEOUT = 300
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # Seed from the clock so an evicted key never hands out an old version again
+        version = int(time.time() * 1000)
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+async def _aget_version(key):
+    version = await cache.aget(key)
+    if version is None:
+        version = int(time.time() * 1000)
+        if not await cache.aadd(key, version, None):
+            version = await cache.aget(key, version)
+    return version
+
+
+def _bump_version(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        return _get_version(key)
+
+
+def get_board_version():
+    return _get_version(BOARD_VERSION_KEY)
+
+
+def get_counter_version(counter_id):
+    return _get_version(COUNTER_VERSION_KEY.format(counter_id=counter_id))
+
+
+async def aget_board_version():
+    return await _aget_version(BOARD_VERSION_KEY)
+
+
+async def aget_counter_version(counter_id):
+    return await _aget_version(COUNTER_VERSION_KEY.format(counter_id=counter_id))
+
+
+def invalidate_board(*counter_ids):
+    """Bump the board version and the version of each counter that changed"""
+    for counter_id in counter_ids:
+        _bump_version(COUNTER_VERSION_KEY.format(counter_id=counter_id))
+    return _bump_version(BOARD_VERSION_KEY)
+
+
+def _build_board_payload(version):
+    payload = json.dumps({
+        'seq': version,
+        'counters': build_board_snapshot(),
+        'timestamp': timezone.now().isoformat()
+    }, cls=DjangoJSONEncoder)
+    cache.set(BOARD_PAYLOAD_KEY.format(version=version), payload, BOARD_PAYLOAD_TIMEOUT)
+    return payload
+
+
+def get_board_payload():
+    """Return (version, serialized JSON) for the display board, building it at most once per version"""
+    version = get_board_version()
+    payload = cache.get(BOARD_PAYLOAD_KEY.format(version=version))
+    if payload is None:
+        payload = _build_board_payload(version)
+    return version, payload
+
+
+async def aget_board_payload():
+    """get_board_payload for async views, through the async cache API"""
+    version = await aget_board_version()
+    payload = await cache.aget(BOARD_PAYLOAD_KEY.format(version=version))
+    if payload is None:
+        payload = await sync_to_async(_build_board_payload)(version)
+    return version, payload
+
+
+# Display push protocol
+#
+# Screens on ws/display/updates/ get a full snapshot on connect and then one
+# delta per board version. The board version doubles as the sequence number:
+# deltas carry complete rows for the counters that changed, so applying one
+# twice is harmless, and the last BOARD_DELTA_BACKLOG of them are kept in the
+# cache so a screen that reconnects with ?since=<seq> only replays what it missed.
+
+BOARD_DELTA_KEY = 'queue_board:delta:{seq}'
+BOARD_DELTA_BACKLOG = 200
+BOARD_DELTA_TIMEOUT = 600
+
+
+def snapshot_frame(payload):
+    # The cached payload is already a JSON object, so splice the type in rather than re-serializing it
+    return '{"type": "snapshot", ' + payload[1:]
+
+
+def publish_board_change(event, *counter_ids, **extra):
+    """
+    Invalidate the board for the given counters and push a delta with their
+    fresh rows to every display screen. Returns the new sequence number.
+    """
+    seq = invalidate_board(*counter_ids)
+    message = {
+        'type': 'delta',
+        'seq': seq,
+        'event': event,
+        'counters': build_board_snapshot(counter_ids),
+        'timestamp': timezone.now().isoformat()
+    }
+    message.update(extra)
+    frame = json.dumps(message, cls=DjangoJSONEncoder)
+    cache.set(BOARD_DELTA_KEY.format(seq=seq), frame, BOARD_DELTA_TIMEOUT)
+
+    # Deltas are never coalesced: screens rely on seeing every seq
+    publish(
+        DISPLAY_GROUP,
+        {
+            "type": "display_update",
+            "frame": frame
+        }
+    )
+    return seq
+
+
+def get_resume_frames(since=None):
+    """
+    Frames a (re)connecting screen needs: the deltas after `since` if they are
+    all still in the backlog, otherwise a full snapshot.
+    """
+    version = get_board_version()
+    if since is not None and 0 <= version - since <= BOARD_DELTA_BACKLOG:
+        keys = [BOARD_DELTA_KEY.format(seq=seq) for seq in range(since + 1, version + 1)]
+        deltas = cache.get_many(keys)
+        if len(deltas) == len(keys):
+            return [deltas[key] for key in keys]
+
+    version, payload = get_board_payload()
+    return [snapshot_frame(payload)]
@@ -0,0 +1,225 @@
+# queue_app/channel_layers.py
+import asyncio
+import pickle
+import random
+import sqlite3
+import string
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    """
+    Cross-process channel layer backed by a local SQLite file.
+
+    Every worker pointed at the same file shares channels and groups, so a
+    group_send from one Daphne process reaches sockets held by another. It is
+    the single-host / CI stand-in for channels_redis and supports the same
+    'groups' and 'flush' extensions. Each process fetches all of its pending
+    messages with one polling query, however many sockets it holds.
+
+    Messages are pickled, so only point trusted processes at the file.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path='channel_layer.sqlite3', expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, poll_interval=0.005, max_poll_interval=0.1, batch_size=500):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.batch_size = batch_size
+        self.client_prefix = ''.join(random.choices(string.ascii_letters, k=12))
+
+        # All SQLite work for this layer happens on one thread, which owns the connection
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-channel-layer')
+        self._conn = None
+        self._last_cleanup = 0
+
+        # Receive-side state is bound to the event loop that started receiving
+        self._loop = None
+        self._receive_queues = {}
+        self._poller = None
+
+    # Storage (runs on the executor thread)
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS channel_messages ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT NOT NULL, channel TEXT NOT NULL, '
+                'body BLOB NOT NULL, expires REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS channel_messages_target ON channel_messages (target, id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS channel_messages_channel ON channel_messages (channel)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS channel_groups ('
+                'group_name TEXT NOT NULL, channel TEXT NOT NULL, expires REAL NOT NULL, '
+                'PRIMARY KEY (group_name, channel))'
+            )
+            self._conn = conn
+        return self._conn
+
+    def _store_send(self, channel, body):
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            queued = conn.execute(
+                'SELECT COUNT(*) FROM channel_messages WHERE channel = ? AND expires > ?', (channel, now)
+            ).fetchone()[0]
+            if queued >= self.get_capacity(channel):
+                raise ChannelFull(channel)
+            conn.execute(
+                'INSERT INTO channel_messages (target, channel, body, expires) VALUES (?, ?, ?, ?)',
+                (self.non_local_name(channel), channel, body, now + self.expiry)
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _store_group_send(self, group, body):
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            members = conn.execute(
+                'SELECT g.channel, (SELECT COUNT(*) FROM channel_messages m WHERE m.channel = g.channel) '
+                'FROM channel_groups g WHERE g.group_name = ? AND g.expires > ?', (group, now)
+            ).fetchall()
+            # Like channels_redis, a full member channel just misses the group message
+            rows = [
+                (self.non_local_name(channel), channel, body, now + self.expiry)
+                for channel, queued in members
+                if queued < self.get_capacity(channel)
+            ]
+            conn.executemany(
+                'INSERT INTO channel_messages (target, channel, body, expires) VALUES (?, ?, ?, ?)', rows
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return len(rows)
+
+    def _store_fetch(self, targets):
+        conn = self._connection()
+        now = time.time()
+        placeholders = ', '.join('?' * len(targets))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                f'SELECT id, channel, body, expires FROM channel_messages WHERE target IN ({placeholders}) '
+                f'ORDER BY id LIMIT ?', (*targets, self.batch_size)
+            ).fetchall()
+            if rows:
+                conn.execute(
+                    f'DELETE FROM channel_messages WHERE id IN ({", ".join("?" * len(rows))})',
+                    [row[0] for row in rows]
+                )
+            if now - self._last_cleanup > self.expiry:
+                conn.execute('DELETE FROM channel_messages WHERE expires <= ?', (now,))
+                conn.execute('DELETE FROM channel_groups WHERE expires <= ?', (now,))
+                self._last_cleanup = now
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return [(channel, body) for _, channel, body, expires in rows if expires > now]
+
+    def _store_group_add(self, group, channel):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO channel_groups (group_name, channel, expires) VALUES (?, ?, ?)',
+            (group, channel, time.time() + self.group_expiry)
+        )
+
+    def _store_group_discard(self, group, channel):
+        self._connection().execute(
+            'DELETE FROM channel_groups WHERE group_name = ? AND channel = ?', (group, channel)
+        )
+
+    def _store_flush(self):
+        conn = self._connection()
+        conn.execute('DELETE FROM channel_messages')
+        conn.execute('DELETE FROM channel_groups')
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        await self._run(self._store_send, channel, pickle.dumps(message))
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._receive_queues = {}
+            self._poller = None
+
+        queue = self._receive_queues.setdefault(channel, asyncio.Queue())
+        if self._poller is None or self._poller.done():
+            self._poller = loop.create_task(self._poll())
+
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            # The consumer went away; stop polling for it unless messages are still buffered
+            if queue.empty() and self._receive_queues.get(channel) is queue:
+                del self._receive_queues[channel]
+            raise
+
+    async def _poll(self):
+        interval = self.poll_interval
+        while self._receive_queues:
+            targets = sorted({self.non_local_name(channel) for channel in self._receive_queues})
+            rows = await self._run(self._store_fetch, targets)
+            for channel, body in rows:
+                queue = self._receive_queues.get(channel)
+                if queue is not None:
+                    queue.put_nowait(pickle.loads(body))
+            if rows:
+                interval = self.poll_interval
+            else:
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, self.max_poll_interval)
+
+    async def new_channel(self, prefix='specific'):
+        return f"{prefix}.{self.client_prefix}!{''.join(random.choices(string.ascii_letters, k=12))}"
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._run(self._store_group_add, group, channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._run(self._store_group_discard, group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        await self._run(self._store_group_send, group, pickle.dumps(message))
+
+    async def flush(self):
+        self._receive_queues = {}
+        await self._run(self._store_flush)
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
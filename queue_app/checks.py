@@ -0,0 +1,34 @@
+# queue_app/checks.py
+from django.conf import settings
+from django.core import checks
+
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+PROCESS_LOCAL_LAYERS = (
+    'channels.layers.InMemoryChannelLayer',
+)
+
+
+# Multi-worker deployments
+#
+# A cross-process channel layer means several workers, and every worker must
+# then see the same cache: board versions and delta frames, OTPs and rate
+# limits, staff principals and SMS delivery status all live there. With a
+# per-process cache a worker would keep answering from its own stale copy
+# (e.g. 304s for a board another worker changed), so refuse the combination.
+
+@checks.register()
+def check_shared_cache(app_configs, **kwargs):
+    layer = getattr(settings, 'CHANNEL_LAYERS', {}).get('default', {}).get('BACKEND', '')
+    cache = settings.CACHES.get('default', {}).get('BACKEND', '')
+    if layer in PROCESS_LOCAL_LAYERS or cache not in PROCESS_LOCAL_CACHES:
+        return []
+    return [checks.Error(
+        f"The default cache ({cache}) is local to each process, but the channel layer ({layer}) "
+        f"is shared by several workers, so they would not see each other's board versions, OTPs "
+        f"or staff principals.",
+        hint='Set CACHE_BACKEND=redis (or database), or point CACHES at another shared cache.',
+        id='queue_app.E001',
+    )]
@@ -1,58 +1,147 @@
 # consumers.py
 import json
+import logging
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from .board import DISPLAY_GROUP, get_resume_frames
+from .engine import live_engine
+from .metrics import registry
+from .models import Counter
+from .notifications import counter_group, service_group
+from .patient_updates import patient_group, patient_status
+
+logger = logging.getLogger(__name__)
+
+def get_subscription_groups(session):
+    """
+    Groups a ws/queue/updates/ socket should join: staff get their counter and
+    its service. Patients use ws/patient/updates/ instead.
+    """
+    if session is None:
+        return []
+
+    staff_id = session.get('staff_id')
+    if staff_id:
+        counter = Counter.objects.filter(staff_id=staff_id).values('counter_id', 'service_id').first()
+        if not counter:
+            return []
+        return [counter_group(counter['counter_id']), service_group(counter['service_id'])]
+
+    return []
+
 
 class QueueUpdatesConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         # Accept the connection
         await self.accept()
         
-        # Add this connection to the "staff_updates" group
-        await self.channel_layer.group_add(
-            "staff_updates",
-            self.channel_name
-        )
+        # Only subscribe to the counter/service groups this session cares about
+        self.subscriptions = await database_sync_to_async(get_subscription_groups)(self.scope.get('session'))
+        for group in self.subscriptions:
+            await self.channel_layer.group_add(group, self.channel_name)
+            registry.ws_connected(group)
         
-        print(f"WebSocket connected: {self.channel_name}")
+        logger.debug("ws.connect channel=%s groups=%s", self.channel_name, ','.join(self.subscriptions))
 
     async def disconnect(self, close_code):
-        # Remove from group
-        await self.channel_layer.group_discard(
-            "staff_updates",
-            self.channel_name
-        )
-        print(f"WebSocket disconnected: {self.channel_name}")
+        # Remove from groups
+        for group in getattr(self, 'subscriptions', []):
+            await self.channel_layer.group_discard(group, self.channel_name)
+            registry.ws_connected(group, -1)
+        logger.debug("ws.disconnect channel=%s", self.channel_name)
 
     async def receive(self, text_data):
         # Handle incoming messages (if needed)
         try:
             data = json.loads(text_data)
-            print("Received:", data)
-        except Exception as e:
-            print(f"WebSocket receive error: {str(e)}")
+            logger.debug("ws.receive channel=%s data=%s", self.channel_name, data)
+        except Exception:
+            logger.warning("ws.receive_invalid channel=%s", self.channel_name)
 
     # This method handles messages sent to the group
     async def send_update(self, event):
         # Send message to WebSocket
         message = event["message"]
         await self.send(text_data=json.dumps(message))
-        print(f"WebSocket message sent: {message}")
+        registry.ws_delivered_to(event["group"])
+
+
+class PatientUpdatesConsumer(AsyncWebsocketConsumer):
+    """
+    A patient dashboard's own queue status: a snapshot on connect, then a
+    message whenever the patient's status, position or ETA changes.
+    """
+    async def connect(self):
+        session = self.scope.get('session')
+        phone_number = await database_sync_to_async(session.get)('patient_phone') if session is not None else None
+        if not phone_number:
+            await self.close()
+            return
+
+        self.group = patient_group(phone_number)
+        # Join before reading the snapshot, so no change can fall between the two
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        registry.ws_connected(self.group)
+        await self.accept()
+        engine = live_engine()
+        if engine is not None:
+            status = await engine.apatient_status(phone_number)
+        else:
+            status = await database_sync_to_async(patient_status)(phone_number)
+        await self.send(text_data=json.dumps(status))
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'group'):
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+            registry.ws_connected(self.group, -1)
+
+    async def send_update(self, event):
+        await self.send(text_data=json.dumps(event["message"]))
+        registry.ws_delivered_to(event["group"])
 
 
 class DisplayUpdatesConsumer(AsyncWebsocketConsumer):
+    """
+    Pushes the display board: a snapshot on connect, then per-counter deltas.
+    Reconnect with ?since=<seq> (or send {"action": "resync", "since": seq})
+    to replay only the deltas missed while disconnected.
+    """
     async def connect(self):
         await self.channel_layer.group_add(
-            "display_updates",
+            DISPLAY_GROUP,
             self.channel_name
         )
+        registry.ws_connected(DISPLAY_GROUP)
         await self.accept()
 
+        since = parse_qs(self.scope.get('query_string', b'').decode()).get('since', [None])[0]
+        await self.send_resume_frames(since)
+
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(
-            "display_updates",
+            DISPLAY_GROUP,
             self.channel_name
         )
+        registry.ws_connected(DISPLAY_GROUP, -1)
+
+    async def receive(self, text_data):
+        try:
+            data = json.loads(text_data)
+        except ValueError:
+            return
+        if data.get('action') == 'resync':
+            await self.send_resume_frames(data.get('since'))
+
+    async def send_resume_frames(self, since):
+        try:
+            since = int(since) if since is not None else None
+        except (TypeError, ValueError):
+            since = None
+
+        for frame in await database_sync_to_async(get_resume_frames)(since):
+            await self.send(text_data=frame)
 
     async def display_update(self, event):
-        await self.send(text_data=json.dumps(event["message"]))
+        await self.send(text_data=event["frame"])
+        registry.ws_delivered_to(DISPLAY_GROUP)
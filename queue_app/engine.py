@@ -0,0 +1,787 @@
+# queue_app/engine.py
+import atexit
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DataError, DatabaseError, IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from . import analytics, estimates, eventlog, patient_updates, transitions
+from .estimates import get_service_minutes
+from .models import Counter, QueueEntry, QueueHistory, Service
+from .transitions import MAX_ANNOUNCEMENTS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 0.05
+
+# Pending rows that wake the writer before its interval is up
+DEFAULT_FLUSH_BATCH = 500
+
+# Failed flushes in a row after which the queued after_write callbacks run anyway
+MAX_FLUSH_FAILURES = 5
+
+ENTRY_FIELDS = ['counter', 'current_status', 'ticket_number', 'announcement_count', 'started_at', 'updated_at']
+COUNTER_FIELDS = ['current_status', 'status_updated_at', 'last_ticket', 'serving_ticket', 'waiting_count', 'updated_at']
+
+LIVE_STATUSES = ('waiting', 'serving')
+
+
+# In-memory queue engine
+#
+# With QUEUE_ENGINE = 'memory' this process holds the live queue: for every
+# counter a deque of waiting tickets in ticket order and the ticket(s) it is
+# serving. serve/skip/start/announce, joins, redistribution and position
+# lookups are answered from memory under one lock (each takes microseconds)
+# instead of locking and re-reading rows, and the changed rows are written
+# behind: a writer thread persists everything changed since its last pass in
+# one transaction every QUEUE_ENGINE_FLUSH_INTERVAL seconds. Patients are
+# pushed their new status straight from memory; the display board, which is
+# built from the database, is published through after_write() once the rows
+# it shows are committed. Staff pages read the database and so trail the
+# engine by at most one flush.
+#
+# The engine is rebuilt from QueueEntry and Counter the first time it is
+# used, so a restart loses at most the last flush interval of changes. Being
+# the authority for the queue, it needs every request that changes the queue
+# to reach this process: run one ASGI worker, and change live entries only
+# through it (an admin edit to QueueEntry is seen after a restart). Counters
+# saved or deleted elsewhere are picked up through their signals.
+
+class PatientRef:
+    __slots__ = ('phone_number', 'name')
+
+    def __init__(self, phone_number, name):
+        self.phone_number = phone_number
+        self.name = name
+
+
+class Ticket:
+    """A live queue entry; the attribute names match QueueEntry's so views and pushes take either"""
+    __slots__ = (
+        'queue_id', 'patient', 'service_id', 'counter', 'current_status', 'ticket_number',
+        'announcement_count', 'created_at', 'started_at', 'completed_at'
+    )
+
+    def __init__(self, queue_id, patient, service_id, counter, current_status='waiting', ticket_number=0,
+                 announcement_count=0, created_at=None, started_at=None):
+        self.queue_id = queue_id
+        self.patient = patient
+        self.service_id = service_id
+        self.counter = counter
+        self.current_status = current_status
+        self.ticket_number = ticket_number
+        self.announcement_count = announcement_count
+        self.created_at = created_at
+        self.started_at = started_at
+        self.completed_at = None
+
+    @property
+    def pk(self):
+        return self.queue_id
+
+    @property
+    def patient_id(self):
+        return self.patient.phone_number
+
+    @property
+    def counter_id(self):
+        return self.counter.counter_id if self.counter is not None else None
+
+
+class CounterQueue:
+    """A counter's state and queue; waiting holds Tickets in ticket order"""
+    __slots__ = (
+        'counter_id', 'service_id', 'counter_name', 'current_status', 'status_updated_at', 'is_active',
+        'last_ticket', 'serving_ticket', 'waiting', 'serving'
+    )
+
+    def __init__(self, counter):
+        self.counter_id = counter.counter_id
+        self.last_ticket = counter.last_ticket
+        self.serving_ticket = counter.serving_ticket
+        self.waiting = deque()
+        # Normally at most one, as in the table
+        self.serving = []
+        self.update(counter)
+
+    def update(self, counter):
+        """Take the fields edited outside the engine from a Counter row"""
+        self.service_id = counter.service_id
+        self.counter_name = counter.counter_name
+        self.current_status = counter.current_status
+        self.status_updated_at = counter.status_updated_at
+        self.is_active = counter.is_active
+
+    @property
+    def pk(self):
+        return self.counter_id
+
+    @property
+    def waiting_count(self):
+        return len(self.waiting)
+
+    @property
+    def is_open(self):
+        return self.is_active and self.current_status in ('available', 'busy')
+
+
+class AlreadyQueued(Exception):
+    pass
+
+
+# Write-behind
+#
+# Changes are recorded as references to the changed tickets and counters, not
+# as statements, so ten changes to a ticket between two flushes are one row
+# update. A flush copies their current values under the engine lock and
+# writes them outside it: new tickets are inserted, changed ones bulk-updated,
+# closed ones moved into QueueHistory, counters bulk-updated, all in one
+# transaction.
+#
+# If that fails, the batch is written again one row per transaction, so a
+# row that can never be written (say its patient was deleted in the admin)
+# is logged and dropped instead of holding up every change behind it. Rows
+# that fail for another reason, such as a lost connection, are put back with
+# the rest of the batch and retried on the next pass; after
+# MAX_FLUSH_FAILURES failed passes in a row the after_write callbacks stop
+# waiting for them and run anyway.
+
+class _Batch:
+    __slots__ = ('new', 'dirty', 'closed', 'counters', 'cursors', 'callbacks', 'rows', 'taken', 'written')
+
+
+class WriteBehind:
+    """Persists the engine's changes in batches, on a thread or when flush() is called"""
+
+    def __init__(self, lock, interval=None, batch_size=None):
+        self._lock = lock
+        self._flush_lock = threading.Lock()
+        self.interval = interval
+        self.batch_size = batch_size
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopped = False
+        self._clear()
+        self.flushes = self.failures = self.rows = self.dropped = 0
+        self.failed_in_row = 0
+        self.last_flush = self.max_flush = 0.0
+
+    def _clear(self):
+        self.new = {}         # queue_id -> Ticket not yet inserted
+        self.dirty = {}       # queue_id -> Ticket changed since it was
+        self.closed = []      # Tickets that left the queue
+        self.counters = {}    # counter_id -> CounterQueue
+        self.cursors = {}     # service_id -> round-robin cursor
+        self.callbacks = []
+        self.oldest = None
+
+    # Called by the engine, holding its lock
+
+    def created(self, ticket):
+        self.new[ticket.queue_id] = ticket
+        self._changed()
+
+    def changed(self, ticket):
+        self.dirty[ticket.queue_id] = ticket
+        self._changed()
+
+    def closed_ticket(self, ticket):
+        self.closed.append(ticket)
+        self._changed()
+
+    def counter_changed(self, counter):
+        self.counters[counter.counter_id] = counter
+        self._changed()
+
+    def cursor_moved(self, service_id, cursor):
+        self.cursors[service_id] = cursor
+        self._changed()
+
+    def forget_counter(self, counter_id):
+        """Drop pending writes for a deleted counter; its rows are gone with it"""
+        self.counters.pop(counter_id, None)
+        for pending in (self.new, self.dirty):
+            for queue_id in [queue_id for queue_id, ticket in pending.items() if ticket.counter_id == counter_id]:
+                del pending[queue_id]
+        self.closed = [ticket for ticket in self.closed if ticket.counter_id != counter_id]
+
+    def _changed(self):
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if self.pending() >= (self.batch_size or getattr(settings, 'QUEUE_ENGINE_FLUSH_BATCH', DEFAULT_FLUSH_BATCH)):
+            self._wakeup.set()
+        self._ensure_thread()
+
+    def pending(self):
+        return len(self.new) + len(self.dirty) + len(self.closed) + len(self.counters) + len(self.cursors)
+
+    def after_write(self, callback):
+        with self._lock:
+            self.callbacks.append(callback)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            self._ensure_thread()
+
+    # Flushing
+
+    def flush(self):
+        """Write everything changed so far; returns the number of rows written"""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._take()
+            if batch is None:
+                return 0
+            started = time.perf_counter()
+            try:
+                try:
+                    self._write(batch)
+                except DatabaseError:
+                    logger.warning("engine.batch_failed rows=%s; writing row by row", batch.rows, exc_info=True)
+                    self._write_rows(batch)
+            except Exception:
+                with self._lock:
+                    self.failures += 1
+                    self.failed_in_row += 1
+                    if self.failed_in_row >= MAX_FLUSH_FAILURES:
+                        # Board publishes and the like must not wait on the database forever
+                        callbacks, batch.callbacks = batch.callbacks, []
+                    else:
+                        callbacks = []
+                    self._restore(batch)
+                for callback in callbacks:
+                    transaction.on_commit(callback, robust=True)
+                raise
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.failed_in_row = 0
+                self.flushes += 1
+                self.rows += batch.rows
+                self.last_flush = elapsed
+                self.max_flush = max(self.max_flush, elapsed)
+            return batch.rows
+
+    def _take(self):
+        if not (self.pending() or self.callbacks):
+            return None
+        now = timezone.now()
+        batch = _Batch()
+        batch.new = [
+            QueueEntry(
+                queue_id=ticket.queue_id, patient_id=ticket.patient_id, service_id=ticket.service_id,
+                counter_id=ticket.counter_id, current_status=ticket.current_status,
+                ticket_number=ticket.ticket_number, announcement_count=ticket.announcement_count,
+                created_at=ticket.created_at, started_at=ticket.started_at
+            )
+            for ticket in self.new.values() if ticket.current_status in LIVE_STATUSES
+        ]
+        batch.dirty = [
+            QueueEntry(
+                queue_id=ticket.queue_id, counter_id=ticket.counter_id, current_status=ticket.current_status,
+                ticket_number=ticket.ticket_number, announcement_count=ticket.announcement_count,
+                started_at=ticket.started_at, updated_at=now
+            )
+            for queue_id, ticket in self.dirty.items()
+            if ticket.current_status in LIVE_STATUSES and queue_id not in self.new
+        ]
+        batch.closed = [
+            (ticket.queue_id, ticket.patient_id, ticket.service_id, ticket.counter_id, ticket.current_status,
+             ticket.created_at, ticket.started_at, ticket.completed_at)
+            for ticket in self.closed
+        ]
+        batch.counters = [
+            Counter(
+                counter_id=counter.counter_id, current_status=counter.current_status,
+                status_updated_at=counter.status_updated_at, last_ticket=counter.last_ticket,
+                serving_ticket=counter.serving_ticket, waiting_count=len(counter.waiting), updated_at=now
+            )
+            for counter in self.counters.values()
+        ]
+        batch.cursors = list(self.cursors.items())
+        batch.callbacks = self.callbacks
+        batch.rows = len(batch.new) + len(batch.dirty) + len(batch.closed) + len(batch.counters) + len(batch.cursors)
+        # Kept to put back if the write fails
+        batch.taken = (self.new, self.dirty, self.closed, self.counters, self.cursors)
+        # What the row-by-row fallback has written or dropped, as ('kind', key)
+        batch.written = set()
+        self._clear()
+        return batch
+
+    def _restore(self, batch):
+        """Put back whatever of the batch was not written"""
+        new, dirty, closed, counters, cursors = batch.taken
+        written = batch.written
+        for kind, pending, taken in (('new', self.new, new), ('dirty', self.dirty, dirty),
+                                     ('counter', self.counters, counters), ('cursor', self.cursors, cursors)):
+            for key, value in taken.items():
+                if (kind, key) not in written:
+                    pending.setdefault(key, value)
+        self.closed[:0] = [ticket for ticket in closed if ('closed', ticket.queue_id) not in written]
+        self.callbacks[:0] = batch.callbacks
+        self.oldest = self.oldest or time.monotonic()
+
+    @staticmethod
+    def _history(closed):
+        return [
+            QueueHistory(
+                queue_id=queue_id, patient_id=patient_id, service_id=service_id, counter_id=counter_id,
+                current_status=status, skipped_at=completed_at if status == 'skipped' else None,
+                created_at=created_at, updated_at=completed_at, date=timezone.localdate(completed_at),
+                started_at=started_at, completed_at=completed_at
+            )
+            for queue_id, patient_id, service_id, counter_id, status, created_at, started_at, completed_at in closed
+        ]
+
+    def _apply(self, new=(), dirty=(), closed=(), counters=(), cursors=()):
+        if new:
+            QueueEntry.objects.bulk_create(new)
+        if dirty:
+            QueueEntry.objects.bulk_update(dirty, ENTRY_FIELDS)
+        if closed:
+            QueueHistory.objects.bulk_create(self._history(closed))
+            # Tickets that joined and left between two flushes were never inserted; deleting them is a no-op
+            QueueEntry.objects.filter(pk__in=[row[0] for row in closed]).delete()
+        if counters:
+            Counter.objects.bulk_update(counters, COUNTER_FIELDS)
+        for service_id, cursor in cursors:
+            Service.objects.filter(pk=service_id).update(assignment_cursor=cursor)
+
+    def _write(self, batch):
+        with transaction.atomic():
+            self._apply(batch.new, batch.dirty, batch.closed, batch.counters, batch.cursors)
+            self._follow_up(batch.closed, batch.callbacks)
+
+    def _write_rows(self, batch):
+        """Write the batch a row per transaction, dropping the rows the database rejects"""
+        rows = (
+            [(('new', entry.queue_id), {'new': [entry]}) for entry in batch.new]
+            + [(('dirty', entry.queue_id), {'dirty': [entry]}) for entry in batch.dirty]
+            + [(('closed', row[0]), {'closed': [row]}) for row in batch.closed]
+            + [(('counter', counter.counter_id), {'counters': [counter]}) for counter in batch.counters]
+            + [(('cursor', cursor[0]), {'cursors': [cursor]}) for cursor in batch.cursors]
+        )
+        dropped = set()
+        for key, row in rows:
+            try:
+                with transaction.atomic():
+                    self._apply(**row)
+            except (IntegrityError, DataError):
+                # It will fail the same way every time: keeping it would block everything behind it
+                logger.error("engine.row_dropped kind=%s key=%s", key[0], key[1], exc_info=True)
+                dropped.add(key)
+            batch.written.add(key)
+        with self._lock:
+            self.dropped += len(dropped)
+        # The follow-ups for the rows that made it; the callbacks run either way
+        self._follow_up([row for row in batch.closed if ('closed', row[0]) not in dropped], batch.callbacks)
+
+    @staticmethod
+    def _follow_up(closed, callbacks):
+        """The same follow-ups the transitions run on commit, then whatever waited for these rows"""
+        closures = [
+            (service_id, counter_id, status, created_at, started_at, completed_at)
+            for _, _, service_id, counter_id, status, created_at, started_at, completed_at in closed
+        ]
+        for service_id, counter_id, _, _, _, completed_at in closures:
+            transaction.on_commit(
+                lambda c=counter_id, s=service_id, at=completed_at: estimates.record_completion(c, s, at)
+            )
+        if closures:
+            transaction.on_commit(lambda: analytics.record_closures(closures))
+        for callback in callbacks:
+            transaction.on_commit(callback, robust=True)
+
+    # The writer thread
+
+    def _ensure_thread(self):
+        interval = self._interval()
+        if interval and self._thread is None and not self._stopped:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='queue-engine-writer', daemon=True)
+            self._thread.start()
+
+    def _interval(self):
+        if self.interval is not None:
+            return self.interval
+        return getattr(settings, 'QUEUE_ENGINE_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+
+    def _run(self, interval):
+        while not self._stopped:
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception:
+                logger.exception("engine.flush_failed pending=%s", self.pending())
+
+    def close(self):
+        """Stop the writer thread after a last flush"""
+        self._stopped = True
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._wakeup.set()
+            thread.join(timeout=5)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("engine.final_flush_failed pending=%s", self.pending())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self.pending(),
+                'callbacks': len(self.callbacks),
+                'lag_ms': round((time.monotonic() - self.oldest) * 1000, 2) if self.oldest is not None else 0.0,
+                'flushes': self.flushes,
+                'failures': self.failures,
+                'dropped': self.dropped,
+                'rows': self.rows,
+                'flush_ms': {'last': round(self.last_flush * 1000, 2), 'max': round(self.max_flush * 1000, 2)},
+            }
+
+
+class QueueEngine:
+    """
+    The live queue in memory. The transition methods take and return the same
+    things as their namesakes in transitions.py, with Tickets and
+    CounterQueues in place of QueueEntry and Counter rows.
+    """
+
+    def __init__(self, flush_interval=None, batch_size=None):
+        self._lock = threading.RLock()
+        self.writer = WriteBehind(self._lock, flush_interval, batch_size)
+        self.loaded = False
+        self.counters = {}    # counter_id -> CounterQueue
+        self.tickets = {}     # queue_id -> live Ticket
+        self.by_patient = {}  # phone number -> live Ticket
+        self.cursors = {}     # service_id -> round-robin cursor
+
+    def load(self):
+        """(Re)build the live queue from the database"""
+        with self._lock:
+            counters = {counter.counter_id: CounterQueue(counter) for counter in Counter.objects.all()}
+            tickets, by_patient, patients = {}, {}, {}
+            entries = QueueEntry.objects.filter(current_status__in=LIVE_STATUSES).select_related('patient') \
+                .order_by('ticket_number', 'created_at')
+            for entry in entries:
+                patient = patients.get(entry.patient_id)
+                if patient is None:
+                    patient = patients[entry.patient_id] = PatientRef(entry.patient_id, entry.patient.name)
+                counter = counters.get(entry.counter_id)
+                ticket = Ticket(
+                    entry.queue_id, patient, entry.service_id, counter, entry.current_status, entry.ticket_number,
+                    entry.announcement_count, entry.created_at, entry.started_at
+                )
+                tickets[ticket.queue_id] = ticket
+                by_patient.setdefault(patient.phone_number, ticket)
+                if counter is not None:
+                    (counter.serving if ticket.current_status == 'serving' else counter.waiting).append(ticket)
+            self.counters, self.tickets, self.by_patient = counters, tickets, by_patient
+            self.cursors = {}
+            self.loaded = True
+            logger.info("engine.loaded counters=%s tickets=%s", len(counters), len(tickets))
+
+    def reset(self):
+        """Write out pending changes and drop the state; the next call rebuilds it"""
+        self.writer.flush()
+        with self._lock:
+            self.loaded = False
+            self.counters, self.tickets, self.by_patient, self.cursors = {}, {}, {}, {}
+
+    def flush(self):
+        return self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def _counter(self, counter_id):
+        self._ensure_loaded()
+        counter = self.counters.get(counter_id)
+        if counter is None:
+            # Created since the engine was loaded and not seen through the signal
+            counter = self.counters[counter_id] = CounterQueue(Counter.objects.get(pk=counter_id))
+        return counter
+
+    # Counters changed outside the engine
+
+    def counter_saved(self, row):
+        with self._lock:
+            if not self.loaded:
+                return
+            counter = self.counters.get(row.counter_id)
+            if counter is None:
+                self.counters[row.counter_id] = CounterQueue(row)
+            else:
+                counter.update(row)
+                # A flush taken before this save may still write the old status over it
+                self.writer.counter_changed(counter)
+
+    def counter_deleted(self, counter_id):
+        with self._lock:
+            if not self.loaded:
+                return
+            counter = self.counters.pop(counter_id, None)
+            if counter is not None:
+                for ticket in counter.serving + list(counter.waiting):
+                    self._drop(ticket)
+            self.writer.forget_counter(counter_id)
+
+    # Bookkeeping shared by the transitions
+
+    def _drop(self, ticket):
+        self.tickets.pop(ticket.queue_id, None)
+        if self.by_patient.get(ticket.patient_id) is ticket:
+            del self.by_patient[ticket.patient_id]
+
+    def _set_status(self, counter, status, now):
+        if counter.current_status != status:
+            counter.current_status = status
+            counter.status_updated_at = now
+            self.writer.counter_changed(counter)
+
+    def _close(self, counter, tickets, status, now):
+        for ticket in tickets:
+            ticket.current_status = status
+            ticket.completed_at = now
+            self._drop(ticket)
+            self.writer.closed_ticket(ticket)
+        patient_updates.push_closed(counter, tickets, status)
+
+    def _start(self, counter, ticket, now):
+        ticket.current_status = 'serving'
+        ticket.started_at = now
+        counter.serving.append(ticket)
+        counter.current_status = 'busy'
+        counter.status_updated_at = now
+        counter.serving_ticket = ticket.ticket_number
+        self.writer.changed(ticket)
+        self.writer.counter_changed(counter)
+
+    def _promote_next(self, counter, now):
+        if counter.waiting:
+            ticket = counter.waiting.popleft()
+            self._start(counter, ticket, now)
+            return ticket
+        self._set_status(counter, 'available', now)
+        return None
+
+    def _push_counter(self, counter):
+        patient_updates.push_entries(counter, counter.serving + list(counter.waiting))
+
+    @staticmethod
+    def _serving(counter, queue_id):
+        return next((ticket for ticket in counter.serving if ticket.queue_id == queue_id), None)
+
+    # Transitions
+
+    def serve_next(self, counter_id):
+        with self._lock:
+            counter = self._counter(counter_id)
+            now = timezone.now()
+            completed, counter.serving = counter.serving, []
+            if completed:
+                self._close(counter, completed, 'completed', now)
+            next_ticket = self._promote_next(counter, now)
+            self._push_counter(counter)
+            eventlog.log_serve(counter, completed, next_ticket)
+        return counter, completed, next_ticket
+
+    def skip_patient(self, counter_id, queue_id):
+        with self._lock:
+            counter = self._counter(counter_id)
+            ticket = self._serving(counter, queue_id)
+            if ticket is None:
+                return counter, None, None
+            now = timezone.now()
+            counter.serving.remove(ticket)
+            self._close(counter, [ticket], 'skipped', now)
+            next_ticket = self._promote_next(counter, now)
+            self._push_counter(counter)
+            eventlog.log_skip(counter, ticket, next_ticket)
+        return counter, ticket, next_ticket
+
+    def start_serving(self, counter_id):
+        with self._lock:
+            counter = self._counter(counter_id)
+            if counter.serving:
+                return counter, counter.serving[0], None
+            next_ticket = None
+            if counter.waiting:
+                next_ticket = counter.waiting.popleft()
+                self._start(counter, next_ticket, timezone.now())
+                self._push_counter(counter)
+                eventlog.log_start(counter, next_ticket)
+        return counter, None, next_ticket
+
+    def announce_patient(self, counter_id, queue_id):
+        with self._lock:
+            counter = self._counter(counter_id)
+            ticket = self._serving(counter, queue_id)
+            if ticket is None:
+                return counter, None, False, None
+
+            now = timezone.now()
+            ticket.announcement_count += 1
+            if ticket.announcement_count < MAX_ANNOUNCEMENTS:
+                self.writer.changed(ticket)
+                patient_updates.push_entries(counter, [ticket])
+                eventlog.log_announce(counter, ticket, False, None)
+                return counter, ticket, False, None
+
+            counter.serving.remove(ticket)
+            self._close(counter, [ticket], 'skipped', now)
+            next_ticket = self._promote_next(counter, now)
+            self._push_counter(counter)
+            eventlog.log_announce(counter, ticket, True, next_ticket)
+        return counter, ticket, True, next_ticket
+
+    def redistribute_waiting(self, counter_id):
+        with self._lock:
+            counter = self._counter(counter_id)
+            targets = {
+                target.counter_id: target for target in self.counters.values()
+                if target.service_id == counter.service_id and target.counter_id != counter_id and target.is_open
+            }
+            if not counter.waiting or not targets:
+                return []
+
+            shortest = [(len(target.waiting), target_id) for target_id, target in targets.items()]
+            heapq.heapify(shortest)
+            moves = []
+            while counter.waiting:
+                ticket = counter.waiting.popleft()
+                waiting, target_id = heapq.heappop(shortest)
+                target = targets[target_id]
+                target.last_ticket += 1
+                ticket.counter = target
+                ticket.ticket_number = target.last_ticket
+                target.waiting.append(ticket)
+                moves.append((ticket, target))
+                self.writer.changed(ticket)
+                self.writer.counter_changed(target)
+                heapq.heappush(shortest, (waiting + 1, target_id))
+            self.writer.counter_changed(counter)
+            patient_updates.push_moves(moves)
+            eventlog.log_moves(moves)
+        return moves
+
+    def set_counter_status(self, counter_id, status):
+        with self._lock:
+            counter = self._counter(counter_id)
+            self._set_status(counter, status, timezone.now())
+            eventlog.log_status(counter, status)
+        return counter
+
+    def join(self, patient, service, queue_id):
+        """
+        Queue a Patient for a Service under queue_id at the counter the
+        assignment policy picks. Returns the new Ticket, or None if no
+        counter of the service is open; raises AlreadyQueued if the patient
+        is already waiting or being served.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if patient.phone_number in self.by_patient:
+                raise AlreadyQueued(patient.phone_number)
+            candidates = sorted(
+                (counter for counter in self.counters.values()
+                 if counter.service_id == service.service_id and counter.is_open),
+                key=lambda counter: counter.counter_id
+            )
+            counter = self._assign(service, candidates)
+            if counter is None:
+                return None
+
+            now = timezone.now()
+            counter.last_ticket += 1
+            ticket = Ticket(
+                queue_id, PatientRef(patient.phone_number, patient.name), service.service_id, counter,
+                'waiting', counter.last_ticket, created_at=now
+            )
+            counter.waiting.append(ticket)
+            self.tickets[queue_id] = ticket
+            self.by_patient[patient.phone_number] = ticket
+            self._set_status(counter, 'busy', now)
+            self.writer.created(ticket)
+            self.writer.counter_changed(counter)
+            patient_updates.push_entries(counter, [ticket])
+            eventlog.log_join(ticket)
+        return ticket
+
+    def _assign(self, service, candidates):
+        if not candidates:
+            return None
+        policy = getattr(settings, 'QUEUE_ASSIGNMENT_POLICY', 'least_waiting')
+        if policy == 'least_waiting':
+            return min(candidates, key=lambda counter: len(counter.waiting))
+        if policy == 'least_estimated_time':
+            minutes = get_service_minutes((counter.counter_id, counter.service_id) for counter in candidates)
+            return min(candidates, key=lambda counter: (len(counter.waiting) + 1) * minutes[counter.counter_id])
+        if policy == 'round_robin':
+            cursor = self.cursors.get(service.service_id, service.assignment_cursor)
+            counter = next((counter for counter in candidates if counter.counter_id > cursor), candidates[0])
+            self.cursors[service.service_id] = counter.counter_id
+            self.writer.cursor_moved(service.service_id, counter.counter_id)
+            return counter
+        raise ValueError(f"Unknown queue assignment policy: {policy}")
+
+    # Lookups
+
+    def live_ticket(self, phone_number):
+        with self._lock:
+            self._ensure_loaded()
+            return self.by_patient.get(phone_number)
+
+    def patient_status(self, phone_number):
+        """patient_updates.patient_status, from memory"""
+        return patient_updates.entry_status(self.live_ticket(phone_number))
+
+    async def apatient_status(self, phone_number):
+        if not self.loaded:
+            await sync_to_async(self.load)()
+        return await patient_updates.aentry_status(self.by_patient.get(phone_number))
+
+    def after_write(self, callback):
+        self.writer.after_write(callback)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'counters': len(self.counters),
+                'tickets': len(self.tickets),
+                **self.writer.stats(),
+            }
+
+
+engine = QueueEngine()
+atexit.register(engine.close)
+
+
+def live_engine():
+    """The engine when QUEUE_ENGINE is 'memory', else None"""
+    return engine if getattr(settings, 'QUEUE_ENGINE', 'database') == 'memory' else None
+
+
+def queue_transitions():
+    """What the views run transitions through: the engine, or transitions.py on the database"""
+    return live_engine() or transitions
+
+
+def after_write(func, *args, **kwargs):
+    """
+    Call func once the queue changes made so far are in the database: after
+    the engine's next flush, or right away without the engine.
+    """
+    current = live_engine()
+    if current is None:
+        return func(*args, **kwargs)
+    current.after_write(lambda: func(*args, **kwargs))
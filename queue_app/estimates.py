@@ -0,0 +1,137 @@
+# queue_app/estimates.py
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import QueueHistory
+
+# Minutes per patient used until a counter has some history
+DEFAULT_SERVICE_MINUTES = 5
+
+# Weight of the newest sample in the moving average
+ALPHA = 0.2
+
+# A gap longer than this between two patients is idle time, not service time
+IDLE_GAP_SECONDS = 30 * 60
+
+# How much history a rebuild replays
+REBUILD_WINDOW = timedelta(hours=24)
+
+COUNTER_KEY = 'service_time:counter:{counter_id}'
+SERVICE_KEY = 'service_time:service:{service_id}'
+STATE_TIMEOUT = 24 * 60 * 60
+
+
+# Service-time estimator
+#
+# Each counter keeps an exponentially weighted moving average of the time
+# between consecutive patients leaving it (served or skipped), which is the
+# time it spends per patient. Every sample is also folded into its service's
+# average, used for counters without history of their own. Recording a
+# completion is O(1); reading is a cache lookup. When state is missing (new
+# process, cache eviction) it is rebuilt by replaying recent QueueHistory.
+
+def _counter_key(counter_id):
+    return COUNTER_KEY.format(counter_id=counter_id)
+
+
+def _service_key(service_id):
+    return SERVICE_KEY.format(service_id=service_id)
+
+
+def _empty_state():
+    return {'ewma': None, 'last': None, 'samples': 0}
+
+
+def _add_sample(state, seconds):
+    state['ewma'] = seconds if state['ewma'] is None else ALPHA * seconds + (1 - ALPHA) * state['ewma']
+    state['samples'] += 1
+
+
+def _fold(counter_state, service_state, completed_at):
+    """Fold one completion into the counter's and its service's averages"""
+    timestamp = completed_at.timestamp()
+    last = counter_state['last']
+    if last is not None and 0 < timestamp - last <= IDLE_GAP_SECONDS:
+        _add_sample(counter_state, timestamp - last)
+        _add_sample(service_state, timestamp - last)
+    if last is None or timestamp > last:
+        counter_state['last'] = timestamp
+
+
+def rebuild(service_ids, counter_ids=()):
+    """Replay recent history for the given services and cache the resulting states"""
+    states = {_service_key(service_id): _empty_state() for service_id in service_ids}
+    states.update({_counter_key(counter_id): _empty_state() for counter_id in counter_ids})
+
+    rows = QueueHistory.objects.filter(
+        service_id__in=list(service_ids),
+        completed_at__gte=timezone.now() - REBUILD_WINDOW
+    ).order_by('completed_at').values_list('counter_id', 'service_id', 'completed_at')
+    for counter_id, service_id, completed_at in rows:
+        counter_state = states.setdefault(_counter_key(counter_id), _empty_state())
+        _fold(counter_state, states[_service_key(service_id)], completed_at)
+
+    cache.set_many(states, STATE_TIMEOUT)
+    return states
+
+
+def record_completion(counter_id, service_id, completed_at):
+    """Update the averages for a patient leaving a counter (after the history row is committed)"""
+    counter_key, service_key = _counter_key(counter_id), _service_key(service_id)
+    states = cache.get_many([counter_key, service_key])
+    if len(states) < 2:
+        # The committed history row is part of the replay, so there is nothing left to fold
+        rebuild([service_id], [counter_id])
+        return
+
+    _fold(states[counter_key], states[service_key], completed_at)
+    cache.set_many(states, STATE_TIMEOUT)
+
+
+def _state_keys(counters):
+    return list({_counter_key(c) for c, _ in counters} | {_service_key(s) for _, s in counters})
+
+
+def _missing(counters, states):
+    return [(c, s) for c, s in counters if _counter_key(c) not in states or _service_key(s) not in states]
+
+
+def get_service_minutes(counters):
+    """
+    Average minutes per patient for each (counter_id, service_id) pair, as
+    {counter_id: minutes}. Falls back to the service average, then the default.
+    """
+    counters = list(counters)
+    states = cache.get_many(_state_keys(counters))
+    missing = _missing(counters, states)
+    if missing:
+        states.update(rebuild({s for _, s in missing}, {c for c, _ in missing}))
+    return _minutes(counters, states)
+
+
+async def aget_service_minutes(counters):
+    """get_service_minutes for async views, through the async cache API"""
+    counters = list(counters)
+    states = await cache.aget_many(_state_keys(counters))
+    missing = _missing(counters, states)
+    if missing:
+        states.update(await sync_to_async(rebuild)({s for _, s in missing}, {c for c, _ in missing}))
+    return _minutes(counters, states)
+
+
+def _minutes(counters, states):
+    minutes = {}
+    for counter_id, service_id in counters:
+        ewma = states[_counter_key(counter_id)]['ewma'] or states[_service_key(service_id)]['ewma']
+        minutes[counter_id] = round(ewma / 60, 1) if ewma else DEFAULT_SERVICE_MINUTES
+    return minutes
+
+
+def estimate_wait_minutes(position, counter_id, service_id):
+    """Estimated wait for a patient `position` places from the front of a counter's queue"""
+    if position is None:
+        return None
+    return round(position * get_service_minutes([(counter_id, service_id)])[counter_id])
@@ -0,0 +1,781 @@
+# queue_app/eventlog.py
+import atexit
+import gzip
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import analytics
+from .models import Counter, Patient, QueueEntry, QueueHistory
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl: the log can be read and replayed there, not written
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_SYNC_INTERVAL = 0.2
+DEFAULT_SNAPSHOT_EVERY = 10000
+
+JOIN, START, COMPLETE, SKIP, ANNOUNCE, MOVE, STATUS = range(1, 8)
+KIND_NAMES = {JOIN: 'join', START: 'start', COMPLETE: 'complete', SKIP: 'skip',
+              ANNOUNCE: 'announce', MOVE: 'move', STATUS: 'status'}
+
+
+# Queue event log
+#
+# With EVENT_LOG_DIR set, every queue transition is appended to a binary
+# log there as it is applied: joins, calls, completions, skips,
+# announcements, moves and counter status changes. Replaying the log
+# rebuilds the live queue and each counter's figures for a day without the
+# database (replay()). restore() then writes today's live queue back to
+# QueueEntry and Counter, which recovers the in-memory engine's last
+# unflushed changes after a crash.
+#
+# The log is a series of segment files, each preallocated to
+# EVENT_LOG_SEGMENT_BYTES and memory-mapped. A segment starts with a header
+# (first sequence number, end of the written part, next sequence number,
+# sealed flag); records follow, each a length, a CRC32 of the payload and a
+# sequence number, then the packed event. Appends from every worker process
+# are serialized by an flock on the directory's LOCK file and only move the
+# header's end past records that are fully written, so a crash mid-append
+# leaves at most a torn tail that readers stop at. Records reach the page
+# cache on append and survive a process crash; a background thread msyncs
+# them to disk every EVENT_LOG_SYNC_INTERVAL seconds, bounding what a power
+# loss can take. Every EVENT_LOG_SNAPSHOT_EVERY events the same thread
+# writes a snapshot of the replayed state, so a replay only reads the events
+# after the latest snapshot.
+
+SEGMENT_HEADER = struct.Struct('<4sB3xQQQ')    # magic, sealed, first seq, end offset, next seq
+SEGMENT_MAGIC = b'QEV1'
+RECORD_HEADER = struct.Struct('<IIQ')          # payload length, payload CRC32, seq
+EVENT = struct.Struct('<BdIIIH')               # kind, unix time, counter, service, ticket, value
+SEGMENT_NAME = '{first_seq:020d}.seg'
+SNAPSHOT_NAME = 'snapshot-{seq:020d}-{at:d}.json.gz'
+
+
+class Event:
+    __slots__ = ('kind', 'at', 'counter_id', 'service_id', 'ticket_number', 'value', 'queue_id', 'text')
+
+    def __init__(self, kind, at, counter_id=0, service_id=0, ticket_number=0, value=0, queue_id='', text=''):
+        self.kind = kind
+        self.at = at
+        self.counter_id = counter_id
+        self.service_id = service_id
+        self.ticket_number = ticket_number
+        self.value = value
+        self.queue_id = queue_id
+        self.text = text
+
+    def __repr__(self):
+        return f"<Event {KIND_NAMES.get(self.kind, self.kind)} {self.queue_id or self.text} counter={self.counter_id}>"
+
+
+def encode(event):
+    queue_id = event.queue_id.encode()
+    text = event.text.encode()
+    return b''.join((
+        EVENT.pack(event.kind, event.at, event.counter_id or 0, event.service_id or 0,
+                   event.ticket_number or 0, event.value or 0),
+        bytes((len(queue_id),)), queue_id, bytes((len(text),)), text,
+    ))
+
+
+def decode(payload):
+    kind, at, counter_id, service_id, ticket_number, value = EVENT.unpack_from(payload)
+    offset = EVENT.size
+    length = payload[offset]
+    queue_id = payload[offset + 1:offset + 1 + length].decode()
+    offset += 1 + length
+    length = payload[offset]
+    text = payload[offset + 1:offset + 1 + length].decode()
+    return Event(kind, at, counter_id, service_id, ticket_number, value, queue_id, text)
+
+
+class Segment:
+    """One memory-mapped segment file; header fields are read and written under the log's lock"""
+
+    def __init__(self, path, first_seq=None, size=None):
+        self.path = path
+        create = size is not None
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT | os.O_EXCL if create else 0), 0o644)
+        try:
+            if create:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        self.size = len(self.map)
+        if create:
+            self.sealed, self.first_seq, self.end, self.next_seq = False, first_seq, SEGMENT_HEADER.size, first_seq
+            self.commit()
+        else:
+            self.load()
+
+    def load(self):
+        magic, sealed, self.first_seq, self.end, self.next_seq = SEGMENT_HEADER.unpack_from(self.map)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f"{self.path} is not an event log segment")
+        self.sealed = bool(sealed)
+
+    def commit(self):
+        SEGMENT_HEADER.pack_into(self.map, 0, SEGMENT_MAGIC, self.sealed, self.first_seq, self.end, self.next_seq)
+
+    def fits(self, payload):
+        return self.end + RECORD_HEADER.size + len(payload) <= self.size
+
+    def write(self, payload):
+        """Write one record after the end; the header moves on commit()"""
+        seq = self.next_seq
+        RECORD_HEADER.pack_into(self.map, self.end, len(payload), zlib.crc32(payload), seq)
+        start = self.end + RECORD_HEADER.size
+        self.map[start:start + len(payload)] = payload
+        self.end = start + len(payload)
+        self.next_seq = seq + 1
+        return seq
+
+    def close(self):
+        self.map.close()
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def segment_paths(directory):
+    """Segment files in sequence order"""
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith('.seg'))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in names]
+
+
+class EventLog:
+    """Appends events to the segments in `directory`; safe across threads and processes"""
+
+    def __init__(self, directory, segment_bytes=None, sync_interval=None, snapshot_every=None):
+        self.directory = directory
+        self.segment_bytes = max(segment_bytes or DEFAULT_SEGMENT_BYTES, 4096)
+        self.sync_interval = DEFAULT_SYNC_INTERVAL if sync_interval is None else sync_interval
+        self.snapshot_every = DEFAULT_SNAPSHOT_EVERY if snapshot_every is None else snapshot_every
+        if fcntl is None:
+            raise ImproperlyConfigured('EVENT_LOG_DIR needs a POSIX system; leave it empty here')
+        os.makedirs(os.path.join(directory, 'snapshots'), exist_ok=True)
+        self._lock = threading.Lock()
+        self._lock_file = open(os.path.join(directory, 'LOCK'), 'a+b')
+        self._segment = None
+        # Segments written since the last msync
+        self._unsynced = set()
+        self._thread = None
+        self._stopped = False
+        self.last_seq = 0
+        latest = latest_snapshot(directory)
+        self.snapshot_seq = latest[0] if latest else 0
+        self.appended = self.syncs = self.snapshots = 0
+
+    def append(self, events):
+        """Append events in order; returns the sequence number of the last one"""
+        payloads = [encode(event) for event in events]
+        if not payloads:
+            return self.last_seq
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                segment = self._current()
+                for payload in payloads:
+                    if not segment.fits(payload):
+                        segment = self._roll(segment)
+                    seq = segment.write(payload)
+                segment.commit()
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._unsynced.add(segment)
+            self.last_seq = seq
+            self.appended += len(payloads)
+            self._ensure_thread()
+        return seq
+
+    def _current(self):
+        """The segment to append to, following rolls made by other processes"""
+        segment = self._segment
+        if segment is None:
+            paths = segment_paths(self.directory)
+            if paths:
+                segment = Segment(paths[-1])
+            else:
+                segment = Segment(self._path(1), first_seq=1, size=self.segment_bytes)
+                _fsync_directory(self.directory)
+        else:
+            segment.load()
+        while segment.sealed:
+            segment = self._leave(segment, Segment(self._path(segment.next_seq)))
+        self._segment = segment
+        return segment
+
+    def _roll(self, segment):
+        segment.sealed = True
+        segment.commit()
+        self._unsynced.add(segment)
+        new = Segment(self._path(segment.next_seq), first_seq=segment.next_seq, size=self.segment_bytes)
+        _fsync_directory(self.directory)
+        return self._leave(segment, new)
+
+    def _leave(self, old, new):
+        # The sync thread msyncs and closes the old segment
+        self._unsynced.add(old)
+        self._segment = new
+        return new
+
+    def _path(self, first_seq):
+        return os.path.join(self.directory, SEGMENT_NAME.format(first_seq=first_seq))
+
+    def sync(self):
+        """msync everything appended so far to disk"""
+        with self._lock:
+            segments, self._unsynced = self._unsynced, set()
+        for segment in segments:
+            segment.map.flush()
+        with self._lock:
+            # Only the current segment is appended to; the rest were left behind
+            for segment in segments:
+                if segment is not self._segment and segment not in self._unsynced:
+                    segment.close()
+        if segments:
+            self.syncs += 1
+
+    def snapshot_if_due(self):
+        if self.snapshot_every and self.last_seq - self.snapshot_seq >= self.snapshot_every:
+            self.snapshot_seq = take_snapshot(self.directory)[0]
+            self.snapshots += 1
+
+    def _ensure_thread(self):
+        if self.sync_interval and self._thread is None and not self._stopped:
+            self._thread = threading.Thread(target=self._run, name='queue-event-log', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+                self.snapshot_if_due()
+            except Exception:
+                logger.exception("eventlog.sync_failed directory=%s", self.directory)
+
+    def close(self):
+        self._stopped = True
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout=5)
+        self.sync()
+        with self._lock:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+            self._lock_file.close()
+
+
+def read_events(directory, after=0):
+    """Yield (seq, Event) for every intact record with a sequence number above `after`"""
+    for seq, event, _ in scan(directory, after):
+        yield seq, event
+
+
+def scan(directory, after=0, position=None):
+    """
+    Yield (seq, Event, position) like read_events, where position is the
+    (segment's first seq, offset) just past the record. Given the position
+    of the last record already applied, reading starts right there instead of
+    at the top of its segment.
+    """
+    paths = segment_paths(directory)
+    firsts = [int(os.path.basename(path)[:-len('.seg')]) for path in paths]
+    if position is not None and position[0] not in firsts:
+        position = None
+    for index, path in enumerate(paths):
+        first = firsts[index]
+        if position is not None:
+            if first < position[0]:
+                continue
+        elif index + 1 < len(paths) and firsts[index + 1] <= after + 1:
+            continue
+        with open(path, 'rb') as segment:
+            magic, _, _, end, _ = SEGMENT_HEADER.unpack(segment.read(SEGMENT_HEADER.size))
+            if magic != SEGMENT_MAGIC:
+                continue
+            start = position[1] if position is not None and first == position[0] else SEGMENT_HEADER.size
+            segment.seek(start)
+            data = segment.read(max(end - start, 0))
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, crc, seq = RECORD_HEADER.unpack_from(data, offset)
+            payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                logger.warning("eventlog.torn_record path=%s offset=%s", path, start + offset)
+                break
+            offset += RECORD_HEADER.size + length
+            if seq > after:
+                yield seq, decode(payload), (first, start + offset)
+
+
+# Replay
+#
+# QueueState applies events in order. It holds every live ticket (counter,
+# ticket number, status, join and call times) and, for the local day of the
+# latest event, each counter's joins, completions, skips, announcements and
+# total wait and service time. Snapshots are that state as gzip'd JSON,
+# named by the last sequence number they include and its time.
+
+def _day_bounds(at):
+    day = timezone.localdate(datetime.fromtimestamp(at, tz=timezone.get_current_timezone()))
+    start = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+    return day, start.timestamp(), (start + timedelta(days=1)).timestamp()
+
+
+def _empty_stats():
+    return {'joined': 0, 'completed': 0, 'skipped': 0, 'announced': 0,
+            'waits': 0, 'wait_seconds': 0.0, 'services': 0, 'service_seconds': 0.0}
+
+
+class QueueState:
+    def __init__(self):
+        self.seq = 0
+        self.at = None
+        # Where in the log the last applied event ends, see scan()
+        self.position = None
+        self.day = None
+        self._day_end = None
+        # queue_id -> [counter_id, service_id, patient, status, ticket_number, joined_at, started_at, announcements]
+        self.tickets = {}
+        # queue_id -> [counter_id, 'completed' or 'skipped', closed_at] for the day
+        self.closed = {}
+        self.counter_status = {}
+        self.stats = {}
+
+    def _counter_stats(self, counter_id):
+        stats = self.stats.get(counter_id)
+        if stats is None:
+            stats = self.stats[counter_id] = _empty_stats()
+        return stats
+
+    def apply(self, seq, event):
+        at = event.at
+        if self._day_end is None or at >= self._day_end:
+            day, _, self._day_end = _day_bounds(at)
+            if day != self.day:
+                self.day, self.stats, self.closed = day, {}, {}
+        self.seq, self.at = seq, at
+        kind, counter_id = event.kind, event.counter_id
+
+        if kind == JOIN:
+            self.tickets[event.queue_id] = [
+                counter_id, event.service_id, event.text, 'waiting', event.ticket_number, at, None, 0
+            ]
+            self._counter_stats(counter_id)['joined'] += 1
+        elif kind == START:
+            ticket = self.tickets.get(event.queue_id)
+            if ticket is None:
+                # Joined before the log was switched on
+                ticket = self.tickets[event.queue_id] = [
+                    counter_id, event.service_id, '', 'waiting', event.ticket_number, None, None, 0
+                ]
+            ticket[0], ticket[3], ticket[6] = counter_id, 'serving', at
+            self.counter_status[counter_id] = 'busy'
+            if ticket[5] is not None:
+                stats = self._counter_stats(counter_id)
+                stats['waits'] += 1
+                stats['wait_seconds'] += at - ticket[5]
+        elif kind in (COMPLETE, SKIP):
+            ticket = self.tickets.pop(event.queue_id, None)
+            self.closed[event.queue_id] = [counter_id, 'skipped' if kind == SKIP else 'completed', at]
+            # As in transitions.py; a START that follows makes it busy again
+            self.counter_status[counter_id] = 'available'
+            stats = self._counter_stats(counter_id)
+            if kind == SKIP:
+                stats['skipped'] += 1
+            else:
+                stats['completed'] += 1
+                if ticket is not None and ticket[6] is not None:
+                    stats['services'] += 1
+                    stats['service_seconds'] += at - ticket[6]
+        elif kind == ANNOUNCE:
+            ticket = self.tickets.get(event.queue_id)
+            if ticket is not None:
+                ticket[7] = event.value
+            self._counter_stats(counter_id)['announced'] += 1
+        elif kind == MOVE:
+            ticket = self.tickets.get(event.queue_id)
+            if ticket is not None:
+                ticket[0], ticket[4] = counter_id, event.ticket_number
+        elif kind == STATUS:
+            self.counter_status[counter_id] = event.text
+
+    def live_queue(self):
+        """counter_id -> {'serving': [queue_id], 'waiting': [queue_id in ticket order]}"""
+        queues = {}
+        for queue_id, (counter_id, _, _, status, number, _, _, _) in self.tickets.items():
+            queue = queues.setdefault(counter_id, {'serving': [], 'waiting': []})
+            queue[status].append((number, queue_id))
+        return {
+            counter_id: {status: [queue_id for _, queue_id in sorted(entries)] for status, entries in queue.items()}
+            for counter_id, queue in queues.items()
+        }
+
+    def counter_stats(self):
+        """counter_id -> the day's figures, with average wait and service minutes"""
+        return {
+            counter_id: {
+                **stats,
+                'avg_wait_minutes': round(stats['wait_seconds'] / stats['waits'] / 60, 1) if stats['waits'] else None,
+                'avg_service_minutes': (
+                    round(stats['service_seconds'] / stats['services'] / 60, 1) if stats['services'] else None
+                ),
+            }
+            for counter_id, stats in self.stats.items()
+        }
+
+    def to_dict(self):
+        return {
+            'seq': self.seq, 'at': self.at, 'position': self.position,
+            'day': self.day.isoformat() if self.day else None,
+            'tickets': self.tickets, 'closed': self.closed,
+            'counter_status': self.counter_status, 'stats': self.stats,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls()
+        state.seq, state.at = data['seq'], data['at']
+        state.position = tuple(data['position']) if data.get('position') else None
+        if data['day']:
+            state.day = datetime.fromisoformat(data['day']).date()
+            state._day_end = _day_bounds(state.at)[2]
+        # JSON keys are strings
+        state.tickets = data['tickets']
+        state.closed = data.get('closed', {})
+        state.counter_status = {int(key): value for key, value in data['counter_status'].items()}
+        state.stats = {int(key): value for key, value in data['stats'].items()}
+        return state
+
+
+def snapshot_paths(directory):
+    """(seq, at, path) of every snapshot, oldest first"""
+    folder = os.path.join(directory, 'snapshots')
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return []
+    snapshots = []
+    for name in names:
+        if name.startswith('snapshot-') and name.endswith('.json.gz'):
+            seq, at = name[len('snapshot-'):-len('.json.gz')].split('-')
+            snapshots.append((int(seq), int(at), os.path.join(folder, name)))
+    return sorted(snapshots)
+
+
+def latest_snapshot(directory, before=None):
+    """(seq, at, path) of the newest snapshot, or of the newest taken before the unix time `before`"""
+    candidates = [snapshot for snapshot in snapshot_paths(directory) if before is None or snapshot[1] < before]
+    return candidates[-1] if candidates else None
+
+
+def load_snapshot(path):
+    with gzip.open(path, 'rt') as snapshot:
+        return QueueState.from_dict(json.load(snapshot))
+
+
+def write_snapshot(directory, state):
+    """Write the state as a snapshot; built next to its final name and moved into place"""
+    folder = os.path.join(directory, 'snapshots')
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, SNAPSHOT_NAME.format(seq=state.seq, at=int(state.at or 0)))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as out:
+                out.write(json.dumps(state.to_dict()).encode())
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def take_snapshot(directory):
+    """Replay from the latest snapshot to the end of the log and snapshot that; returns (seq, path)"""
+    latest = latest_snapshot(directory)
+    state = load_snapshot(latest[2]) if latest else QueueState()
+    for seq, event, position in scan(directory, state.seq, state.position):
+        state.apply(seq, event)
+        state.position = position
+    if latest and state.seq == latest[0]:
+        return latest[0], latest[2]
+    return state.seq, write_snapshot(directory, state)
+
+
+def replay(directory, day=None):
+    """
+    Rebuild the state at the end of `day` (default: today, i.e. now) from the
+    newest snapshot taken before then and the events after it. Returns
+    (state, snapshot path or None, events replayed).
+    """
+    day = day or timezone.localdate()
+    end = timezone.make_aware(datetime.combine(day + timedelta(days=1), datetime.min.time())).timestamp()
+    latest = latest_snapshot(directory, before=end)
+    state = load_snapshot(latest[2]) if latest else QueueState()
+    replayed = 0
+    for seq, event, position in scan(directory, state.seq, state.position):
+        if event.at >= end:
+            break
+        state.apply(seq, event)
+        state.position = position
+        replayed += 1
+    if state.day != day:
+        # Nothing happened that day: carry the queue over with empty figures
+        state.day, state.stats, state.closed = day, {}, {}
+    return state, latest[2] if latest else None, replayed
+
+
+# Restoring the database
+#
+# restore() makes QueueEntry and Counter match a replayed state of today:
+# entries the log saw close move to QueueHistory, live tickets get the log's
+# counter, status, ticket number and start time (and are recreated if their
+# row was lost), and the counters the log mentions get its status and a
+# recount of their waiting and serving figures. Entries that predate the log
+# are left alone. Run it with the workers stopped, since an in-memory engine
+# would write its own copy of the queue back over it.
+
+def _aware(at):
+    return datetime.fromtimestamp(at, tz=timezone.get_current_timezone()) if at is not None else None
+
+
+def restore(state):
+    """Write `state`'s live queue back to the database; returns counts of what changed"""
+    now = timezone.now()
+    counts = {'closed': 0, 'updated': 0, 'created': 0, 'missing': 0, 'counters': 0}
+    with transaction.atomic():
+        counter_ids = (
+            {ticket[0] for ticket in state.tickets.values()}
+            | {closed[0] for closed in state.closed.values()}
+            | set(state.counter_status)
+        )
+        counters = Counter.objects.in_bulk(counter_ids)
+        entries = QueueEntry.objects.in_bulk(list(state.tickets) + list(state.closed))
+
+        # Closures the database missed
+        closing = []
+        for queue_id, (counter_id, status, at) in state.closed.items():
+            entry = entries.get(queue_id)
+            if entry is not None and entry.current_status in ('waiting', 'serving'):
+                closing.append((entry, counter_id if counter_id in counters else entry.counter_id, status, _aware(at)))
+        QueueHistory.objects.bulk_create([
+            QueueHistory(
+                queue_id=entry.queue_id,
+                patient_id=entry.patient_id,
+                service_id=entry.service_id,
+                counter_id=counter_id,
+                current_status=status,
+                skipped_at=closed_at if status == 'skipped' else None,
+                created_at=entry.created_at,
+                updated_at=closed_at,
+                date=timezone.localdate(closed_at),
+                started_at=entry.started_at,
+                completed_at=closed_at
+            )
+            for entry, counter_id, status, closed_at in closing
+        ])
+        QueueEntry.objects.filter(pk__in=[entry.pk for entry, _, _, _ in closing]).delete()
+        closures = [
+            (entry.service_id, counter_id, status, entry.created_at, entry.started_at, closed_at)
+            for entry, counter_id, status, closed_at in closing
+        ]
+        transaction.on_commit(lambda: analytics.record_closures(closures))
+        counts['closed'] = len(closing)
+
+        # Live tickets: fix the rows that drifted, recreate the ones that were lost
+        patients = set(Patient.objects.filter(
+            pk__in=[ticket[2] for queue_id, ticket in state.tickets.items() if queue_id not in entries]
+        ).values_list('pk', flat=True))
+        changed, created = [], []
+        for queue_id, (counter_id, _, patient_id, status, number, joined_at, started_at, announcements) \
+                in state.tickets.items():
+            counter = counters.get(counter_id)
+            entry = entries.get(queue_id)
+            if counter is None or (entry is None and patient_id not in patients):
+                counts['missing'] += 1
+                continue
+            lost = entry is None
+            if lost:
+                entry = QueueEntry(queue_id=queue_id, patient_id=patient_id, service_id=counter.service_id)
+                entry.created_at = _aware(joined_at) or now
+                created.append(entry)
+            fields = (
+                counter_id,
+                status,
+                number,
+                None if status == 'waiting' else entry.started_at or _aware(started_at),
+                max(entry.announcement_count, announcements),
+            )
+            if fields != (entry.counter_id, entry.current_status, entry.ticket_number,
+                          entry.started_at, entry.announcement_count):
+                (entry.counter_id, entry.current_status, entry.ticket_number,
+                 entry.started_at, entry.announcement_count) = fields
+                entry.updated_at = now
+                if not lost:
+                    changed.append(entry)
+        QueueEntry.objects.bulk_create(created)
+        # bulk_create stamps created_at with now; put the join time back
+        QueueEntry.objects.bulk_update(created, ['created_at'])
+        QueueEntry.objects.bulk_update(
+            changed, ['counter', 'current_status', 'ticket_number', 'started_at', 'announcement_count', 'updated_at']
+        )
+        counts['updated'], counts['created'] = len(changed), len(created)
+
+        # Counters: the log's status and the recounted ticket figures
+        waiting, serving, last = {}, {}, {}
+        for counter_id, status, number in QueueEntry.objects.filter(
+            counter_id__in=counters, current_status__in=('waiting', 'serving')
+        ).values_list('counter_id', 'current_status', 'ticket_number'):
+            if status == 'waiting':
+                waiting[counter_id] = waiting.get(counter_id, 0) + 1
+            else:
+                serving[counter_id] = number
+            last[counter_id] = max(last.get(counter_id, 0), number)
+        for counter_id, counter in counters.items():
+            Counter.objects.filter(pk=counter_id).update(
+                current_status=state.counter_status.get(counter_id, counter.current_status),
+                waiting_count=waiting.get(counter_id, 0),
+                serving_ticket=serving.get(counter_id, counter.serving_ticket),
+                last_ticket=Greatest('last_ticket', last.get(counter_id, 0)),
+                status_updated_at=now,
+                updated_at=now
+            )
+        counts['counters'] = len(counters)
+    return counts
+
+
+# Writing from the transitions
+#
+# Each helper turns a transition's result into its events and appends them.
+# transitions.py calls them inside the transaction, with the counter row
+# still locked, and the engine under its lock, so the events of one counter
+# are in the log in the order the transitions were applied (and stamped in
+# that order). A failing append is logged instead of failing the transition.
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def get_log():
+    """This process's EventLog for EVENT_LOG_DIR, or None if the log is off"""
+    global _log
+    directory = getattr(settings, 'EVENT_LOG_DIR', '')
+    if not directory:
+        return None
+    current = _log
+    if current is None or current.directory != directory:
+        with _log_lock:
+            if _log is None or _log.directory != directory:
+                if _log is not None:
+                    _log.close()
+                _log = EventLog(
+                    directory,
+                    segment_bytes=getattr(settings, 'EVENT_LOG_SEGMENT_BYTES', None),
+                    sync_interval=getattr(settings, 'EVENT_LOG_SYNC_INTERVAL', None),
+                    snapshot_every=getattr(settings, 'EVENT_LOG_SNAPSHOT_EVERY', None),
+                )
+            current = _log
+    return current
+
+
+def _close_log():
+    if _log is not None:
+        _log.close()
+
+
+atexit.register(_close_log)
+
+
+def record(events):
+    log = get_log()
+    if log is None or not events:
+        return
+    try:
+        log.append(events)
+    except Exception:
+        logger.exception("eventlog.append_failed events=%s", len(events))
+
+
+def _start(counter, entry, at):
+    return [Event(START, at, counter.counter_id, counter.service_id, entry.ticket_number, queue_id=entry.queue_id)] \
+        if entry else []
+
+
+def _close(counter, entries, kind, at):
+    return [Event(kind, at, counter.counter_id, counter.service_id, queue_id=entry.queue_id) for entry in entries]
+
+
+def log_join(entry):
+    counter = entry.counter
+    record([Event(JOIN, time.time(), counter.counter_id, entry.service_id, entry.ticket_number,
+                  queue_id=entry.queue_id, text=entry.patient_id)])
+
+
+def log_serve(counter, completed, next_entry):
+    at = time.time()
+    record(_close(counter, completed, COMPLETE, at) + _start(counter, next_entry, at))
+
+
+def log_skip(counter, skipped, next_entry):
+    at = time.time()
+    record(_close(counter, [skipped], SKIP, at) + _start(counter, next_entry, at))
+
+
+def log_start(counter, next_entry):
+    record(_start(counter, next_entry, time.time()))
+
+
+def log_announce(counter, entry, skipped, next_entry):
+    at = time.time()
+    events = [Event(ANNOUNCE, at, counter.counter_id, counter.service_id,
+                    value=entry.announcement_count, queue_id=entry.queue_id)]
+    if skipped:
+        events += _close(counter, [entry], SKIP, at) + _start(counter, next_entry, at)
+    record(events)
+
+
+def log_moves(moves):
+    at = time.time()
+    record([
+        Event(MOVE, at, counter.counter_id, counter.service_id, entry.ticket_number, queue_id=entry.queue_id)
+        for entry, counter in moves
+    ])
+
+
+def log_status(counter, status):
+    record([Event(STATUS, time.time(), counter.counter_id, counter.service_id, text=status)])
@@ -0,0 +1,160 @@
+# queue_app/history.py
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from itertools import chain
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Counter, QueueDaySummary, QueueHistory
+
+ARCHIVE_NAME = 'queue_history-{date}.jsonl.gz'
+
+ARCHIVE_FIELDS = [
+    'id', 'queue_id', 'patient_id', 'service_id', 'counter_id', 'current_status',
+    'skipped_at', 'created_at', 'updated_at', 'date', 'started_at', 'completed_at',
+]
+
+
+# History layout
+#
+# QueueHistory is treated as partitioned by its `date` column: every row is
+# written with the local day it closed on, and maintenance works one whole
+# day at a time through the (date, counter) index. Each day is rolled up into
+# one QueueDaySummary row per counter; once a day is older than the retention
+# period its raw rows are written to a gzip'd JSONL file in the archive
+# directory and deleted, so the live table holds only recent days while the
+# summaries cover all of them.
+
+def retention_cutoff(days=None, today=None):
+    """The first day whose raw rows are kept; older days get archived"""
+    if days is None:
+        days = getattr(settings, 'QUEUE_HISTORY_RETENTION_DAYS', 90)
+    return (today or timezone.localdate()) - timedelta(days=days)
+
+
+def history_days(before=None):
+    """Days that still have raw history rows, oldest first"""
+    rows = QueueHistory.objects.all()
+    if before is not None:
+        rows = rows.filter(date__lt=before)
+    return list(rows.order_by('date').values_list('date', flat=True).distinct())
+
+
+def archive_path(day, directory=None):
+    directory = directory or settings.QUEUE_HISTORY_ARCHIVE_DIR
+    return os.path.join(directory, ARCHIVE_NAME.format(date=day.isoformat()))
+
+
+def _archived_rows(path):
+    for row in read_archive(path):
+        yield (row['counter_id'], row['service_id'], row['current_status'],
+               parse_datetime(row['created_at']), row['completed_at'] and parse_datetime(row['completed_at']))
+
+
+def rollup_day(day, directory=None):
+    """
+    Rebuild the QueueDaySummary rows for `day` from its raw history, plus
+    its archive file if part of the day was archived already (rows can close
+    late), and return them. A day with no raw rows left keeps its summaries.
+    """
+    totals = {}
+    rows = QueueHistory.objects.filter(date=day).values_list(
+        'counter_id', 'service_id', 'current_status', 'created_at', 'completed_at'
+    )
+    if not rows.exists():
+        return []
+    rows = rows.iterator(chunk_size=2000)
+    path = archive_path(day, directory)
+    if os.path.exists(path):
+        rows = chain(_archived_rows(path), rows)
+    for counter_id, service_id, status, created_at, completed_at in rows:
+        summary = totals.get(counter_id)
+        if summary is None:
+            summary = totals[counter_id] = QueueDaySummary(date=day, counter_id=counter_id, service_id=service_id)
+        if status == 'skipped':
+            summary.skipped_count += 1
+        else:
+            wait = (completed_at - created_at).total_seconds() if completed_at else 0
+            summary.completed_count += 1
+            summary.total_wait_seconds += wait
+            summary.max_wait_seconds = max(summary.max_wait_seconds, wait)
+        if completed_at:
+            if summary.first_completed_at is None or completed_at < summary.first_completed_at:
+                summary.first_completed_at = completed_at
+            if summary.last_completed_at is None or completed_at > summary.last_completed_at:
+                summary.last_completed_at = completed_at
+
+    # Archived rows can name counters deleted since
+    live = set(Counter.objects.filter(pk__in=totals).values_list('pk', flat=True))
+    with transaction.atomic():
+        QueueDaySummary.objects.filter(date=day).delete()
+        return QueueDaySummary.objects.bulk_create(
+            [summary for counter_id, summary in totals.items() if counter_id in live]
+        )
+
+
+def _write_archive(rows, path):
+    """
+    Write rows as gzip'd JSON lines to `path`. The file is built next to it
+    and moved into place, so a crash never leaves a half-written archive; an
+    existing archive gets the new rows appended as another gzip member.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    count = 0
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as out:
+            for row in rows:
+                out.write(json.dumps(row, cls=DjangoJSONEncoder).encode() + b'\n')
+                count += 1
+        if os.path.exists(path):
+            with open(tmp_path, 'rb') as member, open(path, 'ab') as archive:
+                shutil.copyfileobj(member, archive)
+                archive.flush()
+                os.fsync(archive.fileno())
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
+
+def archive_day(day, directory):
+    """Move `day`'s raw rows into its archive file; returns (path, rows archived)"""
+    path = archive_path(day, directory)
+    rows = QueueHistory.objects.filter(date=day)
+    # Only today's date is ever written, so a past day's rows are fixed by now
+    with transaction.atomic():
+        if not rows.exists():
+            return path, 0
+        count = _write_archive(rows.order_by('id').values(*ARCHIVE_FIELDS).iterator(chunk_size=2000), path)
+        rows.delete()
+    return path, count
+
+
+def read_archive(path):
+    """Yield the rows of an archive file as dicts (datetimes stay ISO strings)"""
+    with gzip.open(path, 'rt') as archive:
+        for line in archive:
+            yield json.loads(line)
+
+
+def archive_before(cutoff, directory):
+    """Roll up and archive every day before `cutoff`; returns {day: rows archived}"""
+    archived = {}
+    for day in history_days(before=cutoff):
+        rollup_day(day, directory)
+        _, archived[day] = archive_day(day, directory)
+    return archived
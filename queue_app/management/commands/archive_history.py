@@ -0,0 +1,28 @@
+# queue_app/management/commands/archive_history.py
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from queue_app import history
+
+
+class Command(BaseCommand):
+    help = 'Roll up, archive to gzip JSONL and delete QueueHistory rows older than the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int, help='Default: QUEUE_HISTORY_RETENTION_DAYS')
+        parser.add_argument('--archive-dir', help='Default: QUEUE_HISTORY_ARCHIVE_DIR')
+        parser.add_argument('--dry-run', action='store_true', help='Only list the days that would be archived')
+
+    def handle(self, *args, **options):
+        cutoff = history.retention_cutoff(options['retention_days'])
+        directory = options['archive_dir'] or settings.QUEUE_HISTORY_ARCHIVE_DIR
+
+        if options['dry_run']:
+            for day in history.history_days(before=cutoff):
+                self.stdout.write(f"{day}: would archive")
+            return
+
+        archived = history.archive_before(cutoff, directory)
+        for day, rows in archived.items():
+            self.stdout.write(f"{day}: archived {rows} row(s)")
+        self.stdout.write(f"Archived {sum(archived.values())} row(s) from {len(archived)} day(s) before {cutoff} to {directory}")
@@ -0,0 +1,215 @@
+# queue_app/management/commands/bench_async_views.py
+import asyncio
+import statistics
+import threading
+import time
+import types
+from datetime import time as clock
+from importlib import import_module
+from unittest import mock
+
+from asgiref.sync import SyncToAsync, async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management.base import BaseCommand
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from django.urls import path
+
+from queue_app import middleware, views
+from queue_app.models import Counter, Patient, QueueEntry, Service, Staff
+
+from .loadtest import Client, Stats, throwaway_database
+
+HOT_VIEWS = [
+    ('staff/get_queue_data/', views.get_queue_data, 'get_queue_data'),
+    ('patient/get_queue_status/', views.get_queue_status, 'get_queue_status'),
+    ('display/screen/data/', views.display_screen_data, 'display_screen_data'),
+]
+
+
+# "sync" is the stack as it was: the hot views and the queue_app middlewares
+# sync-only. Django then runs each request through sync_to_async and it holds
+# its sync thread from the first middleware to the last. The views themselves
+# are the async ones run to completion inside that thread, which is what a
+# sync view costs. "async" is the stack as configured.
+
+class SyncMetricsMiddleware(middleware.MetricsMiddleware):
+    async_capable = False
+
+
+class SyncSessionTabIsolationMiddleware(middleware.SessionTabIsolationMiddleware):
+    async_capable = False
+
+
+class SyncStaffSessionMiddleware(middleware.StaffSessionMiddleware):
+    async_capable = False
+
+
+def sync_view(view):
+    def run(request, *args, **kwargs):
+        return async_to_sync(view)(request, *args, **kwargs)
+    return run
+
+
+def sync_stack():
+    """MIDDLEWARE and a urlconf for the sync-only stack"""
+    replaced = {
+        f'queue_app.middleware.{cls.__name__[4:]}': f'{__name__}.{cls.__name__}'
+        for cls in (SyncMetricsMiddleware, SyncSessionTabIsolationMiddleware, SyncStaffSessionMiddleware)
+    }
+    urlconf = types.ModuleType('bench_sync_urls')
+    urlconf.urlpatterns = [
+        path(route, sync_view(view), name=name) for route, view, name in HOT_VIEWS
+    ] + import_module(settings.ROOT_URLCONF).urlpatterns
+    return [replaced.get(name, name) for name in settings.MIDDLEWARE], urlconf
+
+
+class ThreadMeter:
+    """How busy asgiref's sync threads are: peak threads running sync code at once, and thread-seconds"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.busy = self.peak = 0
+        self.seconds = 0.0
+
+    def __enter__(self):
+        original = SyncToAsync.thread_handler
+        meter = self
+
+        def thread_handler(self, *args, **kwargs):
+            # Nested hops into a thread that is already busy (sync_to_async under async_to_sync) count once
+            depth = getattr(meter.local, 'depth', 0)
+            meter.local.depth = depth + 1
+            if depth:
+                try:
+                    return original(self, *args, **kwargs)
+                finally:
+                    meter.local.depth = depth
+            with meter.lock:
+                meter.busy += 1
+                meter.peak = max(meter.peak, meter.busy)
+            started = time.perf_counter()
+            try:
+                return original(self, *args, **kwargs)
+            finally:
+                meter.local.depth = depth
+                with meter.lock:
+                    meter.busy -= 1
+                    meter.seconds += time.perf_counter() - started
+
+        self.patch = mock.patch.object(SyncToAsync, 'thread_handler', thread_handler)
+        self.patch.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.patch.stop()
+
+
+def make_fixture(counters, waiting):
+    """Staff and patient sessions over a busy service; returns (staff, patient) session keys"""
+    engine = import_module(settings.SESSION_ENGINE)
+    service = Service.objects.create(service_name='Bench', description='bench', week_days=1)
+    staff_sessions, patient_sessions = [], []
+    for c in range(counters):
+        member = Staff.objects.create(username=f'bench-{c}', password='pbkdf2_sha256$bench', role='operator')
+        counter = Counter.objects.create(
+            counter_name=f'Bench {c}', service=service, staff=member, current_status='busy',
+            start_time=clock(0, 0), end_time=clock(23, 59)
+        )
+        session = engine.SessionStore()
+        session.update({'staff_id': member.staff_id, 'session_unique': f'bench-{c}'})
+        session.save()
+        staff_sessions.append(session.session_key)
+        for i in range(waiting + 1):
+            phone = f'7{c:04d}{i:05d}'
+            patient = Patient.objects.create(phone_number=phone, name=f'Patient {phone}')
+            QueueEntry.objects.create(
+                queue_id=f'Q_{phone}', patient=patient, service=service, counter=counter,
+                current_status='serving' if i == 0 else 'waiting', ticket_number=i
+            )
+            session = engine.SessionStore()
+            session['patient_phone'] = phone
+            session.save()
+            patient_sessions.append(session.session_key)
+    return staff_sessions, patient_sessions
+
+
+class Command(BaseCommand):
+    help = ('Compare concurrent-request throughput and sync-thread use of the polled JSON endpoints '
+            'with sync-only views and middlewares against the async ones, on one worker')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 50, 200])
+        parser.add_argument('--duration', type=float, default=3.0, help='Seconds per run')
+        parser.add_argument('--counters', type=int, default=10)
+        parser.add_argument('--waiting', type=int, default=10, help='Patients waiting per counter')
+        parser.add_argument('--db-latency', type=float, default=1.0,
+                            help='Milliseconds added to every query, standing in for a database server')
+
+    def handle(self, *args, **options):
+        latency = options['db_latency'] / 1000
+
+        def slow_query(execute, sql, params, many, context):
+            time.sleep(latency)
+            return execute(sql, params, many, context)
+
+        def add_latency(sender, connection, **kwargs):
+            if slow_query not in connection.execute_wrappers:
+                connection.execute_wrappers.append(slow_query)
+
+        with throwaway_database():
+            staff_sessions, patient_sessions = make_fixture(options['counters'], options['waiting'])
+            connection_created.connect(add_latency)
+            try:
+                self.stdout.write(f"{'stack':<6} {'clients':>7} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+                                  f"{'busy threads':>12} {'thread ms/req':>13}")
+                for concurrency in options['concurrency']:
+                    for stack in ('sync', 'async'):
+                        self.run(stack, concurrency, options['duration'], staff_sessions, patient_sessions)
+            finally:
+                connection_created.disconnect(add_latency)
+
+    def run(self, stack, concurrency, duration, staff_sessions, patient_sessions):
+        overrides = {}
+        if stack == 'sync':
+            overrides['MIDDLEWARE'], overrides['ROOT_URLCONF'] = sync_stack()
+        with override_settings(**overrides):
+            cache.clear()
+            application = ASGIHandler()
+            stats = Stats()
+            with ThreadMeter() as meter:
+                started = time.perf_counter()
+                asyncio.run(self.clients(application, stats, concurrency, duration, staff_sessions, patient_sessions))
+                elapsed = time.perf_counter() - started
+
+        latencies = [seconds for endpoint in stats.latencies.values() for seconds in endpoint]
+        q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        errors = sum(stats.errors.values())
+        self.stdout.write(
+            f"{stack:<6} {concurrency:>7} {len(latencies) / elapsed:>8.0f} {q[49] * 1000:>8.1f} "
+            f"{q[98] * 1000:>8.1f} {meter.peak:>12} {meter.seconds / len(latencies) * 1000:>13.2f}"
+            + (f"  ({errors} errors)" if errors else '')
+        )
+
+    async def clients(self, application, stats, concurrency, duration, staff_sessions, patient_sessions):
+        deadline = time.monotonic() + duration
+
+        async def client(i):
+            # A mix like the real traffic: mostly patients, then staff dashboards and display screens
+            kind = ('patient', 'patient', 'staff', 'display')[i % 4]
+            browser = Client(application, stats, f'10.1.{i // 256 % 256}.{i % 256}')
+            if kind == 'staff':
+                browser.cookies[settings.SESSION_COOKIE_NAME] = staff_sessions[i % len(staff_sessions)]
+                url = '/staff/get_queue_data/'
+            elif kind == 'patient':
+                browser.cookies[settings.SESSION_COOKIE_NAME] = patient_sessions[i % len(patient_sessions)]
+                url = '/patient/get_queue_status/'
+            else:
+                url = '/display/screen/data/'
+            while time.monotonic() < deadline:
+                await browser.request('GET', url)
+
+        await asyncio.gather(*(client(i) for i in range(concurrency)))
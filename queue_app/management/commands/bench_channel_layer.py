@@ -0,0 +1,91 @@
+# queue_app/management/commands/bench_channel_layer.py
+import asyncio
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from queue_app.channel_layers import SQLiteChannelLayer
+
+GROUP = 'bench_group'
+
+
+def run_worker(path, subscribers, expected, ready, results):
+    """One ASGI worker stand-in: holds `subscribers` channels in the group and times delivery"""
+    async def main():
+        layer = SQLiteChannelLayer(path=path, capacity=expected + 1)
+        channels = [await layer.new_channel() for _ in range(subscribers)]
+        for channel in channels:
+            await layer.group_add(GROUP, channel)
+        ready.set()
+
+        latencies = []
+
+        async def drain(channel):
+            for _ in range(expected):
+                message = await layer.receive(channel)
+                latencies.append(time.time() - message['sent_at'])
+
+        await asyncio.gather(*(drain(channel) for channel in channels))
+        await layer.close()
+        results.put((latencies, time.time()))
+
+    asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = 'Benchmark group_send latency and throughput of the SQLite channel layer across worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--subscribers', type=int, default=100, help='Total sockets, spread across workers')
+        parser.add_argument('--messages', type=int, default=200)
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        subscribers = options['subscribers']
+        messages = options['messages']
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.sqlite3')
+            ready_events = []
+            results = multiprocessing.Queue()
+            processes = []
+            for i in range(workers):
+                share = subscribers // workers + (1 if i < subscribers % workers else 0)
+                ready = multiprocessing.Event()
+                process = multiprocessing.Process(target=run_worker, args=(path, share, messages, ready, results))
+                process.start()
+                ready_events.append(ready)
+                processes.append(process)
+            for ready in ready_events:
+                ready.wait()
+
+            async def send_all():
+                layer = SQLiteChannelLayer(path=path)
+                for i in range(messages):
+                    await layer.group_send(GROUP, {'type': 'bench', 'seq': i, 'sent_at': time.time()})
+
+            started = time.time()
+            asyncio.run(send_all())
+            send_elapsed = time.time() - started
+
+            latencies = []
+            finished = started
+            for _ in processes:
+                worker_latencies, worker_finished = results.get()
+                latencies.extend(worker_latencies)
+                finished = max(finished, worker_finished)
+            for process in processes:
+                process.join()
+
+        total_elapsed = finished - started
+        latencies.sort()
+        q = statistics.quantiles(latencies, n=100)
+        self.stdout.write(f"workers={workers} subscribers={subscribers} messages={messages}")
+        self.stdout.write(f"group_send: {messages / send_elapsed:.0f} sends/s ({send_elapsed * 1000 / messages:.2f} ms each)")
+        self.stdout.write(f"deliveries: {len(latencies)} in {total_elapsed:.2f}s ({len(latencies) / total_elapsed:.0f}/s)")
+        self.stdout.write(f"latency ms: p50={q[49] * 1000:.1f} p95={q[94] * 1000:.1f} p99={q[98] * 1000:.1f} max={latencies[-1] * 1000:.1f}")
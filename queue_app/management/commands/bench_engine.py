@@ -0,0 +1,137 @@
+# queue_app/management/commands/bench_engine.py
+import time
+from datetime import time as clock
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from queue_app import transitions
+from queue_app.engine import QueueEngine
+from queue_app.estimates import get_service_minutes
+from queue_app.models import Counter, Patient, QueueEntry, Service
+from queue_app.views import _join_counter
+
+
+class Rollback(Exception):
+    pass
+
+
+# One staff-and-patient cycle at a counter: a join, then the counter calls,
+# announces, skips and serves through its queue
+CYCLE = ('join', 'serve', 'announce', 'serve', 'join', 'start', 'skip', 'serve')
+
+
+def make_fixture(counters, waiting, joins):
+    """A service with `counters` counters of `waiting` patients each, and `joins` patients yet to join"""
+    service = Service.objects.create(service_name='Bench', description='bench', week_days=1)
+    created = [
+        Counter.objects.create(
+            counter_name=f'Bench {c}', service=service, current_status='busy',
+            start_time=clock(0, 0), end_time=clock(23, 59), last_ticket=waiting, waiting_count=waiting
+        )
+        for c in range(counters)
+    ]
+    patients = Patient.objects.bulk_create([
+        Patient(phone_number=f'8{i:09d}', name=f'Bench {i}') for i in range(counters * waiting + joins)
+    ])
+    QueueEntry.objects.bulk_create([
+        QueueEntry(
+            queue_id=f'BENCH_{c}_{i}', patient=patients[c * waiting + i], service=service, counter=counter,
+            current_status='waiting', ticket_number=i + 1
+        )
+        for c, counter in enumerate(created) for i in range(waiting)
+    ])
+    get_service_minutes((counter.counter_id, service.service_id) for counter in created)
+    return service, [counter.counter_id for counter in created], patients[counters * waiting:]
+
+
+def run_cycles(backend, join, service, counter_ids, patients, transitions_count, after_each=None):
+    """Drive `transitions_count` transitions round the counters"""
+    joined = iter(patients)
+    for n in range(transitions_count):
+        counter_id = counter_ids[n % len(counter_ids)]
+        step = CYCLE[n // len(counter_ids) % len(CYCLE)]
+        if step == 'join':
+            patient = next(joined)
+            join(patient, service, f'BENCHJ_{patient.phone_number}')
+        elif step == 'serve':
+            backend.serve_next(counter_id)
+        elif step == 'start':
+            backend.start_serving(counter_id)
+        else:
+            serving = backend.start_serving(counter_id)[1]
+            queue_id = serving.queue_id if serving else ''
+            method = backend.announce_patient if step == 'announce' else backend.skip_patient
+            method(counter_id, queue_id)
+        if after_each:
+            after_each(n + 1)
+
+
+class Command(BaseCommand):
+    help = ('Compare queue transitions per second through the database transitions '
+            'and through the in-memory engine with write-behind')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--transitions', type=int, default=2000)
+        parser.add_argument('--counters', type=int, default=10)
+        parser.add_argument('--waiting', type=int, default=20, help='Patients waiting per counter at the start')
+        parser.add_argument('--flush-every', type=int, default=100,
+                            help='Transitions between engine flushes, standing in for the flush interval')
+        parser.add_argument('--db-latency', type=float, nargs='+', default=[0.0, 1.0],
+                            help='Milliseconds added to every query, standing in for a database server')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'latency ms':>10} {'path':<8} {'trans/s':>9} {'µs/trans':>9} "
+                          f"{'queries/trans':>13} {'load ms':>8} {'flush ms':>9}")
+        for latency in options['db_latency']:
+            for path in ('orm', 'engine'):
+                self.run(path, latency / 1000, options)
+
+    def run(self, path, latency, options):
+        count = options['transitions']
+        queries = [0]
+
+        def counted(execute, sql, params, many, context):
+            queries[0] += 1
+            if latency:
+                time.sleep(latency)
+            return execute(sql, params, many, context)
+
+        cache.clear()
+        load = flushing = 0.0
+        try:
+            with transaction.atomic():
+                joins = count * CYCLE.count('join') // len(CYCLE) + options['counters']
+                service, counter_ids, patients = make_fixture(options['counters'], options['waiting'], joins)
+                with connection.execute_wrapper(counted):
+                    if path == 'orm':
+                        started = time.perf_counter()
+                        run_cycles(transitions, _join_counter, service, counter_ids, patients, count)
+                        elapsed = time.perf_counter() - started
+                    else:
+                        engine = QueueEngine(flush_interval=0)
+                        started = time.perf_counter()
+                        engine.load()
+                        load = time.perf_counter() - started
+                        queries[0] = 0
+                        timings = []
+
+                        def flush(n):
+                            if n % options['flush_every'] == 0 or n == count:
+                                flush_started = time.perf_counter()
+                                engine.flush()
+                                timings.append(time.perf_counter() - flush_started)
+
+                        started = time.perf_counter()
+                        run_cycles(engine, engine.join, service, counter_ids, patients, count, flush)
+                        elapsed = time.perf_counter() - started
+                        flushing = sum(timings)
+                raise Rollback
+        except Rollback:
+            pass
+
+        self.stdout.write(
+            f"{latency * 1000:>10.1f} {path:<8} {count / elapsed:>9.0f} {elapsed / count * 1e6:>9.1f} "
+            f"{queries[0] / count:>13.2f} {load * 1000:>8.1f} {flushing * 1000:>9.1f}"
+        )
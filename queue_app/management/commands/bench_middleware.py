@@ -0,0 +1,115 @@
+# queue_app/management/commands/bench_middleware.py
+import time
+from datetime import time as clock
+from importlib import import_module
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from queue_app.metrics import registry
+from queue_app.middleware import MetricsMiddleware, SessionTabIsolationMiddleware, StaffSessionMiddleware
+from queue_app.models import Counter, Service, Staff
+
+
+class Rollback(Exception):
+    pass
+
+
+PATHS = [
+    ('patient', '/dashboard/'),
+    ('display', '/display/screen/data/'),
+    ('static', '/static/css/style.css'),
+    ('staff', '/staff/get_queue_data/'),
+]
+
+
+def view(request):
+    return HttpResponse()
+
+
+def make_staff_session():
+    """A logged-in staff session as staff_login leaves it; returns (session key, tab id)"""
+    service = Service.objects.create(service_name='Bench', description='bench', week_days=1)
+    staff = Staff.objects.create(username='bench-operator', password='pbkdf2_sha256$bench', role='operator')
+    Counter.objects.create(
+        counter_name='Bench 1', service=service, staff=staff,
+        start_time=clock(9, 0), end_time=clock(17, 0)
+    )
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    tab_id = 'tab_bench'
+    session['staff_id'] = staff.staff_id
+    session['session_unique'] = 'bench-unique'
+    session['tab_id'] = tab_id
+    session[f'tab_{tab_id}_staff'] = {'staff_id': staff.staff_id, 'session_unique': 'bench-unique'}
+    session.save()
+    return session.session_key, tab_id
+
+
+def measure(handler, make_request, iterations, rounds=5):
+    """Mean µs (best of `rounds`) and queries per request through handler"""
+    handler(make_request())  # warm the principal cache
+    queries = []
+    with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+        handler(make_request())
+    best = None
+    for _ in range(rounds):
+        # Build the requests up front so only the middleware is timed
+        requests = [make_request() for _ in range(iterations)]
+        started = time.perf_counter()
+        for request in requests:
+            handler(request)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / iterations * 1e6, len(queries)
+
+
+class Command(BaseCommand):
+    help = 'Measure the per-request overhead of the queue_app middlewares (staff sessions and metrics)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        factory = RequestFactory()
+        engine = import_module(settings.SESSION_ENGINE)
+        # The view alone, against the view behind the two queue_app middlewares
+        bare = view
+        full = SessionTabIsolationMiddleware(StaffSessionMiddleware(view))
+
+        cache.clear()
+        try:
+            with transaction.atomic():
+                session_key, tab_id = make_staff_session()
+                self.stdout.write(f"{'path':<12} {'bare µs':>9} {'with µs':>9} {'overhead µs':>12} {'queries':>9}")
+                for label, path in PATHS:
+                    def make_request():
+                        # Every request carries the staff session, as a staff browser's would.
+                        # SessionMiddleware loads it lazily, so touching it costs a query.
+                        request = factory.get(path, {'tab_id': tab_id})
+                        request.session = engine.SessionStore(session_key)
+                        return request
+
+                    bare_us, bare_queries = measure(bare, make_request, iterations)
+                    full_us, full_queries = measure(full, make_request, iterations)
+                    self.stdout.write(
+                        f"{label:<12} {bare_us:>9.1f} {full_us:>9.1f} {full_us - bare_us:>12.1f} "
+                        f"{bare_queries:>4} -> {full_queries}"
+                    )
+
+                # Metrics sampling on and off, against the bare view
+                make_request = lambda: factory.get('/dashboard/')
+                bare_us, _ = measure(bare, make_request, iterations)
+                for label, rate in (('metrics off', 0.0), ('metrics on', 1.0)):
+                    metrics = MetricsMiddleware(view)
+                    metrics.sample_rate = rate
+                    with_us, _ = measure(metrics, make_request, iterations)
+                    self.stdout.write(f"{label:<12} {bare_us:>9.1f} {with_us:>9.1f} {with_us - bare_us:>12.1f}")
+                registry.reset()
+                raise Rollback
+        except Rollback:
+            pass
@@ -0,0 +1,63 @@
+# queue_app/management/commands/bench_otp_delivery.py
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from queue_app.sms import OTP_MESSAGE, DeliveryQueue, FakeGateway
+
+
+def timed_requests(handle, requests, clients):
+    """Run `requests` calls of handle(i) from `clients` concurrent threads; returns per-call seconds"""
+    def one(i):
+        started = time.perf_counter()
+        handle(i)
+        return time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        return list(pool.map(one, range(requests)))
+
+
+class Command(BaseCommand):
+    help = 'Compare sending OTPs inside the request with the background delivery queue, against the fake SMS gateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--clients', type=int, default=20, help='Concurrent send-otp requests')
+        parser.add_argument('--latency', type=float, default=0.2, help='Seconds the fake gateway takes per SMS')
+        parser.add_argument('--failure-rate', type=float, default=0.05)
+        parser.add_argument('--workers', type=int, default=8, help='Delivery queue concurrency')
+
+    def report(self, label, latencies, total, delivered, requests):
+        q = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f"{label:<8} request p50={q[49] * 1000:.1f}ms p99={q[98] * 1000:.1f}ms "
+            f"all delivered in {total:.2f}s, {delivered}/{requests} sent"
+        )
+
+    def handle(self, *args, **options):
+        requests = options['requests']
+        clients = options['clients']
+        phone = lambda i: f'9{i:09d}'
+
+        # Before: the request thread talks to the gateway once, failures are lost
+        gateway = FakeGateway(latency=options['latency'], failure_rate=options['failure_rate'], seed=1)
+
+        def inline(i):
+            try:
+                gateway.send(phone(i), OTP_MESSAGE.format(otp='123456'))
+            except Exception:
+                pass
+
+        started = time.perf_counter()
+        latencies = timed_requests(inline, requests, clients)
+        self.report('inline', latencies, time.perf_counter() - started, len(gateway.sent), requests)
+
+        # After: the request only queues; workers send and retry
+        gateway = FakeGateway(latency=options['latency'], failure_rate=options['failure_rate'], seed=1)
+        queue = DeliveryQueue(gateway, workers=options['workers'], backoff=0.05)
+        started = time.perf_counter()
+        latencies = timed_requests(lambda i: queue.submit(phone(i), OTP_MESSAGE.format(otp='123456')), requests, clients)
+        queue.join()
+        self.report('queued', latencies, time.perf_counter() - started, len(gateway.sent), requests)
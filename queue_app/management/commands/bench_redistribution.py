@@ -0,0 +1,108 @@
+# queue_app/management/commands/bench_redistribution.py
+import time
+from datetime import time as clock
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q
+from django.test.utils import override_settings
+
+from queue_app import transitions
+from queue_app.board import publish_board_change
+from queue_app.models import Counter, Patient, QueueEntry, Service
+from queue_app.notifications import notify_counter
+from queue_app.views import redistribute_patients_on_break
+
+from .loadtest import throwaway_database
+
+# The board versions the redistribution bumps go to a cache of the bench's own
+BENCH_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'bench'}}
+
+
+class Rollback(Exception):
+    pass
+
+
+def legacy_redistribute(breaking_counter):
+    """The per-patient loop redistribute_patients_on_break used to run, for comparison"""
+    redistributed_count = 0
+    for patient_entry in QueueEntry.objects.filter(counter=breaking_counter, current_status='waiting'):
+        alternative_counter = Counter.objects.filter(
+            service=breaking_counter.service,
+            current_status__in=['available', 'busy']
+        ).exclude(counter_id=breaking_counter.counter_id).annotate(
+            waiting=Count('queueentry', filter=Q(queueentry__current_status='waiting'))
+        ).order_by('waiting', 'counter_id').first()
+        if alternative_counter:
+            patient_entry.counter = alternative_counter
+            with transaction.atomic():
+                patient_entry.ticket_number = transitions.issue_ticket(alternative_counter.counter_id)
+                patient_entry.save()
+            publish_board_change('redistribute', breaking_counter.counter_id, alternative_counter.counter_id)
+            redistributed_count += 1
+            message = {
+                "action": "patient_redistributed",
+                "queue_id": patient_entry.queue_id,
+                "old_counter": breaking_counter.counter_name,
+                "new_counter": alternative_counter.counter_name,
+                "patient_name": patient_entry.patient.name,
+                "service_name": breaking_counter.service.service_name
+            }
+            notify_counter(breaking_counter.counter_id, message)
+            notify_counter(alternative_counter.counter_id, message)
+    return redistributed_count
+
+
+def make_fixture(waiting, counters):
+    """A service whose first counter has `waiting` patients queued"""
+    service = Service.objects.create(service_name='Bench', description='bench', week_days=1)
+    created = [
+        Counter.objects.create(
+            counter_name=f'Bench {i}', service=service, current_status='busy',
+            start_time=clock(9, 0), end_time=clock(17, 0)
+        )
+        for i in range(counters)
+    ]
+    patients = Patient.objects.bulk_create([
+        Patient(phone_number=f'8{i:09d}', name=f'Bench {i}') for i in range(waiting)
+    ])
+    QueueEntry.objects.bulk_create([
+        QueueEntry(
+            queue_id=f'BENCH_{i}', patient=patient, service=service, counter=created[0],
+            current_status='waiting', ticket_number=i + 1
+        )
+        for i, patient in enumerate(patients)
+    ])
+    Counter.objects.filter(pk=created[0].pk).update(last_ticket=waiting, waiting_count=waiting)
+    return Counter.objects.select_related('service').get(pk=created[0].pk)
+
+
+def timed(func, waiting, counters):
+    """Run func on a fresh fixture and roll everything back; returns seconds"""
+    try:
+        with transaction.atomic():
+            breaking_counter = make_fixture(waiting, counters)
+            started = time.perf_counter()
+            moved = func(breaking_counter)
+            elapsed = time.perf_counter() - started
+            assert moved == waiting, f"moved {moved} of {waiting}"
+            raise Rollback
+    except Rollback:
+        return elapsed
+
+
+class Command(BaseCommand):
+    help = 'Compare the per-patient and the bulk redistribution of a counter going on break'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+        parser.add_argument('--counters', type=int, default=4, help='Counters in the service, including the one going on break')
+
+    def handle(self, *args, **options):
+        counters = options['counters']
+        with throwaway_database(), override_settings(CACHES=BENCH_CACHES):
+            self.stdout.write(f"{'waiting':>8} {'per-patient ms':>15} {'bulk ms':>10} {'speedup':>8}")
+            for waiting in options['sizes']:
+                legacy = timed(legacy_redistribute, waiting, counters)
+                bulk = timed(redistribute_patients_on_break, waiting, counters)
+                self.stdout.write(f"{waiting:>8} {legacy * 1000:>15.1f} {bulk * 1000:>10.1f} {legacy / bulk:>7.1f}x")
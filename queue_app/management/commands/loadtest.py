@@ -0,0 +1,403 @@
+# queue_app/management/commands/loadtest.py
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import time as clock
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.urls import Resolver404, resolve
+
+from queue_app import sms
+from queue_app.models import Counter, Service, Staff
+
+STAFF_PASSWORD = 'loadtest-password'
+
+
+# Query accounting
+#
+# Each simulated request runs with its own counter in a context variable.
+# asgiref copies the context into the thread that runs Django's sync views,
+# so a wrapper on every database connection can charge each query to the
+# request that made it.
+
+_request_queries = contextvars.ContextVar('loadtest_request_queries', default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    queries = _request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+@contextmanager
+def throwaway_database():
+    """Run against a fresh test database, never real data (SQLite gets a file, so threads share it)"""
+    database = settings.DATABASES['default']
+    if connection.vendor == 'sqlite':
+        # Requests run on several threads. SQLite serialises writers on the database
+        # file; taking the write lock when a transaction starts (rather than failing
+        # on upgrade) and waiting for it makes it behave like a row-locking server.
+        if not database.setdefault('TEST', {}).get('NAME'):
+            database['TEST']['NAME'] = os.path.join(tempfile.mkdtemp(), 'loadtest.sqlite3')
+        database.setdefault('OPTIONS', {}).update(transaction_mode='IMMEDIATE', timeout=30)
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, queries, status):
+        self.latencies[endpoint].append(seconds)
+        self.queries[endpoint].append(queries)
+        if status >= 400:
+            self.errors[endpoint] += 1
+
+
+class Client:
+    """One simulated browser: keeps its cookies and its client address"""
+
+    def __init__(self, application, stats, ip):
+        self.application = application
+        self.stats = stats
+        self.ip = ip
+        self.cookies = {}
+        self.etags = {}
+
+    def headers(self):
+        headers = [(b'host', b'testserver')]
+        if self.cookies:
+            headers.append((b'cookie', '; '.join(f'{k}={v}' for k, v in self.cookies.items()).encode()))
+        return headers
+
+    async def request(self, method, path, data=None, conditional=False):
+        body = urlencode(data or {}).encode()
+        path, _, query = path.partition('?')
+        headers = self.headers()
+        if method == 'POST':
+            headers += [(b'content-type', b'application/x-www-form-urlencoded'),
+                        (b'content-length', str(len(body)).encode())]
+        if conditional and path in self.etags:
+            headers.append((b'if-none-match', self.etags[path]))
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+            'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+            'headers': headers, 'client': (self.ip, 40000), 'server': ('testserver', 80),
+        }
+
+        # The application task is created in this context, so it (and the sync
+        # threads it hands views to) charges queries to this request
+        queries = [0]
+        token = _request_queries.set(queries)
+        inbox, outbox = asyncio.Queue(), asyncio.Queue()
+        started = time.perf_counter()
+        task = asyncio.ensure_future(self.application(scope, inbox.get, outbox.put))
+        _request_queries.reset(token)
+        await inbox.put({'type': 'http.request', 'body': body})
+        start = await outbox.get()
+        content = b''
+        while True:
+            message = await outbox.get()
+            content += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        elapsed = time.perf_counter() - started
+        await inbox.put({'type': 'http.disconnect'})
+        await task
+
+        response_headers = {}
+        for name, value in start['headers']:
+            name = name.decode().lower()
+            if name == 'set-cookie':
+                for morsel in SimpleCookie(value.decode()).values():
+                    self.cookies[morsel.key] = morsel.value
+            response_headers[name] = value
+        if 'etag' in response_headers:
+            self.etags[path] = response_headers['etag']
+
+        try:
+            endpoint = resolve(path).url_name
+        except Resolver404:
+            endpoint = path
+        self.stats.record(endpoint, elapsed, queries[0], start['status'])
+        return start['status'], content
+
+    async def json(self, method, path, data=None, conditional=False):
+        status, content = await self.request(method, path, data, conditional)
+        if status == 304 or not content:
+            return status, None
+        try:
+            return status, json.loads(content)
+        except ValueError:
+            return status, None
+
+
+class RecordingGateway(sms.FakeGateway):
+    """The fake gateway, keeping the last OTP texted to each phone so patients can read it"""
+
+    OTP_PATTERN = re.compile(r'is: (\d+)')
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.otps = {}
+
+    def send(self, phone_number, body):
+        message_id = super().send(phone_number, body)
+        self.otps[phone_number] = self.OTP_PATTERN.search(body).group(1)
+        return message_id
+
+
+# The simulated day
+#
+# Patients arrive as a Poisson process, log in with the OTP their (fake) SMS
+# brings, join a random service and wait on their patient WebSocket (or poll)
+# until they are served or skipped. Each counter's staff member polls their queue, calls patients,
+# sometimes announces them first, takes an exponentially distributed service
+# time and serves or skips. Display screens poll the board with ETags or hold
+# a WebSocket open. Everything runs in this process against the real ASGI
+# application, so latencies include the event loop the clients share with it.
+
+class Simulation:
+    def __init__(self, application, options, gateway):
+        self.application = application
+        self.options = options
+        self.gateway = gateway
+        self.random = random.Random(options['seed'])
+        self.stats = Stats()
+        self.outcomes = defaultdict(int)
+        self.display_frames = 0
+        self.patient_frames = 0
+        self.done = asyncio.Event()
+
+    async def frames(self, communicator):
+        """A socket's frames until the day is over"""
+        # receive_from() kills the socket when its timeout runs out, so wait on the day ending instead
+        done = asyncio.ensure_future(self.done.wait())
+        try:
+            while True:
+                receive = asyncio.ensure_future(communicator.receive_from(timeout=self.options['duration']))
+                await asyncio.wait({receive, done}, return_when=asyncio.FIRST_COMPLETED)
+                if not receive.done():
+                    receive.cancel()
+                    return
+                yield receive.result()
+        finally:
+            done.cancel()
+
+    async def patient(self, i, service_ids):
+        options = self.options
+        client = Client(self.application, self.stats, f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}')
+        phone = f'8{i:09d}'
+        status, _ = await client.request('POST', '/api/send-otp/', {'phone_number': phone, 'name': f'Patient {i}'})
+        if status != 200:
+            self.outcomes['otp_refused'] += 1
+            return
+        deadline = time.monotonic() + 30
+        while phone not in self.gateway.otps:
+            if time.monotonic() > deadline:
+                self.outcomes['otp_lost'] += 1
+                return
+            await asyncio.sleep(0.01)
+        await client.request('POST', '/api/verify-otp/', {'phone_number': phone, 'otp': self.gateway.otps[phone]})
+
+        status, data = await client.json('POST', '/queue/join/', {'service_id': self.random.choice(service_ids)})
+        if status != 200:
+            self.outcomes['join_failed'] += 1
+            return
+        if options['patient_mode'] == 'ws':
+            communicator = WebsocketCommunicator(self.application, '/ws/patient/updates/', headers=client.headers())
+            await communicator.connect()
+            try:
+                async for frame in self.frames(communicator):
+                    self.patient_frames += 1
+                    data = json.loads(frame)
+                    if data['queue_status'] in ('completed', 'skipped', 'none'):
+                        self.outcomes['left_queue'] += 1
+                        return
+            finally:
+                await communicator.disconnect()
+            self.outcomes['still_waiting'] += 1
+            return
+        while not self.done.is_set():
+            await asyncio.sleep(options['poll_interval'])
+            _, data = await client.json('GET', '/patient/get_queue_status/')
+            if data and data['queue_status'] == 'none':
+                self.outcomes['left_queue'] += 1
+                return
+        self.outcomes['still_waiting'] += 1
+
+    async def staff_login(self, username, tab_id):
+        client = Client(self.application, self.stats, '10.255.0.1')
+        await client.request('POST', f'/staff/login/?tab_id={tab_id}', {'username': username, 'password': STAFF_PASSWORD})
+        return client
+
+    async def staff(self, client, tab_id):
+        options = self.options
+        suffix = f'?tab_id={tab_id}'
+        data = None
+        while not self.done.is_set():
+            # A 304 means the queue is as it was at the last full answer
+            status, fresh = await client.json('GET', f'/staff/get_queue_data/{suffix}', conditional=True)
+            if status != 304:
+                data = fresh
+            if not data or data.get('status') != 'success':
+                await asyncio.sleep(options['poll_interval'])
+                continue
+            serving = data['serving_patient']
+            if serving:
+                if self.random.random() < options['announce_rate']:
+                    await client.request('POST', f'/staff/announce_patient/{suffix}', {'queue_id': serving['queue_id']})
+                await asyncio.sleep(self.random.expovariate(1 / options['service_time']))
+                if self.random.random() < options['skip_rate']:
+                    await client.request('POST', f'/staff/skip_patient/{suffix}', {'queue_id': serving['queue_id']})
+                else:
+                    await client.request('POST', f'/staff/serve_next/{suffix}')
+            elif data['queue_count']:
+                await client.request('POST', f'/staff/start_serving/{suffix}')
+            else:
+                await asyncio.sleep(options['poll_interval'])
+
+    async def display(self, i):
+        if self.options['display_mode'] == 'ws':
+            communicator = WebsocketCommunicator(self.application, '/ws/display/updates/')
+            await communicator.connect()
+            try:
+                async for _ in self.frames(communicator):
+                    self.display_frames += 1
+            finally:
+                await communicator.disconnect()
+            return
+        client = Client(self.application, self.stats, f'10.254.0.{i % 256}')
+        while not self.done.is_set():
+            await client.request('GET', '/display/screen/data/', conditional=True)
+            await asyncio.sleep(self.options['poll_interval'])
+
+    async def run(self, service_ids, staff):
+        options = self.options
+        # Staff log in before the doors open
+        tabs = [f'tab_loadtest_{n}' for n in range(len(staff))]
+        clients = await asyncio.gather(*(self.staff_login(username, tab) for username, tab in zip(staff, tabs)))
+        background = [asyncio.ensure_future(self.staff(client, tab)) for client, tab in zip(clients, tabs)]
+        background += [asyncio.ensure_future(self.display(i)) for i in range(options['displays'])]
+
+        patients = []
+        for i in range(options['patients']):
+            patients.append(asyncio.ensure_future(self.patient(i, service_ids)))
+            await asyncio.sleep(self.random.expovariate(options['arrival_rate']))
+        try:
+            await asyncio.wait_for(asyncio.gather(*patients), options['duration'])
+        except asyncio.TimeoutError:
+            pass
+        self.done.set()
+        await asyncio.gather(*patients, *background, return_exceptions=True)
+
+
+class Command(BaseCommand):
+    help = ('Simulate a hospital day against the ASGI application in a throwaway database and report '
+            'p50/p95/p99 latency and queries per request for each endpoint')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=200)
+        parser.add_argument('--arrival-rate', type=float, default=4.0, help='Patients arriving per second')
+        parser.add_argument('--services', type=int, default=2)
+        parser.add_argument('--counters', type=int, default=4, help='Counters per service')
+        parser.add_argument('--displays', type=int, default=4)
+        parser.add_argument('--patient-mode', choices=['poll', 'ws'], default='ws')
+        parser.add_argument('--display-mode', choices=['poll', 'ws'], default='poll')
+        parser.add_argument('--service-time', type=float, default=1.0, help='Mean seconds a counter spends per patient')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between status polls')
+        parser.add_argument('--skip-rate', type=float, default=0.05)
+        parser.add_argument('--announce-rate', type=float, default=0.3)
+        parser.add_argument('--sms-latency', type=float, default=0.05)
+        parser.add_argument('--duration', type=float, default=600, help='Stop after this many seconds')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        with throwaway_database():
+            self.run_simulation(options)
+
+    def make_fixture(self, options):
+        service_ids, staff = [], []
+        for s in range(options['services']):
+            service = Service.objects.create(service_name=f'Service {s}', description='loadtest', week_days=1)
+            service_ids.append(service.service_id)
+            for c in range(options['counters']):
+                member = Staff.objects.create(username=f'staff-{s}-{c}', password=STAFF_PASSWORD, role='operator')
+                Counter.objects.create(
+                    counter_name=f'Counter {s}-{c}', service=service, staff=member,
+                    start_time=clock(0, 0), end_time=clock(23, 59)
+                )
+                staff.append(member.username)
+        return service_ids, staff
+
+    def run_simulation(self, options):
+        from queue_system.asgi import application
+
+        cache.clear()
+        service_ids, staff = self.make_fixture(options)
+        gateway = RecordingGateway(latency=options['sms_latency'])
+        previous_queue, sms._queue = sms._queue, sms.DeliveryQueue(gateway, workers=8, backoff=0.05)
+        connection_created.connect(install_query_counter)
+        simulation = Simulation(application, options, gateway)
+        started = time.perf_counter()
+        try:
+            # Per-request info logs (logins, SMS sends) would drown the report
+            app_logger = logging.getLogger('queue_app')
+            level = app_logger.level
+            app_logger.setLevel(max(level, logging.WARNING))
+            try:
+                asyncio.run(simulation.run(service_ids, staff))
+            finally:
+                app_logger.setLevel(level)
+        finally:
+            connection_created.disconnect(install_query_counter)
+            sms._queue = previous_queue
+        self.report(simulation, time.perf_counter() - started)
+
+    def report(self, simulation, elapsed):
+        stats = simulation.stats
+        total = sum(len(latencies) for latencies in stats.latencies.values())
+        self.stdout.write(f"{total} requests in {elapsed:.1f}s ({total / elapsed:.0f}/s); "
+                          f"patients: {dict(simulation.outcomes)}")
+        if simulation.display_frames:
+            self.stdout.write(f"display WebSocket frames received: {simulation.display_frames}")
+        if simulation.patient_frames:
+            self.stdout.write(f"patient WebSocket frames received: {simulation.patient_frames}")
+        self.stdout.write(f"{'endpoint':<24} {'count':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} "
+                          f"{'p99 ms':>8} {'queries':>8} {'max q':>6}")
+        for endpoint in sorted(stats.latencies):
+            latencies = stats.latencies[endpoint]
+            q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [latencies[0]] * 99
+            queries = stats.queries[endpoint]
+            self.stdout.write(
+                f"{endpoint:<24} {len(latencies):>6} {stats.errors[endpoint]:>6} {q[49] * 1000:>8.1f} "
+                f"{q[94] * 1000:>8.1f} {q[98] * 1000:>8.1f} {statistics.mean(queries):>8.1f} {max(queries):>6}"
+            )
@@ -0,0 +1,12 @@
+# queue_app/management/commands/purge_otps.py
+from django.core.management.base import BaseCommand
+
+from queue_app import otp_store
+
+
+class Command(BaseCommand):
+    help = 'Delete used and expired OTPs (run periodically, e.g. from cron every few minutes)'
+
+    def handle(self, *args, **options):
+        deleted = otp_store.purge()
+        self.stdout.write(f"Deleted {deleted} OTP(s)")
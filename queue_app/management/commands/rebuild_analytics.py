@@ -0,0 +1,31 @@
+# queue_app/management/commands/rebuild_analytics.py
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from queue_app import analytics
+
+
+class Command(BaseCommand):
+    help = ('Recompute the hourly and daily analytics buckets from QueueHistory and its archive '
+            '(after a backfill or an import)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='Rebuild this many local days, today included')
+        parser.add_argument('--gaps', action='store_true',
+                            help='Rebuild from the earliest day whose closures failed to record, if any')
+        parser.add_argument('--archive-dir', help='Default: QUEUE_HISTORY_ARCHIVE_DIR')
+
+    def handle(self, *args, **options):
+        if options['gaps']:
+            day = analytics.first_gap()
+            if day is None:
+                self.stdout.write("No analytics gaps")
+                return
+            since = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+        else:
+            since = timezone.now() - timedelta(days=options['days'] - 1)
+        replayed = analytics.rebuild(since, options['archive_dir'] or settings.QUEUE_HISTORY_ARCHIVE_DIR)
+        self.stdout.write(f"Rebuilt analytics from {replayed} history row(s)")
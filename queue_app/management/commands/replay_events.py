@@ -0,0 +1,71 @@
+# queue_app/management/commands/replay_events.py
+import json
+import time
+from datetime import date
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from queue_app import eventlog
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the live queue and per-counter figures for a day from the queue event log'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--day', type=date.fromisoformat, help='YYYY-MM-DD; default: today, up to now')
+        parser.add_argument('--log-dir', help='Default: EVENT_LOG_DIR')
+        parser.add_argument('--json', action='store_true', help='Print the rebuilt state as JSON')
+        parser.add_argument('--snapshot', action='store_true',
+                            help='Snapshot the end of the log first, so later replays start from here')
+        parser.add_argument('--apply', action='store_true',
+                            help="Write today's rebuilt queue back to the database (stop the workers first)")
+
+    def handle(self, *args, **options):
+        directory = options['log_dir'] or settings.EVENT_LOG_DIR
+        if not directory:
+            raise CommandError('No event log: set EVENT_LOG_DIR or pass --log-dir')
+        if options['apply'] and options['day'] not in (None, timezone.localdate()):
+            raise CommandError('--apply restores the live queue, so it only works for today')
+
+        if options['snapshot']:
+            seq, path = eventlog.take_snapshot(directory)
+            self.stderr.write(f"Snapshot at seq {seq}: {path}")
+
+        started = time.perf_counter()
+        state, snapshot, replayed = eventlog.replay(directory, options['day'])
+        elapsed = time.perf_counter() - started
+
+        queues = state.live_queue()
+        stats = state.counter_stats()
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'day': state.day.isoformat(),
+                'seq': state.seq,
+                'queues': queues,
+                'counter_status': state.counter_status,
+                'stats': stats,
+            }, indent=2))
+        else:
+            self.stdout.write(f"{'counter':>7} {'status':<9} {'serving':<18} {'waiting':>7} {'joined':>6} "
+                              f"{'done':>5} {'skipped':>7} {'wait min':>8} {'service min':>11}")
+            for counter_id in sorted(set(queues) | set(stats) | set(state.counter_status)):
+                queue = queues.get(counter_id, {})
+                figures = stats.get(counter_id, {})
+                self.stdout.write(
+                    f"{counter_id:>7} {state.counter_status.get(counter_id, '-'):<9} "
+                    f"{', '.join(queue.get('serving', [])) or '-':<18} {len(queue.get('waiting', [])):>7} "
+                    f"{figures.get('joined', 0):>6} {figures.get('completed', 0):>5} {figures.get('skipped', 0):>7} "
+                    f"{figures.get('avg_wait_minutes') or '-':>8} {figures.get('avg_service_minutes') or '-':>11}"
+                )
+        self.stderr.write(
+            f"Replayed {replayed} event(s) up to seq {state.seq} in {elapsed:.2f}s "
+            f"from {snapshot or 'the start of the log'}"
+        )
+        if options['apply']:
+            counts = eventlog.restore(state)
+            self.stderr.write(
+                "Restored: {closed} closed, {updated} updated, {created} recreated, {missing} skipped "
+                "(counter or patient gone), {counters} counter(s) recounted".format(**counts)
+            )
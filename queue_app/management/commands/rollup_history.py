@@ -0,0 +1,22 @@
+# queue_app/management/commands/rollup_history.py
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from queue_app import history
+
+
+class Command(BaseCommand):
+    help = 'Roll QueueHistory up into per-day, per-counter summaries (run nightly, e.g. from cron after midnight)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=date.fromisoformat, help='Day to roll up (default: yesterday)')
+        parser.add_argument('--days', type=int, default=1, help='Roll up this many days ending at --date')
+
+    def handle(self, *args, **options):
+        last = options['date'] or timezone.localdate() - timedelta(days=1)
+        for offset in range(options['days'] - 1, -1, -1):
+            day = last - timedelta(days=offset)
+            summaries = history.rollup_day(day)
+            self.stdout.write(f"{day}: {len(summaries)} counter summary row(s)")
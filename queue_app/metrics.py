@@ -0,0 +1,185 @@
+# queue_app/metrics.py
+import bisect
+import contextvars
+import re
+import threading
+import time
+
+# Upper bounds of the histogram buckets (Prometheus `le` labels)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# counter_12 -> counter, so WebSocket metrics have one series per kind of group
+GROUP_KIND = re.compile(r'_\d+$')
+
+
+# Metrics registry
+#
+# Process-local counters and histograms, rendered in the Prometheus text
+# format at /metrics. MetricsMiddleware records each sampled request: its
+# view, status, latency, and the number and total time of its database
+# queries. The outbox and the consumers count WebSocket group sends, the
+# frames they fan out to, and open sockets. With several worker processes
+# each one is scraped separately (or summed by the collector).
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_sum{{{labels}}} {self.sum:.6f}'
+        yield f'{name}_count{{{labels}}} {cumulative}'
+
+
+class _ViewMetrics:
+    __slots__ = ('statuses', 'latency', 'queries', 'db_seconds')
+
+    def __init__(self):
+        self.statuses = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.db_seconds = 0.0
+
+
+def group_kind(group):
+    return GROUP_KIND.sub('', group)
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.views = {}
+            self.ws_sent = {}
+            self.ws_delivered = {}
+            self.ws_connections = {}
+
+    def observe_request(self, view, status, seconds, queries, db_seconds):
+        with self._lock:
+            metrics = self.views.get(view)
+            if metrics is None:
+                metrics = self.views[view] = _ViewMetrics()
+            status_class = f'{status // 100}xx'
+            metrics.statuses[status_class] = metrics.statuses.get(status_class, 0) + 1
+            metrics.latency.observe(seconds)
+            metrics.queries.observe(queries)
+            metrics.db_seconds += db_seconds
+
+    def _add(self, table, group, amount):
+        kind = group_kind(group)
+        with self._lock:
+            table[kind] = table.get(kind, 0) + amount
+
+    def ws_group_send(self, group):
+        self._add(self.ws_sent, group, 1)
+
+    def ws_delivered_to(self, group):
+        self._add(self.ws_delivered, group, 1)
+
+    def ws_connected(self, group, change=1):
+        self._add(self.ws_connections, group, change)
+
+    def render(self, extra=()):
+        """The registry in the Prometheus text exposition format"""
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            views = sorted(self.views.items())
+            family('queue_http_requests_total', 'counter', 'Sampled requests by view and status class')
+            for view, metrics in views:
+                for status, count in sorted(metrics.statuses.items()):
+                    lines.append(f'queue_http_requests_total{{view="{view}",status="{status}"}} {count}')
+            family('queue_http_request_duration_seconds', 'histogram', 'Request latency by view')
+            for view, metrics in views:
+                lines.extend(metrics.latency.samples('queue_http_request_duration_seconds', f'view="{view}"'))
+            family('queue_db_queries_per_request', 'histogram', 'Database queries per request by view')
+            for view, metrics in views:
+                lines.extend(metrics.queries.samples('queue_db_queries_per_request', f'view="{view}"'))
+            family('queue_db_query_seconds_total', 'counter', 'Time spent in database queries by view')
+            for view, metrics in views:
+                lines.append(f'queue_db_query_seconds_total{{view="{view}"}} {metrics.db_seconds:.6f}')
+
+            for name, kind, help_text, table in (
+                ('queue_ws_group_sends_total', 'counter', 'Messages sent to WebSocket groups', self.ws_sent),
+                ('queue_ws_frames_delivered_total', 'counter',
+                 'Group messages delivered to sockets in this process (fan-out)', self.ws_delivered),
+                ('queue_ws_connections', 'gauge', 'Open WebSocket subscriptions in this process', self.ws_connections),
+            ):
+                family(name, kind, help_text)
+                for group, value in sorted(table.items()):
+                    lines.append(f'{name}{{group="{group}"}} {value}')
+
+        for name, kind, help_text, value in extra:
+            family(name, kind, help_text)
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class QueryTimer:
+    """Counts and times the queries charged to it (an execute_wrapper, or activate() it)"""
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - started
+
+
+# Async views run their queries in asgiref's sync thread, on that thread's
+# connection, so a wrapper added to the request thread's connection would
+# miss them. Instead every connection carries charge_query(), which charges
+# the QueryTimer active in the calling context; sync_to_async copies the
+# context into the thread, so queries land on the request that made them.
+
+_active_timer = contextvars.ContextVar('metrics_query_timer', default=None)
+
+
+def charge_query(execute, sql, params, many, context):
+    timer = _active_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    return timer(execute, sql, params, many, context)
+
+
+def install_query_timer(sender=None, connection=None, **kwargs):
+    """connection_created receiver adding charge_query to each database connection"""
+    if charge_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(charge_query)
+
+
+def activate(timer):
+    """Charge this context's queries to `timer`; returns a token for deactivate()"""
+    return _active_timer.set(timer)
+
+
+def deactivate(token):
+    _active_timer.reset(token)
@@ -0,0 +1,171 @@
+# queue_app/middleware.py
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .metrics import QueryTimer, activate, deactivate, registry
+from .models import Staff
+from .principals import aget_request_principal, get_request_principal
+
+
+# Only staff pages carry a staff session. Everything else (patient pages, the
+# display board, static files) passes straight through both middlewares
+# without touching request.session, so they add no queries there.
+
+def staff_path_prefixes():
+    return tuple(getattr(settings, 'STAFF_PATH_PREFIXES', ('/staff/',)))
+
+
+class _SyncAndAsyncMiddleware:
+    """
+    Runs in whichever mode the rest of the stack runs in. Under ASGI a
+    sync-only middleware is run through sync_to_async and holds the one
+    sync thread for the whole request, async views included.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.handle(request)
+
+
+class SessionTabIsolationMiddleware(_SyncAndAsyncMiddleware):
+    """
+    Resolves the browser tab a staff request comes from. staff_login stores
+    the tab's login under session['tab_<tab_id>_staff'] and the dashboard
+    sends ?tab_id= with every request. Sets request.tab_id and
+    request.tab_session (that entry, or None), and request.tab_conflict when
+    the tab's login is no longer the session's: a later login in another tab
+    replaced the shared session cookie.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.prefixes = staff_path_prefixes()
+
+    def tab_id(self, request):
+        request.tab_id = None
+        request.tab_session = None
+        request.tab_conflict = False
+        if request.path_info.startswith(self.prefixes):
+            return request.GET.get('tab_id')
+        return None
+
+    def resolve(self, request, tab_id, tab_session, staff_id, session_unique):
+        request.tab_id = tab_id
+        request.tab_session = tab_session
+        request.tab_conflict = staff_id is not None and (
+            tab_session is None or tab_session.get('session_unique') != session_unique
+        )
+
+    def handle(self, request):
+        tab_id = self.tab_id(request)
+        if tab_id:
+            session = request.session
+            self.resolve(
+                request, tab_id, session.get(f"tab_{tab_id}_staff"),
+                session.get('staff_id'), session.get('session_unique')
+            )
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        tab_id = self.tab_id(request)
+        if tab_id:
+            session = request.session
+            self.resolve(
+                request, tab_id, await session.aget(f"tab_{tab_id}_staff"),
+                await session.aget('staff_id'), await session.aget('session_unique')
+            )
+        return await self.get_response(request)
+
+
+class StaffSessionMiddleware(_SyncAndAsyncMiddleware):
+    """
+    Attaches the session's staff member and counter to staff requests as
+    request.staff / request.counter (None when there is no valid staff
+    session). The lookup is shared with validate_staff_session, so it runs
+    once per request, usually from the cache.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.prefixes = staff_path_prefixes()
+
+    def applies(self, request):
+        request.staff = None
+        request.counter = None
+        return request.path_info.startswith(self.prefixes) and not getattr(request, 'tab_conflict', False)
+
+    def handle(self, request):
+        if self.applies(request) and 'staff_id' in request.session:
+            try:
+                request.staff, request.counter = get_request_principal(request)
+            except Staff.DoesNotExist:
+                pass
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        if self.applies(request) and await request.session.ahas_key('staff_id'):
+            try:
+                request.staff, request.counter = await aget_request_principal(request)
+            except Staff.DoesNotExist:
+                pass
+        return await self.get_response(request)
+
+
+class MetricsMiddleware(_SyncAndAsyncMiddleware):
+    """
+    Records each request's view, status, latency and database queries in
+    metrics.registry, for a METRICS_SAMPLE_RATE fraction of requests. At
+    0 requests pass straight through.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.sample_rate = getattr(settings, 'METRICS_SAMPLE_RATE', 1.0)
+
+    def sampled(self):
+        return self.sample_rate > 0 and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+
+    def observe(self, request, response, timer, started):
+        elapsed = time.perf_counter() - started
+        match = request.resolver_match
+        # Unrouted paths (static files, 404s) share one series so labels stay bounded
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        registry.observe_request(view, response.status_code, elapsed, timer.count, timer.seconds)
+
+    def handle(self, request):
+        if not self.sampled():
+            return self.get_response(request)
+        timer = QueryTimer()
+        started = time.perf_counter()
+        token = activate(timer)
+        try:
+            response = self.get_response(request)
+        finally:
+            deactivate(token)
+        self.observe(request, response, timer, started)
+        return response
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+        timer = QueryTimer()
+        started = time.perf_counter()
+        token = activate(timer)
+        try:
+            response = await self.get_response(request)
+        finally:
+            deactivate(token)
+        self.observe(request, response, timer, started)
+        return response
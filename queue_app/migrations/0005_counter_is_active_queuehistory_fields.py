@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2025-08-20 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queue_app', '0004_alter_queueentry_queue_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='counter',
+            name='is_active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterField(
+            model_name='queuehistory',
+            name='current_status',
+            field=models.CharField(choices=[('served', 'Served'), ('completed', 'Completed'), ('skipped', 'Skipped')], max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='queuehistory',
+            name='queue_id',
+            field=models.CharField(max_length=50),
+        ),
+    ]
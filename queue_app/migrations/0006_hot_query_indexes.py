@@ -0,0 +1,37 @@
+# Generated by Django 5.2.5 on 2025-08-21 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queue_app', '0005_counter_is_active_queuehistory_fields'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='otp',
+            index=models.Index(fields=['phone_number', 'is_used', 'expires_at'], name='otp_phone_used_expires_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='queueentry',
+            index=models.Index(fields=['counter', 'current_status', 'created_at'], name='queueentry_counter_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='queueentry',
+            index=models.Index(fields=['patient', 'current_status'], name='queueentry_patient_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='queueentry',
+            index=models.Index(fields=['current_status', 'created_at'], name='queueentry_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='queuehistory',
+            index=models.Index(fields=['completed_at'], name='queuehistory_completed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='queuehistory',
+            index=models.Index(fields=['date', 'counter'], name='queuehistory_date_counter_idx'),
+        ),
+    ]
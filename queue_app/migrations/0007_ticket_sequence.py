@@ -0,0 +1,59 @@
+# Generated by Django 5.2.5 on 2025-08-22 10:05
+
+from django.db import migrations, models
+
+
+def number_live_entries(apps, schema_editor):
+    """Give entries already in the queue tickets in arrival order, serving patient first"""
+    Counter = apps.get_model('queue_app', 'Counter')
+    QueueEntry = apps.get_model('queue_app', 'QueueEntry')
+    status_order = {'serving': 0, 'waiting': 1}
+
+    for counter in Counter.objects.all():
+        entries = sorted(
+            QueueEntry.objects.filter(counter=counter, current_status__in=['serving', 'waiting']),
+            key=lambda entry: (status_order[entry.current_status], entry.created_at)
+        )
+        serving_ticket = 0
+        for ticket, entry in enumerate(entries, start=1):
+            entry.ticket_number = ticket
+            if entry.current_status == 'serving':
+                serving_ticket = ticket
+        QueueEntry.objects.bulk_update(entries, ['ticket_number'])
+        counter.last_ticket = len(entries)
+        counter.serving_ticket = serving_ticket
+        counter.save(update_fields=['last_ticket', 'serving_ticket'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queue_app', '0006_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='queueentry',
+            name='queueentry_counter_status_idx',
+        ),
+        migrations.AddField(
+            model_name='counter',
+            name='last_ticket',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='counter',
+            name='serving_ticket',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='queueentry',
+            name='ticket_number',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='queueentry',
+            index=models.Index(fields=['counter', 'current_status', 'ticket_number'], name='queueentry_counter_ticket_idx'),
+        ),
+        migrations.RunPython(number_live_entries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.5 on 2025-08-23 09:40
+
+from django.db import migrations, models
+
+
+def count_waiting_entries(apps, schema_editor):
+    """Seed each counter's waiting_count from the entries already in its queue"""
+    Counter = apps.get_model('queue_app', 'Counter')
+    QueueEntry = apps.get_model('queue_app', 'QueueEntry')
+
+    counts = dict(
+        QueueEntry.objects.filter(current_status='waiting')
+        .values('counter').annotate(n=models.Count('pk')).values_list('counter', 'n')
+    )
+    counters = list(Counter.objects.all())
+    for counter in counters:
+        counter.waiting_count = counts.get(counter.pk, 0)
+    Counter.objects.bulk_update(counters, ['waiting_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queue_app', '0007_ticket_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='counter',
+            name='waiting_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='assignment_cursor',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='counter',
+            index=models.Index(fields=['service', 'waiting_count'], name='counter_service_waiting_idx'),
+        ),
+        migrations.RunPython(count_waiting_entries, migrations.RunPython.noop),
+    ]
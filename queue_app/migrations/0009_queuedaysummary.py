@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2025-08-24 10:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queue_app', '0008_counter_waiting_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueDaySummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('completed_count', models.IntegerField(default=0)),
+                ('skipped_count', models.IntegerField(default=0)),
+                ('total_wait_seconds', models.FloatField(default=0)),
+                ('max_wait_seconds', models.FloatField(default=0)),
+                ('first_completed_at', models.DateTimeField(blank=True, null=True)),
+                ('last_completed_at', models.DateTimeField(blank=True, null=True)),
+                ('counter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='queue_app.counter')),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='queue_app.service')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['service', 'date'], name='queuedaysummary_service_idx')],
+                'constraints': [models.UniqueConstraint(fields=('date', 'counter'), name='queuedaysummary_date_counter_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.5 on 2025-08-25 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queue_app', '0009_queuedaysummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queueentry',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='queuehistory',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='AnalyticsBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(choices=[('service', 'Service'), ('counter', 'Counter')], max_length=10)),
+                ('scope_id', models.IntegerField()),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('start', models.DateTimeField()),
+                ('completed_count', models.IntegerField(default=0)),
+                ('skipped_count', models.IntegerField(default=0)),
+                ('wait_count', models.IntegerField(default=0)),
+                ('wait_sum', models.FloatField(default=0)),
+                ('wait_sketch', models.JSONField(default=dict)),
+                ('service_count', models.IntegerField(default=0)),
+                ('service_sum', models.FloatField(default=0)),
+                ('service_sketch', models.JSONField(default=dict)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('scope', 'scope_id', 'period', 'start'), name='analyticsbucket_key_uniq')],
+            },
+        ),
+    ]
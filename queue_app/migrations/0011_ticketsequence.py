@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2025-08-26 10:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queue_app', '0010_analytics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('last_number', models.PositiveIntegerField(default=0)),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='queue_app.service')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('service', 'date'), name='ticketsequence_service_date_uniq')],
+            },
+        ),
+    ]
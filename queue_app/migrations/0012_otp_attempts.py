@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2025-08-26 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queue_app', '0011_ticketsequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='otp',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
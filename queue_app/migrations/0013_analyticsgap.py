@@ -0,0 +1,21 @@
+# Generated by Django 5.2.5 on 2025-08-26 10:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queue_app', '0012_otp_attempts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsGap',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -25,6 +25,8 @@ class Service(models.Model):
     week_days = models.IntegerField(choices=WEEKDAY_CHOICES)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Last counter the round-robin assignment policy picked
+    assignment_cursor = models.IntegerField(default=0)
 
     def __str__(self):
         return self.service_name
@@ -48,6 +50,13 @@ class Counter(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Ticket sequence: the last ticket issued at this counter and the ticket it
+    # is now serving. A waiting patient's position is ticket_number - serving_ticket.
+    last_ticket = models.PositiveIntegerField(default=0)
+    serving_ticket = models.PositiveIntegerField(default=0)
+    # Patients waiting at this counter, maintained by join/serve/redistribute
+    waiting_count = models.IntegerField(default=0)
+
     staff = models.OneToOneField(
         'Staff',
         on_delete=models.SET_NULL,
@@ -56,6 +65,12 @@ class Counter(models.Model):
         related_name='counter'
     )
 
+    class Meta:
+        indexes = [
+            # Least-loaded counter of a service for join_queue
+            models.Index(fields=['service', 'waiting_count'], name='counter_service_waiting_idx'),
+        ]
+
     def __str__(self):
         return f"{self.counter_name} - {self.service.service_name}"
 
@@ -110,6 +125,14 @@ class OTP(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField()
     is_used = models.BooleanField(default=False)
+    # Wrong guesses so far, counted here so every worker sees the same number
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # verify_otp_view: unused, unexpired OTPs for a phone, newest first
+            models.Index(fields=['phone_number', 'is_used', 'expires_at'], name='otp_phone_used_expires_idx'),
+        ]
 
     def __str__(self):
         return f"OTP for {self.phone_number}"
@@ -130,8 +153,21 @@ class QueueEntry(models.Model):
     skipped_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(null=True, blank=True)  # When serving began
     completed_at = models.DateTimeField(null=True, blank=True)
     announcement_count = models.IntegerField(default=0) 
+    ticket_number = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # A counter's waiting/serving patients in ticket order
+            models.Index(fields=['counter', 'current_status', 'ticket_number'], name='queueentry_counter_ticket_idx'),
+            # A patient's active entry
+            models.Index(fields=['patient', 'current_status'], name='queueentry_patient_status_idx'),
+            # Every serving entry on the display board
+            models.Index(fields=['current_status', 'created_at'], name='queueentry_status_created_idx'),
+        ]
+
     def __str__(self):
         return self.queue_id
 
@@ -151,7 +187,106 @@ class QueueHistory(models.Model):
     created_at = models.DateTimeField()
     updated_at = models.DateTimeField()
     date = models.DateField()
+    started_at = models.DateTimeField(null=True, blank=True)
     completed_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        # Rows are rolled up and archived a whole `date` at a time (see history.py),
+        # so every maintenance query leads with it
+        indexes = [
+            models.Index(fields=['completed_at'], name='queuehistory_completed_idx'),
+            models.Index(fields=['date', 'counter'], name='queuehistory_date_counter_idx'),
+        ]
+
     def __str__(self):
         return f"{self.queue_id} - {self.current_status}"
+
+
+class TicketSequence(models.Model):
+    """The last ticket number reserved for a service on a day (see tickets.py)"""
+    service = models.ForeignKey(Service, on_delete=models.CASCADE)
+    date = models.DateField()
+    last_number = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['service', 'date'], name='ticketsequence_service_date_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.service_id} {self.date}: {self.last_number}"
+
+
+class QueueDaySummary(models.Model):
+    """One counter's QueueHistory for one day, kept after the raw rows are archived"""
+    date = models.DateField()
+    service = models.ForeignKey(Service, on_delete=models.CASCADE)
+    counter = models.ForeignKey(Counter, on_delete=models.CASCADE)
+    completed_count = models.IntegerField(default=0)
+    skipped_count = models.IntegerField(default=0)
+    # Seconds from joining the queue to leaving it, over completed patients
+    total_wait_seconds = models.FloatField(default=0)
+    max_wait_seconds = models.FloatField(default=0)
+    first_completed_at = models.DateTimeField(null=True, blank=True)
+    last_completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'counter'], name='queuedaysummary_date_counter_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['service', 'date'], name='queuedaysummary_service_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} - {self.counter_id}"
+
+    @property
+    def average_wait_seconds(self):
+        return self.total_wait_seconds / self.completed_count if self.completed_count else None
+
+
+class AnalyticsBucket(models.Model):
+    """
+    Throughput and duration totals for one service or counter over one hour
+    or day (see analytics.py). Sketches are QuantileSketch.to_json() dicts.
+    """
+    SCOPE_CHOICES = [
+        ('service', 'Service'),
+        ('counter', 'Counter'),
+    ]
+    PERIOD_CHOICES = [
+        ('hour', 'Hour'),
+        ('day', 'Day'),
+    ]
+
+    scope = models.CharField(max_length=10, choices=SCOPE_CHOICES)
+    scope_id = models.IntegerField()
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    start = models.DateTimeField()
+    completed_count = models.IntegerField(default=0)
+    skipped_count = models.IntegerField(default=0)
+    # Seconds from joining to being called, and from being called to leaving
+    wait_count = models.IntegerField(default=0)
+    wait_sum = models.FloatField(default=0)
+    wait_sketch = models.JSONField(default=dict)
+    service_count = models.IntegerField(default=0)
+    service_sum = models.FloatField(default=0)
+    service_sketch = models.JSONField(default=dict)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'scope_id', 'period', 'start'], name='analyticsbucket_key_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.scope_id} {self.period} {self.start}"
+
+
+class AnalyticsGap(models.Model):
+    """A local day whose analytics buckets missed closures; rebuild_analytics --gaps replays it"""
+    date = models.DateField(unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Analytics gap {self.date}"
@@ -0,0 +1,38 @@
+# queue_app/notifications.py
+from .outbox import publish
+
+
+# Staff sockets on ws/queue/updates/ are subscribed to their counter's and
+# its service's groups, and each patient socket on ws/patient/updates/ to
+# that patient's own group (patient_updates.py), so an event only reaches
+# the browsers it concerns. Display screens have ws/display/updates/
+# (board.py). Sends go through the outbox: they leave after the current
+# transaction commits and never hold up the request.
+
+def counter_group(counter_id):
+    return f"counter_{counter_id}"
+
+
+def service_group(service_id):
+    return f"service_{service_id}"
+
+
+def send_update(group, message, key=None):
+    """Queue `message` for the group's sockets; a later message with the same key replaces it"""
+    publish(
+        group,
+        {
+            "type": "send_update",
+            "group": group,
+            "message": message
+        },
+        key
+    )
+
+
+def notify_counter(counter_id, message, key=None):
+    send_update(counter_group(counter_id), message, key)
+
+
+def notify_service(service_id, message, key=None):
+    send_update(service_group(service_id), message, key)
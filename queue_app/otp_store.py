@@ -0,0 +1,112 @@
+# queue_app/otp_store.py
+import secrets
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import OTP
+
+OTP_VALIDITY = timedelta(minutes=5)
+
+# Wrong guesses allowed before the OTP is thrown away
+MAX_ATTEMPTS = 5
+
+OTP_KEY = 'otp:{phone_number}'
+
+
+# OTP store
+#
+# Each phone has at most one live OTP. It is kept in the cache with a TTL of
+# its validity, so verification is a cache read, and written through to the
+# OTP table so another process (or a cold cache) can still verify it. The
+# table is the authority: a guess that does not match the cached OTP is
+# checked against the row before it is rejected, since another worker may
+# have issued a newer one, and wrong guesses are counted on the row so every
+# worker sees the same count. Issuing a new OTP removes the phone's older
+# rows and purge() clears whatever expired; the table stays about as large as
+# the number of logins in flight.
+
+def _otp_key(phone_number):
+    return OTP_KEY.format(phone_number=phone_number)
+
+
+def issue(phone_number):
+    """Create a fresh OTP for the phone, replacing any earlier one, and return it"""
+    otp = str(100000 + secrets.randbelow(900000))
+    now = timezone.now()
+    expires_at = now + OTP_VALIDITY
+
+    OTP.objects.filter(phone_number=phone_number).delete()
+    record = OTP.objects.create(phone_number=phone_number, otp=otp, expires_at=expires_at)
+
+    _cache(phone_number, record.pk, otp, expires_at)
+    return otp
+
+
+def _cache(phone_number, pk, otp, expires_at):
+    cache.set(_otp_key(phone_number), {'pk': pk, 'otp': otp, 'expires': expires_at}, OTP_VALIDITY.total_seconds())
+
+
+def _stored_otp(phone_number, now):
+    record = OTP.objects.filter(
+        phone_number=phone_number,
+        is_used=False,
+        expires_at__gte=now
+    ).order_by('-expires_at').first()
+    if record is None:
+        return None
+    return {'pk': record.pk, 'otp': record.otp, 'expires': record.expires_at}
+
+
+def _live_otp(phone_number, now):
+    entry = cache.get(_otp_key(phone_number))
+    if entry is not None:
+        return entry if entry['expires'] >= now else None
+    # Cache miss: fall back to the table
+    return _stored_otp(phone_number, now)
+
+
+def _discard(phone_number, pk):
+    """Use up the OTP; False if another request got there first"""
+    cache.delete(_otp_key(phone_number))
+    return bool(OTP.objects.filter(pk=pk, is_used=False).update(is_used=True))
+
+
+def verify(phone_number, otp):
+    """
+    Check and consume the phone's OTP. Returns 'ok', 'invalid', 'expired'
+    (none live) or 'locked' (too many wrong guesses; a new OTP is needed).
+    """
+    now = timezone.now()
+    entry = _live_otp(phone_number, now)
+    if entry is None:
+        return 'expired'
+
+    if entry['otp'] != otp:
+        # The cached OTP may be stale: another worker may have issued a newer one
+        entry = _stored_otp(phone_number, now)
+        if entry is None:
+            cache.delete(_otp_key(phone_number))
+            return 'expired'
+        _cache(phone_number, entry['pk'], entry['otp'], entry['expires'])
+
+    if entry['otp'] == otp:
+        return 'ok' if _discard(phone_number, entry['pk']) else 'expired'
+
+    # Count the wrong guess on the row, so the limit holds across workers
+    if not OTP.objects.filter(pk=entry['pk'], is_used=False).update(attempts=F('attempts') + 1):
+        return 'expired'
+    attempts = OTP.objects.filter(pk=entry['pk']).values_list('attempts', flat=True).get()
+    if attempts >= MAX_ATTEMPTS:
+        _discard(phone_number, entry['pk'])
+        return 'locked'
+    return 'invalid'
+
+
+def purge(now=None):
+    """Delete used and expired OTP rows; returns how many were removed"""
+    now = now or timezone.now()
+    deleted, _ = OTP.objects.filter(Q(is_used=True) | Q(expires_at__lt=now)).delete()
+    return deleted
@@ -0,0 +1,228 @@
+# queue_app/outbox.py
+import asyncio
+import atexit
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import SyncToAsync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+# Notification outbox
+#
+# Views never wait on the channel layer. They publish into the outbox, which
+# queues the message once the surrounding transaction commits, so a socket
+# is never told about a write that could still roll back. A dispatcher task
+# drains the queue in batches: different groups are sent concurrently and each
+# group keeps its order. A message published with a key replaces the queued
+# message with the same group and key, so bursts of state updates collapse
+# into the latest one.
+#
+# The dispatcher runs on the ASGI server's event loop when a view under it
+# publishes (the in-memory layer only works on that loop); otherwise (WSGI,
+# management commands) it runs on a background thread with its own loop.
+
+def _caller_loop():
+    """The event loop serving the caller: its own, or the one a sync view was called from"""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    threadlocal = SyncToAsync.threadlocal
+    if getattr(threadlocal, 'main_event_loop_pid', None) == os.getpid():
+        loop = getattr(threadlocal, 'main_event_loop', None)
+        if loop is not None and loop.is_running():
+            return loop
+    return None
+
+
+def _run_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+    # Stopped by close(): let the dispatcher task finish before the loop goes away
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+
+
+class _Dispatcher:
+    def __init__(self, loop):
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+        self.stopped = False
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+
+class Outbox:
+    def __init__(self, batch_size=100, layer=None):
+        self.batch_size = batch_size
+        self._layer = layer
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._ids = itertools.count()
+        self._dispatcher = None
+        self._thread_loop = None
+        self._thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.enqueued = 0
+            self.coalesced = 0
+            self.dispatched = 0
+            self.failed = 0
+            self.batches = 0
+            self.max_depth = len(self._pending)
+            self.last_lag = 0.0
+            self.max_lag = 0.0
+            self.total_lag = 0.0
+
+    def publish(self, group, message, key=None):
+        """Queue a group_send for when the current transaction commits (right away outside one)"""
+        transaction.on_commit(lambda: self.put(group, message, key))
+
+    def put(self, group, message, key=None):
+        """Queue a group_send now"""
+        with self._lock:
+            slot = ('key', group, key) if key is not None else ('id', next(self._ids))
+            if slot in self._pending:
+                # Keep the original place and age, send the newest message
+                _, _, enqueued_at = self._pending[slot]
+                self._pending[slot] = (group, message, enqueued_at)
+                self.coalesced += 1
+            else:
+                self._pending[slot] = (group, message, time.monotonic())
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self._pending))
+            dispatcher = self._ensure_dispatcher()
+        dispatcher.wake()
+
+    def _ensure_dispatcher(self):
+        caller_loop = _caller_loop()
+        current = self._dispatcher
+        if current is not None and not current.loop.is_closed():
+            alive = current.loop.is_running() or current.loop is self._thread_loop
+            if alive and caller_loop in (None, current.loop):
+                return current
+
+        # (Re)start on the caller's loop, or on our own thread if it has none
+        loop = caller_loop or self._own_loop()
+        dispatcher = _Dispatcher(loop)
+        if current is not None:
+            current.stopped = True
+            if not current.loop.is_closed():
+                current.wake()
+        loop.call_soon_threadsafe(lambda: loop.create_task(self._dispatch(dispatcher)))
+        self._dispatcher = dispatcher
+        return dispatcher
+
+    def _own_loop(self):
+        if self._thread_loop is None:
+            self._thread_loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=_run_loop, args=(self._thread_loop,), name='queue-outbox', daemon=True
+            )
+            self._thread.start()
+        return self._thread_loop
+
+    def close(self):
+        """Stop dispatching; whatever is still queued stays queued"""
+        with self._lock:
+            dispatcher, self._dispatcher = self._dispatcher, None
+            loop, self._thread_loop = self._thread_loop, None
+            thread, self._thread = self._thread, None
+        if dispatcher is not None:
+            dispatcher.stopped = True
+            if not dispatcher.loop.is_closed():
+                dispatcher.wake()
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout=1)
+
+    def _take(self):
+        with self._lock:
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False)[1])
+            return batch
+
+    async def _dispatch(self, dispatcher):
+        while not dispatcher.stopped:
+            batch = self._take()
+            if batch:
+                await self._send_batch(batch)
+                continue
+            # Nothing can be queued between the take and the wait: wakeups run on this loop
+            dispatcher.wakeup.clear()
+            await dispatcher.wakeup.wait()
+
+    async def _send_batch(self, batch):
+        layer = self._layer or get_channel_layer()
+        by_group = {}
+        for item in batch:
+            by_group.setdefault(item[0], []).append(item)
+
+        async def send_in_order(items):
+            for group, message, enqueued_at in items:
+                try:
+                    await layer.group_send(group, message)
+                    registry.ws_group_send(group)
+                    sent = True
+                except Exception:
+                    logger.exception("outbox.send_failed group=%s", group)
+                    sent = False
+                self._record(sent, time.monotonic() - enqueued_at)
+
+        await asyncio.gather(*(send_in_order(items) for items in by_group.values()))
+        with self._lock:
+            self.batches += 1
+
+    def _record(self, sent, lag):
+        with self._lock:
+            if sent:
+                self.dispatched += 1
+            else:
+                self.failed += 1
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.total_lag += lag
+
+    def stats(self):
+        """Queue depth and dispatch lag (time from commit to group_send) so far"""
+        with self._lock:
+            done = self.dispatched + self.failed
+            return {
+                'depth': len(self._pending),
+                'max_depth': self.max_depth,
+                'enqueued': self.enqueued,
+                'coalesced': self.coalesced,
+                'dispatched': self.dispatched,
+                'failed': self.failed,
+                'batches': self.batches,
+                'lag_ms': {
+                    'last': round(self.last_lag * 1000, 2),
+                    'max': round(self.max_lag * 1000, 2),
+                    'avg': round(self.total_lag * 1000 / done, 2) if done else 0.0,
+                },
+            }
+
+
+outbox = Outbox()
+atexit.register(outbox.close)
+
+
+def publish(group, message, key=None):
+    outbox.publish(group, message, key)
@@ -0,0 +1,127 @@
+# queue_app/patient_updates.py
+from .estimates import aget_service_minutes, get_service_minutes
+from .models import QueueEntry
+from .notifications import send_update
+
+
+# Patient push
+#
+# Each patient dashboard holds one ws/patient/updates/ socket, subscribed to
+# its own patient group only. The queue transitions call push_counter() for
+# every counter whose queue moved, push_entries()/push_moves() when only some
+# patients changed and push_closed() for those who left, all inside their
+# transaction: one query reads the counter's queue and every patient on it
+# gets their own status, position and ETA once it commits. Messages are keyed
+# per patient, so a burst of transitions reaches a slow socket as just the
+# latest state.
+
+def patient_group(phone_number):
+    return f"patient_{phone_number}"
+
+
+def queue_position(ticket_number, serving_ticket):
+    """Places from the front of a counter's queue: the ticket minus the ticket being served"""
+    return max(ticket_number - serving_ticket, 1)
+
+
+def _status(queue_id, status, position, minutes, counter_name, announcement_count):
+    return {
+        'action': 'queue_status',
+        'queue_id': queue_id,
+        'queue_status': status,
+        'position': position,
+        'estimated_wait_minutes': round(position * minutes) if position else None,
+        'counter_name': counter_name,
+        'announcement_count': announcement_count,
+    }
+
+
+def _send(phone_number, message):
+    send_update(patient_group(phone_number), message, key='queue_status')
+
+
+def _live_entry(phone_number):
+    return QueueEntry.objects.filter(
+        patient_id=phone_number,
+        current_status__in=['waiting', 'serving']
+    ).select_related('counter')
+
+
+def _entry_status(entry, minutes_for):
+    if entry is None:
+        return _status(None, 'none', None, 0, None, 0)
+    if entry.counter is None:
+        return _status(entry.queue_id, entry.current_status, None, 0, None, entry.announcement_count)
+
+    counter = entry.counter
+    position = queue_position(entry.ticket_number, counter.serving_ticket) if entry.current_status == 'waiting' else None
+    return _status(
+        entry.queue_id, entry.current_status, position, minutes_for(counter) if position else 0,
+        counter.counter_name, entry.announcement_count
+    )
+
+
+def entry_status(entry):
+    """The status pushed for a live entry (None for no entry), its counter already loaded"""
+    return _entry_status(
+        entry, lambda counter: get_service_minutes([(counter.counter_id, counter.service_id)])[counter.counter_id]
+    )
+
+
+async def aentry_status(entry):
+    """entry_status for async views"""
+    minutes = 0
+    if entry is not None and entry.counter is not None and entry.current_status == 'waiting':
+        counter = entry.counter
+        minutes = (await aget_service_minutes([(counter.counter_id, counter.service_id)]))[counter.counter_id]
+    return _entry_status(entry, lambda counter: minutes)
+
+
+def patient_status(phone_number):
+    """The patient's current queue status, as pushed to their socket"""
+    return entry_status(_live_entry(phone_number).first())
+
+
+async def apatient_status(phone_number):
+    """patient_status for async views"""
+    return await aentry_status(await _live_entry(phone_number).afirst())
+
+
+def push_moves(moves):
+    """
+    Push the status of live entries, given as [(entry, counter)] with each
+    counter's serving_ticket current. The estimates are read in one go.
+    """
+    if not moves:
+        return
+    minutes = get_service_minutes({(counter.counter_id, counter.service_id) for _, counter in moves})
+    for entry, counter in moves:
+        position = (
+            queue_position(entry.ticket_number, counter.serving_ticket)
+            if entry.current_status == 'waiting' else None
+        )
+        _send(entry.patient_id, _status(
+            entry.queue_id, entry.current_status, position, minutes[counter.counter_id],
+            counter.counter_name, entry.announcement_count
+        ))
+
+
+def push_entries(counter, entries):
+    """Push the status of these live entries, all at `counter`"""
+    push_moves([(entry, counter) for entry in entries])
+
+
+def push_counter(counter):
+    """Push every patient waiting at or being served by `counter`"""
+    push_entries(counter, list(
+        QueueEntry.objects.filter(counter_id=counter.pk, current_status__in=['waiting', 'serving'])
+        .only('queue_id', 'patient_id', 'current_status', 'ticket_number', 'announcement_count')
+    ))
+
+
+def push_closed(counter, entries, status):
+    """Tell patients their entries at `counter` were just completed or skipped"""
+    for entry in entries:
+        _send(entry.patient_id, _status(
+            entry.queue_id, status, None, 0, counter.counter_name, entry.announcement_count
+        ))
@@ -0,0 +1,105 @@
+# queue_app/principals.py
+from django.core.cache import cache
+
+from .models import Counter, Staff
+
+PRINCIPAL_KEY = 'staff_principal:{session_key}:{staff_id}'
+GENERATION_KEY = 'staff_principal:generation'
+PRINCIPAL_TIMEOUT = 5 * 60
+
+# Counter fields that only change through the staff dashboard; saving just
+# these does not change who a session belongs to
+LIVE_COUNTER_FIELDS = {
+    'current_status', 'status_updated_at', 'updated_at', 'last_ticket', 'serving_ticket', 'waiting_count'
+}
+
+
+# Resolved staff principals
+#
+# validate_staff_session needs the session's staff member and their counter
+# (with its service) on every dashboard poll. They are cached per session for
+# a few minutes. Any admin edit of a Staff or Counter bumps one generation
+# number, which invalidates every cached principal at once.
+#
+# The cached counter is for identity (id, name, service): its status and
+# ticket fields are a snapshot, so read those from the database.
+
+def _generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 0, None)
+        generation = cache.get(GENERATION_KEY, 0)
+    return generation
+
+
+async def _ageneration():
+    generation = await cache.aget(GENERATION_KEY)
+    if generation is None:
+        await cache.aadd(GENERATION_KEY, 0, None)
+        generation = await cache.aget(GENERATION_KEY, 0)
+    return generation
+
+
+def resolve_staff(session_key, staff_id):
+    """
+    (staff, counter) for a staff session; counter is None if they have no
+    counter. Raises Staff.DoesNotExist if the staff member is gone.
+    """
+    key = PRINCIPAL_KEY.format(session_key=session_key, staff_id=staff_id)
+    found = cache.get_many([key, GENERATION_KEY])
+    generation = found.get(GENERATION_KEY)
+    if generation is None:
+        generation = _generation()
+    cached = found.get(key)
+    if cached is not None and cached[0] == generation:
+        return cached[1], cached[2]
+
+    # One query when the staff member has a counter, which is the usual case
+    counter = Counter.objects.select_related('staff', 'service').filter(staff_id=staff_id).first()
+    staff = counter.staff if counter else Staff.objects.get(staff_id=staff_id)
+    cache.set(key, (generation, staff, counter), PRINCIPAL_TIMEOUT)
+    return staff, counter
+
+
+async def aresolve_staff(session_key, staff_id):
+    """resolve_staff for async views, through the async cache API and the async ORM"""
+    key = PRINCIPAL_KEY.format(session_key=session_key, staff_id=staff_id)
+    found = await cache.aget_many([key, GENERATION_KEY])
+    generation = found.get(GENERATION_KEY)
+    if generation is None:
+        generation = await _ageneration()
+    cached = found.get(key)
+    if cached is not None and cached[0] == generation:
+        return cached[1], cached[2]
+
+    counter = await Counter.objects.select_related('staff', 'service').filter(staff_id=staff_id).afirst()
+    staff = counter.staff if counter else await Staff.objects.aget(staff_id=staff_id)
+    await cache.aset(key, (generation, staff, counter), PRINCIPAL_TIMEOUT)
+    return staff, counter
+
+
+def get_request_principal(request):
+    """resolve_staff for the request's session, resolved at most once per request"""
+    if not hasattr(request, '_staff_principal'):
+        request._staff_principal = resolve_staff(request.session.session_key, request.session['staff_id'])
+    return request._staff_principal
+
+
+async def aget_request_principal(request):
+    """get_request_principal for async code; the two share the per-request result"""
+    if not hasattr(request, '_staff_principal'):
+        session = request.session
+        staff_id = await session.aget('staff_id')
+        if staff_id is None:
+            raise KeyError('staff_id')
+        request._staff_principal = await aresolve_staff(session.session_key, staff_id)
+    return request._staff_principal
+
+
+def invalidate_principals():
+    """Drop every cached principal (after a Staff or Counter change)"""
+    _generation()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, 1, None)
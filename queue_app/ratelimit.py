@@ -0,0 +1,34 @@
+# queue_app/ratelimit.py
+import time
+
+from django.core.cache import cache
+
+RATE_KEY = 'ratelimit:{scope}:{identifier}:{window}'
+
+
+def hit(scope, identifier, limit, period):
+    """
+    Count one request for `identifier` in the current fixed window of
+    `period` seconds. Returns (allowed, retry_after_seconds); a constant
+    number of cache operations however much traffic there is.
+    """
+    now = time.time()
+    window = int(now // period)
+    key = RATE_KEY.format(scope=scope, identifier=identifier, window=window)
+    # add() only sets a missing key, so the first request of a window creates the counter atomically
+    if cache.add(key, 1, period):
+        count = 1
+    else:
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr()
+            cache.set(key, 1, period)
+            count = 1
+    if count > limit:
+        return False, int((window + 1) * period - now) + 1
+    return True, 0
+
+
+def client_ip(request):
+    return request.META.get('REMOTE_ADDR', '')
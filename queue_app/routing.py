@@ -4,5 +4,7 @@ from . import consumers
 websocket_urlpatterns = [
     
     re_path(r'ws/queue/updates/$', consumers.QueueUpdatesConsumer.as_asgi()),
+    re_path(r'ws/patient/updates/$', consumers.PatientUpdatesConsumer.as_asgi()),
+    re_path(r'ws/display/updates/$', consumers.DisplayUpdatesConsumer.as_asgi()),
     
 ]
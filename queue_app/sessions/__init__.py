@@ -0,0 +1,33 @@
+# queue_app/sessions/__init__.py
+import time
+
+from django.conf import settings
+
+# Session key holding when the session row was last written
+WRITTEN_AT_KEY = '_written_at'
+
+
+class SkipUnchangedSaveMixin:
+    """
+    With SESSION_SAVE_EVERY_REQUEST every request rewrites the session just
+    to push its expiry forward; the staff dashboard polls every few seconds,
+    so that is a write per poll. This skips the write when the request changed
+    nothing and the session was written less than SESSION_REFRESH_INTERVAL
+    seconds ago, so expiry still slides, just in coarser steps.
+    """
+
+    def _is_fresh(self, session):
+        written_at = session.get(WRITTEN_AT_KEY)
+        return written_at and time.time() - written_at < getattr(settings, 'SESSION_REFRESH_INTERVAL', 300)
+
+    def save(self, must_create=False):
+        if self.session_key and not must_create and not self.modified and self._is_fresh(self._get_session()):
+            return
+        self._get_session()[WRITTEN_AT_KEY] = int(time.time())
+        super().save(must_create=must_create)
+
+    async def asave(self, must_create=False):
+        if self.session_key and not must_create and not self.modified and self._is_fresh(await self._aget_session()):
+            return
+        (await self._aget_session())[WRITTEN_AT_KEY] = int(time.time())
+        await super().asave(must_create=must_create)
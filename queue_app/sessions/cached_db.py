@@ -0,0 +1,12 @@
+# queue_app/sessions/cached_db.py
+from django.contrib.sessions.backends import cached_db
+
+from . import SkipUnchangedSaveMixin
+
+
+class SessionStore(SkipUnchangedSaveMixin, cached_db.SessionStore):
+    """
+    Cache-first sessions that are only rewritten when they change. Reads
+    usually skip the database too, but the cache must be shared by every
+    worker (Redis/Memcached), not the per-process default.
+    """
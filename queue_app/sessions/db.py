@@ -0,0 +1,8 @@
+# queue_app/sessions/db.py
+from django.contrib.sessions.backends import db
+
+from . import SkipUnchangedSaveMixin
+
+
+class SessionStore(SkipUnchangedSaveMixin, db.SessionStore):
+    """Database sessions that are only rewritten when they change (or are due a refresh)"""
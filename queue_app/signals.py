@@ -0,0 +1,35 @@
+# queue_app/signals.py
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .engine import live_engine
+from .models import Counter, Staff
+from .principals import LIVE_COUNTER_FIELDS, invalidate_principals
+
+
+@receiver([post_save, post_delete], sender=Staff)
+def staff_changed(sender, **kwargs):
+    invalidate_principals()
+
+
+@receiver([post_save, post_delete], sender=Counter)
+def counter_changed(sender, update_fields=None, **kwargs):
+    # Status saves from the dashboard do not change who works the counter
+    if update_fields and set(update_fields) <= LIVE_COUNTER_FIELDS:
+        return
+    invalidate_principals()
+
+
+@receiver(post_save, sender=Counter)
+def counter_saved(sender, instance, **kwargs):
+    # The in-memory queue keeps its own copy of each counter's name and status
+    engine = live_engine()
+    if engine is not None:
+        engine.counter_saved(instance)
+
+
+@receiver(post_delete, sender=Counter)
+def counter_deleted(sender, instance, **kwargs):
+    engine = live_engine()
+    if engine is not None:
+        engine.counter_deleted(instance.counter_id)
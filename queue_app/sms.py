@@ -0,0 +1,204 @@
+# queue_app/sms.py
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from .utils import format_phone_number, is_twilio_configured
+
+logger = logging.getLogger(__name__)
+
+OTP_MESSAGE = 'Your OTP for queue system is: {otp}. This OTP is valid for 5 minutes.'
+
+DELIVERY_KEY = 'otp_delivery:{delivery_id}'
+DELIVERY_TIMEOUT = 10 * 60
+
+
+class SMSError(Exception):
+    """A failed send; retryable=False means trying again cannot help (e.g. an invalid number)"""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+# Gateways
+#
+# A gateway is any object with send(phone_number, body) that returns a
+# message id or raises. SMS_GATEWAY picks one by dotted path, with
+# SMS_GATEWAY_OPTIONS as keyword arguments; by default Twilio is used when it
+# is configured and the console otherwise.
+
+class TwilioGateway:
+    """Twilio REST API through one client, so HTTPS connections are pooled and reused"""
+
+    def __init__(self, timeout=10):
+        from twilio.http.http_client import TwilioHttpClient
+        from twilio.rest import Client
+
+        self.from_number = settings.TWILIO_PHONE_NUMBER
+        self.client = Client(
+            settings.TWILIO_ACCOUNT_SID,
+            settings.TWILIO_AUTH_TOKEN,
+            http_client=TwilioHttpClient(pool_connections=True, timeout=timeout)
+        )
+
+    def send(self, phone_number, body):
+        from twilio.base.exceptions import TwilioRestException
+
+        try:
+            message = self.client.messages.create(body=body, from_=self.from_number, to=format_phone_number(phone_number))
+        except TwilioRestException as e:
+            # 4xx other than rate limiting means the request itself is wrong
+            retryable = e.status is None or e.status == 429 or e.status >= 500
+            raise SMSError(str(e), retryable=retryable) from e
+        return message.sid
+
+
+class ConsoleGateway:
+    """Development sender: logs the message instead of sending it"""
+
+    def send(self, phone_number, body):
+        logger.info("sms.console to=%s body=%r", phone_number, body)
+        return f"console-{uuid.uuid4().hex[:12]}"
+
+
+class FakeGateway:
+    """
+    Local stand-in for an SMS provider in tests and load benchmarks: takes
+    `latency` seconds per send and fails `failure_rate` of them (plus the
+    first `fail_first`). Sent messages are kept in `sent`.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, fail_first=0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.fail_first = fail_first
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.sent = []
+
+    def send(self, phone_number, body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            if self.calls <= self.fail_first or self.random.random() < self.failure_rate:
+                raise SMSError('fake gateway failure')
+            self.sent.append((phone_number, body))
+            return f"fake-{self.calls}"
+
+
+def build_gateway():
+    path = getattr(settings, 'SMS_GATEWAY', None)
+    if path is None:
+        return TwilioGateway() if is_twilio_configured() else ConsoleGateway()
+    return import_string(path)(**getattr(settings, 'SMS_GATEWAY_OPTIONS', {}))
+
+
+# Delivery queue
+#
+# send_otp_view hands the SMS to a small worker pool and returns at once. The
+# pool bounds how many sends are in flight; a failed attempt is retried with
+# exponential backoff and jitter on a timer, so waiting never occupies a
+# worker. Each delivery's status is kept in the cache for the login page to
+# poll; with several workers that must be the shared cache (CACHE_BACKEND),
+# since the poll can reach a different worker than the one sending.
+
+def _status_key(delivery_id):
+    return DELIVERY_KEY.format(delivery_id=delivery_id)
+
+
+def get_delivery_status(delivery_id):
+    """{'status': queued|sending|retrying|sent|failed, 'attempts': n} or None if unknown"""
+    return cache.get(_status_key(delivery_id))
+
+
+class DeliveryQueue:
+    def __init__(self, gateway, workers=4, max_attempts=3, backoff=1.0, max_pending=1000):
+        self.gateway = gateway
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sms')
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self.pending = 0
+
+    def _set_status(self, delivery_id, status, attempts):
+        cache.set(_status_key(delivery_id), {'status': status, 'attempts': attempts}, DELIVERY_TIMEOUT)
+
+    def submit(self, phone_number, body):
+        """Queue an SMS and return its delivery id right away"""
+        delivery_id = uuid.uuid4().hex
+        with self._lock:
+            if self.pending >= self.max_pending:
+                logger.warning("sms.dropped to=%s reason=queue_full", phone_number)
+                self._set_status(delivery_id, 'failed', 0)
+                return delivery_id
+            self.pending += 1
+        self._set_status(delivery_id, 'queued', 0)
+        self._executor.submit(self._attempt, delivery_id, phone_number, body, 1)
+        return delivery_id
+
+    def _attempt(self, delivery_id, phone_number, body, attempt):
+        self._set_status(delivery_id, 'sending', attempt)
+        try:
+            message_id = self.gateway.send(phone_number, body)
+        except Exception as e:
+            retryable = getattr(e, 'retryable', True)
+            if retryable and attempt < self.max_attempts:
+                delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                logger.warning("sms.retry to=%s attempt=%s delay=%.1f error=%r", phone_number, attempt, delay, str(e))
+                self._set_status(delivery_id, 'retrying', attempt)
+                timer = threading.Timer(delay, self._executor.submit,
+                                        args=(self._attempt, delivery_id, phone_number, body, attempt + 1))
+                timer.daemon = True
+                timer.start()
+                return
+            logger.error("sms.failed to=%s attempts=%s error=%r", phone_number, attempt, str(e))
+            self._set_status(delivery_id, 'failed', attempt)
+        else:
+            logger.info("sms.sent to=%s attempt=%s message_id=%s", phone_number, attempt, message_id)
+            self._set_status(delivery_id, 'sent', attempt)
+        self._done()
+
+    def _done(self):
+        with self._lock:
+            self.pending -= 1
+            if not self.pending:
+                self._idle.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until every queued message was sent or gave up; False on timeout"""
+        with self._lock:
+            return self._idle.wait_for(lambda: not self.pending, timeout)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_delivery_queue():
+    """The process-wide queue, built on first use so the gateway's client is shared"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = DeliveryQueue(
+                build_gateway(),
+                workers=getattr(settings, 'SMS_MAX_CONCURRENCY', 4),
+                max_attempts=getattr(settings, 'SMS_MAX_ATTEMPTS', 3)
+            )
+        return _queue
+
+
+def send_otp(phone_number, otp):
+    """Queue the OTP text for `phone_number`; returns the delivery id to poll"""
+    return get_delivery_queue().submit(phone_number, OTP_MESSAGE.format(otp=otp))
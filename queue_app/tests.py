@@ -1,3 +1,1836 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time as time_module
+from datetime import timedelta
+from datetime import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.exceptions import ChannelFull
+from channels.testing import WebsocketCommunicator
+from django.contrib.sessions.backends.db import SessionStore
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, OperationalError, connection, connections, transaction
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .board import build_board_snapshot, invalidate_board, publish_board_change
+from .channel_layers import SQLiteChannelLayer
+from .checks import check_shared_cache
+from .consumers import DisplayUpdatesConsumer, PatientUpdatesConsumer, QueueUpdatesConsumer, get_subscription_groups
+from .middleware import MetricsMiddleware, SessionTabIsolationMiddleware, StaffSessionMiddleware
+from . import (
+    analytics, assignment, engine, estimates, eventlog, history, metrics, otp_store, principals, sms, tickets, transitions
+)
+from .models import (
+    OTP, AnalyticsBucket, Counter, Patient, QueueDaySummary, QueueEntry, QueueHistory, Service, Staff, TicketSequence
+)
+from .notifications import notify_counter, notify_service
+from .outbox import Outbox
+
+
+def make_service(name='OPD'):
+    return Service.objects.create(service_name=name, description=name, week_days=1)
+
+
+def make_counter(service, name, **kwargs):
+    return Counter.objects.create(
+        counter_name=name,
+        service=service,
+        start_time=time(9, 0),
+        end_time=time(17, 0),
+        **kwargs
+    )
+
+
+# Staff.save() hashes anything that does not look hashed; skip that in tests
+HASHED_PASSWORD = 'pbkdf2_sha256$test'
+
+
+def login_staff(client, counter, username='operator1'):
+    staff = Staff.objects.create(username=username, password=HASHED_PASSWORD, role='operator')
+    counter.staff = staff
+    counter.save()
+    session = client.session
+    session['staff_id'] = staff.staff_id
+    session['session_unique'] = f'unique-{username}'
+    session.save()
+    return staff
+
+
+def make_entry(counter, phone, status='waiting'):
+    patient = Patient.objects.create(phone_number=phone, name=f'Patient {phone}')
+    return QueueEntry.objects.create(
+        queue_id=f'Q_{phone}',
+        patient=patient,
+        service=counter.service,
+        counter=counter,
+        current_status=status
+    )
+
+
+class BoardSnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+
+    def add_counters(self, count):
+        start = Counter.objects.count()
+        for i in range(start, start + count):
+            counter = make_counter(self.service, f'Counter {i}', current_status='busy')
+            make_entry(counter, f'{9000000000 + i}', status='serving')
+        invalidate_board()
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as ctx:
+            func()
+        return len(ctx.captured_queries)
+
+    def test_snapshot_rows(self):
+        counter = make_counter(self.service, 'Counter A')
+        entry = make_entry(counter, '9000000001', status='serving')
+        make_counter(self.service, 'Counter B')
+        make_counter(self.service, 'Hidden', is_active=False)
+
+        rows = build_board_snapshot()
+
+        self.assertEqual([row['counter_name'] for row in rows], ['Counter A', 'Counter B'])
+        self.assertEqual(rows[0]['serving_patient']['queue_id'], entry.queue_id)
+        self.assertEqual(rows[0]['serving_patient']['patient_name'], entry.patient.name)
+        self.assertIsNone(rows[1]['serving_patient'])
+
+    def test_snapshot_query_count_is_flat(self):
+        self.add_counters(2)
+        small = self.count_queries(build_board_snapshot)
+        self.add_counters(40)
+        large = self.count_queries(build_board_snapshot)
+        self.assertEqual(small, large)
+        # Counters, serving entries and (cold cache only) the service-time rebuild
+        self.assertLessEqual(large, 3)
+
+    def test_display_views_query_count_is_flat(self):
+        self.add_counters(2)
+        small = self.count_queries(lambda: self.client.get(reverse('display_screen_data')))
+        self.add_counters(40)
+        large = self.count_queries(lambda: self.client.get(reverse('display_screen_data')))
+        self.assertEqual(small, large)
+
+        response = self.client.get(reverse('display_screen'))
+        self.assertContains(response, 'Q_9000000041')
+
+
+class BoardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+        self.counter = make_counter(self.service, 'Counter A', current_status='busy')
+        self.entry = make_entry(self.counter, '9000000001', status='serving')
+
+    def test_display_data_answers_conditional_get(self):
+        url = reverse('display_screen_data')
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        etag = first['ETag']
+
+        with self.assertNumQueries(0):
+            cached = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(cached.status_code, 304)
+
+        invalidate_board(self.counter.counter_id)
+        fresh = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(fresh.status_code, 200)
+        self.assertNotEqual(fresh['ETag'], etag)
+
+    def test_staff_action_invalidates_board(self):
+        login_staff(self.client, self.counter)
+        etag = self.client.get(reverse('display_screen_data'))['ETag']
+
+        self.client.post(reverse('announce_patient'), {'queue_id': self.entry.queue_id})
+
+        response = self.client.get(reverse('display_screen_data'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['counters'][0]['serving_patient']['announcement_count'], 1)
+
+    def test_queue_data_answers_conditional_get(self):
+        login_staff(self.client, self.counter)
+        url = reverse('get_queue_data')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        invalidate_board(self.counter.counter_id)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_shared_channel_layer_needs_a_shared_cache(self):
+        shared_layer = {'default': {'BACKEND': 'queue_app.channel_layers.SQLiteChannelLayer'}}
+        local_cache = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(CHANNEL_LAYERS=shared_layer, CACHES=local_cache):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['queue_app.E001'])
+        shared_cache = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache'}}
+        with override_settings(CHANNEL_LAYERS=shared_layer, CACHES=shared_cache):
+            self.assertEqual(check_shared_cache(None), [])
+
+    def test_async_polls_with_a_database_cache(self):
+        database_cache = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'queue_cache'}}
+        with override_settings(CACHE_BACKEND='database', CACHES=database_cache):
+            call_command('createcachetable', verbosity=0)
+            board = self.client.get(reverse('display_screen_data'))
+            self.assertEqual(board.status_code, 200)
+            self.assertEqual(board.json()['counters'][0]['serving_patient']['queue_id'], self.entry.queue_id)
+            self.assertEqual(
+                self.client.get(reverse('display_screen_data'), HTTP_IF_NONE_MATCH=board['ETag']).status_code, 304
+            )
+
+            login_staff(self.client, self.counter)
+            queue = self.client.get(reverse('get_queue_data'))
+            self.assertEqual(queue.status_code, 200)
+            self.assertEqual(queue.json()['serving_patient']['queue_id'], self.entry.queue_id)
+            self.assertEqual(
+                self.client.get(reverse('get_queue_data'), HTTP_IF_NONE_MATCH=queue['ETag']).status_code, 304
+            )
+
+
+class DisplayPushTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+        self.counter = make_counter(self.service, 'Counter A', current_status='busy')
+        self.entry = make_entry(self.counter, '9000000001', status='serving')
+
+    def connect(self, query=''):
+        return WebsocketCommunicator(DisplayUpdatesConsumer.as_asgi(), f'/ws/display/updates/{query}')
+
+    async def receive(self, communicator):
+        return json.loads(await communicator.receive_from())
+
+    def test_snapshot_then_deltas(self):
+        async def scenario():
+            communicator = self.connect()
+            await communicator.connect()
+            snapshot = await self.receive(communicator)
+            self.assertEqual(snapshot['type'], 'snapshot')
+            self.assertEqual(snapshot['counters'][0]['serving_patient']['queue_id'], self.entry.queue_id)
+
+            seq = await sync_to_async(publish_board_change)('status', self.counter.counter_id)
+            delta = await self.receive(communicator)
+            self.assertEqual(delta['type'], 'delta')
+            self.assertEqual(delta['seq'], seq)
+            self.assertEqual(delta['seq'], snapshot['seq'] + 1)
+            self.assertEqual([row['counter_id'] for row in delta['counters']], [self.counter.counter_id])
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_reconnect_replays_missed_deltas(self):
+        async def scenario():
+            communicator = self.connect()
+            await communicator.connect()
+            since = (await self.receive(communicator))['seq']
+            await communicator.disconnect()
+
+            await sync_to_async(publish_board_change)('serve', self.counter.counter_id)
+            await sync_to_async(publish_board_change)('skip', self.counter.counter_id)
+
+            communicator = self.connect(f'?since={since}')
+            await communicator.connect()
+            first = await self.receive(communicator)
+            second = await self.receive(communicator)
+            self.assertEqual([first['type'], first['event'], second['event']], ['delta', 'serve', 'skip'])
+            self.assertEqual(second['seq'], since + 2)
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+
+class ScopedStaffUpdatesTests(TransactionTestCase):
+    """Fan-out per event with 50 staff sockets connected (5 services x 10 counters)"""
+
+    SERVICES = 5
+    COUNTERS_PER_SERVICE = 10
+
+    def setUp(self):
+        self.counters = []
+        for s in range(self.SERVICES):
+            service = make_service(f'Service {s}')
+            for c in range(self.COUNTERS_PER_SERVICE):
+                counter = make_counter(service, f'Counter {s}-{c}')
+                counter.staff = Staff.objects.create(username=f'staff{s}_{c}', password=HASHED_PASSWORD, role='operator')
+                counter.save()
+                self.counters.append(counter)
+
+    async def connect_staff(self, counter):
+        session = SessionStore()
+        session['staff_id'] = counter.staff_id
+        await sync_to_async(session.save)()
+        communicator = WebsocketCommunicator(QueueUpdatesConsumer.as_asgi(), '/ws/queue/updates/')
+        communicator.scope['session'] = session
+        await communicator.connect()
+        return communicator
+
+    async def count_deliveries(self, communicators):
+        delivered = 0
+        for communicator in communicators:
+            if not await communicator.receive_nothing(timeout=0.01):
+                await communicator.receive_from()
+                delivered += 1
+        return delivered
+
+    def test_message_count_per_event(self):
+        async def scenario():
+            communicators = [await self.connect_staff(counter) for counter in self.counters]
+            target = self.counters[0]
+
+            await sync_to_async(notify_counter)(target.counter_id, {'action': 'new_patient'})
+            counter_event = await self.count_deliveries(communicators)
+
+            await sync_to_async(notify_service)(target.service_id, {'action': 'counter_status_update'})
+            service_event = await self.count_deliveries(communicators)
+
+            for communicator in communicators:
+                await communicator.disconnect()
+            return counter_event, service_event
+
+        counter_event, service_event = async_to_sync(scenario)()
+        fan_out = (f"{len(self.counters)} staff sockets: counter event -> {counter_event} messages, "
+                   f"service event -> {service_event} messages (global broadcast: {len(self.counters)})")
+        self.assertEqual(counter_event, 1, fan_out)
+        self.assertEqual(service_event, self.COUNTERS_PER_SERVICE, fan_out)
+
+
+class PatientPushTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+        self.counter = make_counter(self.service, 'Counter A', current_status='busy')
+        self.phones = ['9000000001', '9000000002', '9000000003']
+        for phone in self.phones:
+            entry = make_entry(self.counter, phone)
+            QueueEntry.objects.filter(pk=entry.pk).update(ticket_number=transitions.issue_ticket(self.counter.counter_id))
+        transitions.start_serving(self.counter.counter_id)
+
+    async def connect(self, phone):
+        session = SessionStore()
+        session['patient_phone'] = phone
+        await sync_to_async(session.save)()
+        communicator = WebsocketCommunicator(PatientUpdatesConsumer.as_asgi(), '/ws/patient/updates/')
+        communicator.scope['session'] = session
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive(self, communicator):
+        return json.loads(await communicator.receive_from())
+
+    def test_snapshot_then_only_own_changes(self):
+        async def scenario():
+            served, next_up, last = [await self.connect(phone) for phone in self.phones]
+            snapshots = [await self.receive(communicator) for communicator in (served, next_up, last)]
+            self.assertEqual([s['queue_status'] for s in snapshots], ['serving', 'waiting', 'waiting'])
+            self.assertEqual([s['position'] for s in snapshots], [None, 1, 2])
+
+            await sync_to_async(transitions.announce_patient)(self.counter.counter_id, 'Q_9000000001')
+            self.assertEqual((await self.receive(served))['announcement_count'], 1)
+            # An announcement moves nobody else
+            self.assertTrue(await next_up.receive_nothing())
+
+            await sync_to_async(transitions.serve_next)(self.counter.counter_id)
+            self.assertEqual((await self.receive(served))['queue_status'], 'completed')
+            now_serving = await self.receive(next_up)
+            self.assertEqual((now_serving['queue_status'], now_serving['counter_name']), ('serving', 'Counter A'))
+            moved_up = await self.receive(last)
+            self.assertEqual((moved_up['position'], moved_up['estimated_wait_minutes']), (1, estimates.DEFAULT_SERVICE_MINUTES))
+            for communicator in (served, next_up, last):
+                self.assertTrue(await communicator.receive_nothing())
+                await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_redistribution_pushes_new_counter(self):
+        other = make_counter(self.service, 'Counter B', current_status='available')
+
+        async def scenario():
+            last = await self.connect(self.phones[2])
+            await self.receive(last)
+            await sync_to_async(transitions.redistribute_waiting)(self.counter.counter_id)
+            moved = await self.receive(last)
+            self.assertEqual((moved['counter_name'], moved['position']), ('Counter B', 2))
+            await last.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(QueueEntry.objects.get(queue_id='Q_9000000003').counter_id, other.counter_id)
+
+    def test_sockets_without_a_patient_are_refused(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(PatientUpdatesConsumer.as_asgi(), '/ws/patient/updates/')
+            communicator.scope['session'] = SessionStore()
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+
+        async_to_sync(scenario)()
+        # Patients no longer ride on the counter groups meant for staff
+        session = SessionStore()
+        session['patient_phone'] = self.phones[1]
+        self.assertEqual(get_subscription_groups(session), [])
+
+
+class SQLiteChannelLayerTests(TestCase):
+    """Two layer instances on one file stand in for two ASGI worker processes"""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'layer.sqlite3')
+
+    def test_group_send_reaches_other_worker(self):
+        async def scenario():
+            worker_a = SQLiteChannelLayer(path=self.path)
+            worker_b = SQLiteChannelLayer(path=self.path)
+            channel = await worker_a.new_channel()
+            await worker_a.group_add('counter_1', channel)
+
+            await worker_b.group_send('counter_1', {'type': 'send_update', 'message': {'action': 'new_patient'}})
+            received = await asyncio.wait_for(worker_a.receive(channel), timeout=2)
+
+            await worker_a.group_discard('counter_1', channel)
+            await worker_b.group_send('counter_1', {'type': 'send_update'})
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(worker_a.receive(channel), timeout=0.3)
+            await worker_a.close()
+            return received
+
+        received = async_to_sync(scenario)()
+        self.assertEqual(received['message'], {'action': 'new_patient'})
+
+    def test_send_respects_capacity(self):
+        async def scenario():
+            layer = SQLiteChannelLayer(path=self.path, capacity=2)
+            channel = await layer.new_channel()
+            await layer.send(channel, {'type': 'one'})
+            await layer.send(channel, {'type': 'two'})
+            with self.assertRaises(ChannelFull):
+                await layer.send(channel, {'type': 'three'})
+            first = await layer.receive(channel)
+            await layer.close()
+            return first
+
+        self.assertEqual(async_to_sync(scenario)()['type'], 'one')
+
+
+class QueueTransitionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+        self.counter = make_counter(self.service, 'Counter A')
+        self.entries = [make_entry(self.counter, f'{9000000000 + i}') for i in range(3)]
+        login_staff(self.client, self.counter)
+
+    def test_serve_next_walks_the_queue_in_order(self):
+        served = [self.client.post(reverse('serve_next')).json().get('queue_id') for _ in range(4)]
+        self.assertEqual(served, [entry.queue_id for entry in self.entries] + [None])
+        self.assertEqual(QueueHistory.objects.filter(current_status='completed').count(), 3)
+        self.counter.refresh_from_db()
+        self.assertEqual(self.counter.current_status, 'available')
+
+    def test_third_announcement_skips_patient(self):
+        self.client.post(reverse('start_serving'))
+        queue_id = self.entries[0].queue_id
+        statuses = [self.client.post(reverse('announce_patient'), {'queue_id': queue_id}).json()['status'] for _ in range(3)]
+        self.assertEqual(statuses, ['announced', 'announced', 'skipped'])
+        self.assertTrue(QueueHistory.objects.filter(queue_id=queue_id, current_status='skipped').exists())
+        self.assertEqual(QueueEntry.objects.get(current_status='serving').queue_id, self.entries[1].queue_id)
+
+
+class QueueTransitionConcurrencyTests(TransactionTestCase):
+    WAITING = 20
+    CALLS = 30
+    THREADS = 8
+
+    def setUp(self):
+        service = make_service()
+        self.counter = make_counter(service, 'Counter A')
+        base = timezone.now()
+        for i in range(self.WAITING):
+            entry = make_entry(self.counter, f'{9000000000 + i}')
+            QueueEntry.objects.filter(pk=entry.pk).update(created_at=base + timedelta(seconds=i))
+
+    def test_parallel_serve_next_keeps_invariants(self):
+        barrier = threading.Barrier(self.THREADS)
+        errors = []
+        calls = iter(range(self.CALLS))
+        lock = threading.Lock()
+
+        def worker():
+            barrier.wait()
+            try:
+                while True:
+                    with lock:
+                        if next(calls, None) is None:
+                            return
+                    transitions.serve_next(self.counter.counter_id)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        history_ids = list(QueueHistory.objects.values_list('queue_id', flat=True))
+        self.assertEqual(len(history_ids), len(set(history_ids)), 'a patient was served twice')
+        self.assertLessEqual(QueueEntry.objects.filter(current_status='serving').count(), 1)
+        self.assertEqual(len(history_ids) + QueueEntry.objects.count(), self.WAITING)
+        self.assertEqual(len(history_ids), self.WAITING)
+
+
+# Tables every hot path filters; a full scan of any of them fails the plan check.
+# Counter/Service/Staff are small lookup tables and Patient is only read by primary key.
+HOT_TABLES = ('queue_app_queueentry', 'queue_app_queuehistory', 'queue_app_otp')
+
+
+def full_scans(sql):
+    """Hot tables the database would read in full to run `sql`, from its EXPLAIN output"""
+    with connection.cursor() as cursor:
+        cursor.execute(f"{connection.ops.explain_query_prefix()} {sql}")
+        rows = cursor.fetchall()
+        columns = [col[0].lower() for col in cursor.description]
+
+    scans = []
+    if connection.vendor == 'sqlite':
+        # Rows are (id, parent, notused, detail): "SCAN t" is a full scan, "SEARCH t USING INDEX" is not
+        for row in rows:
+            detail = row[-1]
+            for table in HOT_TABLES:
+                if detail.startswith(f'SCAN {table}'):
+                    scans.append(detail)
+    elif connection.vendor == 'mysql':
+        # access type ALL is a table scan, index is a full index scan
+        for row in rows:
+            plan = dict(zip(columns, row))
+            if plan.get('table') in HOT_TABLES and plan.get('type') in ('ALL', 'index'):
+                scans.append(f"{plan['table']} type={plan['type']}")
+    return scans
+
+
+class QueryPlanTests(TestCase):
+    """EXPLAIN every SELECT the hot views issue and fail on full scans of the queue tables"""
+
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+        self.counter = make_counter(self.service, 'Counter A', current_status='busy')
+        self.other = make_counter(self.service, 'Counter B', current_status='busy')
+        for i in range(5):
+            make_entry(self.counter, f'{9000000000 + i}', status='serving' if i == 0 else 'waiting')
+            make_entry(self.other, f'{9100000000 + i}', status='serving' if i == 0 else 'waiting')
+        self.patient = Patient.objects.create(phone_number='9200000000', name='New Patient')
+        self.staff_client = self.client_class()
+        login_staff(self.staff_client, self.counter)
+        session = self.client.session
+        session['patient_phone'] = self.patient.phone_number
+        session.save()
+
+    def assert_no_full_scans(self, run):
+        with CaptureQueriesContext(connection) as ctx:
+            run()
+        selects = [q['sql'] for q in ctx.captured_queries if q['sql'].lstrip().upper().startswith('SELECT')]
+        self.assertTrue(selects)
+        for sql in selects:
+            self.assertEqual(full_scans(sql), [], sql)
+
+    def test_display_views(self):
+        self.assert_no_full_scans(lambda: self.client.get(reverse('display_screen_data')))
+        self.assert_no_full_scans(lambda: self.client.get(reverse('display_screen')))
+
+    def test_staff_views(self):
+        self.assert_no_full_scans(lambda: self.staff_client.get(reverse('get_queue_data')))
+        self.assert_no_full_scans(lambda: self.staff_client.post(reverse('announce_patient'), {'queue_id': 'Q_9000000000'}))
+        self.assert_no_full_scans(lambda: self.staff_client.post(reverse('skip_patient'), {'queue_id': 'Q_9000000000'}))
+        self.assert_no_full_scans(lambda: self.staff_client.post(reverse('serve_next')))
+        self.assert_no_full_scans(lambda: self.staff_client.post(reverse('update_counter_status'), {'status': 'break'}))
+
+    def test_patient_views(self):
+        self.assert_no_full_scans(lambda: self.client.post(reverse('join_queue'), {'service_id': self.service.service_id}))
+        self.assert_no_full_scans(lambda: self.client.get(reverse('get_queue_status')))
+        self.assert_no_full_scans(lambda: self.client.get(reverse('patient_dashboard')))
+
+    def test_otp_verification(self):
+        OTP.objects.create(phone_number=self.patient.phone_number, otp='123456', expires_at=timezone.now() + timedelta(minutes=5))
+        self.assert_no_full_scans(lambda: self.client.post(
+            reverse('verify_otp'), {'phone_number': self.patient.phone_number, 'otp': '123456'}
+        ))
+
+    def test_history_queries(self):
+        self.assert_no_full_scans(lambda: list(QueueHistory.objects.filter(completed_at__gte=timezone.now() - timedelta(hours=1))))
+        self.assert_no_full_scans(lambda: list(QueueHistory.objects.filter(date=timezone.localdate(), counter=self.counter)))
+
+
+class QueuePositionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+        self.counter = make_counter(self.service, 'Counter A')
+        self.patients = []
+        for i in range(4):
+            client = self.client_class()
+            patient = Patient.objects.create(phone_number=f'{9000000000 + i}', name=f'Patient {i}')
+            session = client.session
+            session['patient_phone'] = patient.phone_number
+            session.save()
+            client.post(reverse('join_queue'), {'service_id': self.service.service_id})
+            self.patients.append(client)
+        self.staff_client = self.client_class()
+        login_staff(self.staff_client, self.counter)
+
+    def positions(self):
+        return [client.get(reverse('get_queue_status')).json()['position'] for client in self.patients]
+
+    def test_join_issues_sequential_tickets(self):
+        tickets = list(QueueEntry.objects.order_by('ticket_number').values_list('ticket_number', flat=True))
+        self.assertEqual(tickets, [1, 2, 3, 4])
+        self.assertEqual(self.positions(), [1, 2, 3, 4])
+
+    def test_position_follows_serving_cursor(self):
+        self.staff_client.post(reverse('serve_next'))
+        self.assertEqual(self.positions(), [None, 1, 2, 3])
+        self.staff_client.post(reverse('serve_next'))
+        status = self.patients[3].get(reverse('get_queue_status')).json()
+        self.assertEqual(status['position'], 2)
+        self.assertIsNotNone(status['estimated_wait_minutes'])
+
+    def test_position_lookup_is_constant_time(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.patients[3].get(reverse('get_queue_status'))
+        entry_queries = [q for q in ctx.captured_queries if 'queue_app_queueentry' in q['sql']]
+        self.assertEqual(len(entry_queries), 1)
+        self.assertNotIn('COUNT(', entry_queries[0]['sql'].upper())
+
+
+class ServiceTimeEstimatorTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+        self.counter = make_counter(self.service, 'Counter A')
+        self.idle = make_counter(self.service, 'Counter B')
+        self.start = timezone.now() - timedelta(hours=1)
+
+    def add_history(self, minutes_apart):
+        completed_at = self.start
+        for i, minutes in enumerate(minutes_apart):
+            completed_at += timedelta(minutes=minutes)
+            patient = Patient.objects.create(phone_number=f'{9000000000 + i}', name=f'Patient {i}')
+            QueueHistory.objects.create(
+                queue_id=f'Q_{i}', patient=patient, service=self.service, counter=self.counter,
+                current_status='completed', created_at=self.start, updated_at=completed_at,
+                date=completed_at.date(), completed_at=completed_at
+            )
+            estimates.record_completion(self.counter.counter_id, self.service.service_id, completed_at)
+
+    def minutes(self):
+        pairs = [(self.counter.counter_id, self.service.service_id), (self.idle.counter_id, self.service.service_id)]
+        return estimates.get_service_minutes(pairs)
+
+    def test_defaults_without_history(self):
+        self.assertEqual(self.minutes()[self.counter.counter_id], estimates.DEFAULT_SERVICE_MINUTES)
+
+    def test_moving_average_and_service_fallback(self):
+        self.add_history([0, 4, 4, 4, 4])
+        minutes = self.minutes()
+        self.assertEqual(minutes[self.counter.counter_id], 4.0)
+        # A counter without history falls back to the service average
+        self.assertEqual(minutes[self.idle.counter_id], 4.0)
+
+    def test_idle_gaps_are_ignored(self):
+        self.add_history([0, 3, 120, 3])
+        self.assertEqual(self.minutes()[self.counter.counter_id], 3.0)
+
+    def test_rebuild_from_history_matches_incremental(self):
+        self.add_history([0, 2, 6, 3, 8, 5])
+        incremental = self.minutes()
+        cache.clear()
+        with self.assertNumQueries(1):
+            rebuilt = self.minutes()
+        self.assertEqual(incremental, rebuilt)
+
+    def test_reads_do_not_query(self):
+        self.add_history([0, 2, 6])
+        self.minutes()  # First read of the idle counter loads its (empty) state
+        with self.assertNumQueries(0):
+            self.minutes()
+
+
+class CounterAssignmentTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+        self.counters = [make_counter(self.service, f'Counter {name}') for name in 'ABC']
+        self.patients = 0
+
+    def join(self, policy=None):
+        with transaction.atomic():
+            counter = assignment.assign_counter(self.service.service_id, policy=policy)
+            self.patients += 1
+            patient = Patient.objects.create(phone_number=f'{9000000000 + self.patients}', name='Patient')
+            QueueEntry.objects.create(
+                queue_id=f'Q_{self.patients}', patient=patient, service=self.service, counter=counter,
+                current_status='waiting', ticket_number=transitions.issue_ticket(counter.counter_id)
+            )
+        return counter.counter_id
+
+    def waiting_counts(self):
+        return list(Counter.objects.order_by('counter_id').values_list('waiting_count', flat=True))
+
+    def test_least_waiting_spreads_joins(self):
+        for _ in range(7):
+            self.join()
+        self.assertEqual(self.waiting_counts(), [3, 2, 2])
+
+    def test_waiting_count_follows_transitions(self):
+        first = self.counters[0]
+        for _ in range(6):
+            self.join()
+        transitions.serve_next(first.counter_id)
+        self.assertEqual(self.waiting_counts(), [1, 2, 2])
+        transitions.serve_next(first.counter_id)
+        transitions.serve_next(first.counter_id)
+        transitions.serve_next(first.counter_id)
+        self.assertEqual(self.waiting_counts(), [0, 2, 2])
+        actual = [QueueEntry.objects.filter(counter=c, current_status='waiting').count() for c in self.counters]
+        self.assertEqual(self.waiting_counts(), actual)
+
+    def test_closed_counters_are_skipped(self):
+        Counter.objects.filter(pk=self.counters[0].pk).update(current_status='break')
+        Counter.objects.filter(pk=self.counters[1].pk).update(is_active=False)
+        self.assertEqual({self.join() for _ in range(3)}, {self.counters[2].counter_id})
+
+    def test_round_robin(self):
+        picked = [self.join('round_robin') for _ in range(5)]
+        ids = [c.counter_id for c in self.counters]
+        self.assertEqual(picked, ids + ids[:2])
+
+    def test_least_estimated_time_prefers_fast_counters(self):
+        slow, fast = self.counters[0].counter_id, self.counters[1].counter_id
+        Counter.objects.filter(pk=self.counters[2].pk).update(current_status='break')
+        minutes = {slow: 10, fast: 2}
+        with mock.patch.object(assignment, 'get_service_minutes', return_value=minutes):
+            picked = [self.join('least_estimated_time') for _ in range(5)]
+        # 5 patients at 2 minutes beat the first one at 10
+        self.assertEqual(picked, [fast] * 4 + [slow])
+
+    def test_assignment_does_not_count_entries(self):
+        for _ in range(5):
+            self.join()
+        with CaptureQueriesContext(connection) as ctx:
+            self.join()
+        for query in ctx.captured_queries:
+            self.assertNotIn('COUNT(', query['sql'].upper())
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            assignment.get_policy('fastest_first')
+
+
+class RedistributionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+        self.breaking, self.first, self.second = [
+            make_counter(self.service, f'Counter {name}', current_status='busy') for name in 'ABC'
+        ]
+        self.staff_client = self.client_class()
+        login_staff(self.staff_client, self.breaking)
+
+    def queue(self, counter, count, offset=0):
+        for i in range(count):
+            entry = make_entry(counter, f'{9000000000 + offset + i}')
+            ticket = transitions.issue_ticket(counter.counter_id)
+            QueueEntry.objects.filter(pk=entry.pk).update(ticket_number=ticket)
+
+    def go_on_break(self):
+        with mock.patch('queue_app.views.notify_service') as service_sends, \
+                mock.patch('queue_app.views.notify_counter') as counter_sends:
+            self.staff_client.post(reverse('update_counter_status'), {'status': 'break'})
+        return service_sends, counter_sends
+
+    def test_patients_are_balanced_in_order(self):
+        self.queue(self.first, 2, offset=100)
+        self.queue(self.breaking, 6)
+        self.go_on_break()
+
+        second = list(QueueEntry.objects.filter(counter=self.second).order_by('ticket_number')
+                      .values_list('queue_id', 'ticket_number'))
+        first = list(QueueEntry.objects.filter(counter=self.first).order_by('ticket_number')
+                     .values_list('queue_id', 'ticket_number'))
+        # The empty counter takes patients until it catches up, then they alternate
+        self.assertEqual(second, [('Q_9000000000', 1), ('Q_9000000001', 2), ('Q_9000000003', 3), ('Q_9000000005', 4)])
+        self.assertEqual(first[2:], [('Q_9000000002', 3), ('Q_9000000004', 4)])
+        counts = dict(Counter.objects.values_list('counter_id', 'waiting_count'))
+        self.assertEqual(counts, {self.breaking.counter_id: 0, self.first.counter_id: 4, self.second.counter_id: 4})
+
+    def test_one_batched_notification(self):
+        self.queue(self.breaking, 5)
+        service_sends, counter_sends = self.go_on_break()
+        batches = [call.args[1] for call in service_sends.call_args_list
+                   if call.args[1].get('action') == 'patients_redistributed']
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0]['moves']), 5)
+        self.assertEqual(batches[0]['moves'][0]['patient_name'], 'Patient 9000000000')
+        # The batch plus the counter status update, and nothing to the counter group
+        self.assertEqual(service_sends.call_count, 2)
+        self.assertEqual(counter_sends.call_count, 0)
+
+    def test_query_count_does_not_grow_with_queue(self):
+        self.queue(self.breaking, 3)
+        with CaptureQueriesContext(connection) as small:
+            transitions.redistribute_waiting(self.breaking.counter_id)
+        self.queue(self.first, 30, offset=100)
+        with CaptureQueriesContext(connection) as large:
+            transitions.redistribute_waiting(self.first.counter_id)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+
+class TicketNumberTests(TransactionTestCase):
+    def setUp(self):
+        self.service = make_service('OPD')
+        self.today = timezone.localdate()
+        tickets.allocator.reset()
+        self.addCleanup(tickets.allocator.reset)
+
+    def test_numbers_count_up_per_service_and_day(self):
+        allocator = tickets.TicketAllocator(block_size=5)
+        other = make_service('X-ray')
+        day = self.today.strftime('%y%m%d')
+        ids = [allocator.next_queue_id(self.service) for _ in range(3)] + [allocator.next_queue_id(other)]
+        self.assertEqual(ids, [
+            f'OPD{self.service.service_id}-{day}-001', f'OPD{self.service.service_id}-{day}-002',
+            f'OPD{self.service.service_id}-{day}-003', f'XRA{other.service_id}-{day}-001',
+        ])
+        tomorrow = self.today + timedelta(days=1)
+        self.assertEqual(allocator.next_number(self.service.service_id, tomorrow), 1)
+
+    def test_blocks_are_reserved_once_per_block(self):
+        allocator = tickets.TicketAllocator(block_size=5)
+        with CaptureQueriesContext(connection) as ctx:
+            numbers = [allocator.next_number(self.service.service_id) for _ in range(12)]
+        self.assertEqual(numbers, list(range(1, 13)))
+        # Three blocks: the first creates the day's row, the others update and read it back
+        self.assertEqual(len([q for q in ctx.captured_queries if 'queue_app_ticketsequence' in q['sql']]), 6)
+
+    def test_workers_never_share_a_number(self):
+        workers = [tickets.TicketAllocator(block_size=3) for _ in range(4)]
+        numbers = []
+        errors = []
+        lock = threading.Lock()
+
+        def join(worker):
+            try:
+                for _ in range(10):
+                    number = worker.next_number(self.service.service_id)
+                    with lock:
+                        numbers.append(number)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=join, args=(worker,)) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(numbers), 40)
+        self.assertEqual(len(set(numbers)), 40)
+
+    def test_inside_a_transaction_a_rollback_returns_the_number(self):
+        allocator = tickets.TicketAllocator(block_size=5)
+        try:
+            with transaction.atomic():
+                self.assertEqual(allocator.next_number(self.service.service_id), 1)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(allocator.next_number(self.service.service_id), 1)
+        self.assertEqual(TicketSequence.objects.get().last_number, 5)
+
+    def test_join_issues_a_ticket_id(self):
+        make_counter(self.service, 'Counter A')
+        Patient.objects.create(phone_number='9000000001', name='Patient')
+        session = self.client.session
+        session['patient_phone'] = '9000000001'
+        session.save()
+        queue_id = self.client.post(reverse('join_queue'), {'service_id': self.service.service_id}).json()['queue_id']
+        self.assertEqual(queue_id, f"OPD{self.service.service_id}-{self.today:%y%m%d}-001")
+        self.assertTrue(QueueEntry.objects.filter(queue_id=queue_id).exists())
+
+
+class CounterAssignmentConcurrencyTests(TransactionTestCase):
+    JOINS = 24
+    THREADS = 8
+
+    def test_parallel_joins_stay_balanced(self):
+        service = make_service()
+        counters = [make_counter(service, f'Counter {name}') for name in 'ABC']
+        patients = [Patient.objects.create(phone_number=f'{9000000000 + i}', name='Patient') for i in range(self.JOINS)]
+        barrier = threading.Barrier(self.THREADS)
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            barrier.wait()
+            try:
+                while True:
+                    with lock:
+                        if not patients:
+                            return
+                        patient = patients.pop()
+                    with transaction.atomic():
+                        counter = assignment.assign_counter(service.service_id)
+                        QueueEntry.objects.create(
+                            queue_id=f'Q_{patient.phone_number}', patient=patient, service=service,
+                            counter=counter, current_status='waiting',
+                            ticket_number=transitions.issue_ticket(counter.counter_id)
+                        )
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for counter in counters:
+            counter.refresh_from_db()
+            self.assertEqual(counter.waiting_count, self.JOINS // len(counters))
+            self.assertEqual(QueueEntry.objects.filter(counter=counter).count(), counter.waiting_count)
+
+
+class RecordingLayer:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.sent = []
+
+    async def group_send(self, group, message):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.sent.append((group, message))
+
+
+async def wait_dispatched(box, count, timeout=2):
+    deadline = time_module.monotonic() + timeout
+    while box.stats()['dispatched'] < count and time_module.monotonic() < deadline:
+        await asyncio.sleep(0.005)
+
+
+class OutboxTests(TestCase):
+    def test_nothing_is_queued_before_commit(self):
+        box = Outbox(layer=RecordingLayer())
+        self.addCleanup(box.close)
+        with self.captureOnCommitCallbacks(execute=True):
+            box.publish('counter_1', {'type': 'send_update', 'message': {}})
+            self.assertEqual(box.stats()['enqueued'], 0)
+        self.assertEqual(box.stats()['enqueued'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    box.publish('counter_1', {'type': 'send_update', 'message': {}})
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(box.stats()['enqueued'], 1)
+
+    def test_coalesces_keyed_messages_and_keeps_group_order(self):
+        layer = RecordingLayer()
+        box = Outbox(layer=layer)
+        self.addCleanup(box.close)
+
+        async def scenario():
+            # Queued back to back, so the dispatcher sees them as one batch
+            box.put('service_1', {'status': 'busy'}, key='counter_status:1')
+            for i in range(3):
+                box.put('counter_1', {'seq': i})
+            box.put('service_1', {'status': 'break'}, key='counter_status:1')
+            await wait_dispatched(box, 4)
+
+        async_to_sync(scenario)()
+        self.assertEqual([m for g, m in layer.sent if g == 'counter_1'], [{'seq': 0}, {'seq': 1}, {'seq': 2}])
+        self.assertEqual([m for g, m in layer.sent if g == 'service_1'], [{'status': 'break'}])
+        stats = box.stats()
+        self.assertEqual((stats['enqueued'], stats['coalesced'], stats['dispatched'], stats['depth']), (5, 1, 4, 0))
+
+    def test_slow_channel_layer_does_not_block_publishers(self):
+        layer = RecordingLayer(delay=0.1)
+        box = Outbox(layer=layer)
+        self.addCleanup(box.close)
+
+        async def scenario():
+            started = time_module.monotonic()
+            for i in range(10):
+                box.put(f'counter_{i}', {'seq': i})
+            queued_in = time_module.monotonic() - started
+            await wait_dispatched(box, 10)
+            return queued_in, time_module.monotonic() - started
+
+        queued_in, delivered_in = async_to_sync(scenario)()
+        self.assertLess(queued_in, 0.05)
+        # Different groups go out concurrently
+        self.assertLess(delivered_in, 0.5)
+        stats = box.stats()
+        self.assertEqual(stats['dispatched'], 10)
+        self.assertGreaterEqual(stats['lag_ms']['max'], 100)
+        self.assertEqual(stats['max_depth'], 10)
+
+    def test_background_thread_without_event_loop(self):
+        layer = RecordingLayer()
+        box = Outbox(layer=layer)
+        self.addCleanup(box.close)
+        box.put('counter_1', {'seq': 1})
+        async_to_sync(wait_dispatched)(box, 1)
+        self.assertEqual(layer.sent, [('counter_1', {'seq': 1})])
+
+
+class PermanentFailureGateway:
+    calls = 0
+
+    def send(self, phone_number, body):
+        self.calls += 1
+        raise sms.SMSError('invalid number', retryable=False)
+
+
+class OTPDeliveryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def deliver(self, gateway, **kwargs):
+        queue = sms.DeliveryQueue(gateway, backoff=0.01, **kwargs)
+        delivery_id = queue.submit('9000000001', 'Your OTP is 123456')
+        self.assertTrue(queue.join(timeout=5))
+        return sms.get_delivery_status(delivery_id)
+
+    def test_retries_until_sent(self):
+        gateway = sms.FakeGateway(fail_first=2)
+        self.assertEqual(self.deliver(gateway), {'status': 'sent', 'attempts': 3})
+        self.assertEqual(gateway.sent, [('9000000001', 'Your OTP is 123456')])
+
+    def test_gives_up_after_max_attempts(self):
+        gateway = sms.FakeGateway(fail_first=10)
+        self.assertEqual(self.deliver(gateway, max_attempts=3), {'status': 'failed', 'attempts': 3})
+        self.assertEqual(gateway.calls, 3)
+
+    def test_permanent_failures_are_not_retried(self):
+        gateway = PermanentFailureGateway()
+        self.assertEqual(self.deliver(gateway), {'status': 'failed', 'attempts': 1})
+        self.assertEqual(gateway.calls, 1)
+
+    def test_send_otp_view_does_not_wait_for_the_gateway(self):
+        queue = sms.DeliveryQueue(sms.FakeGateway(latency=0.3))
+        Patient.objects.create(phone_number='9000000001', name='Patient')
+        with mock.patch.object(sms, '_queue', queue):
+            started = time_module.monotonic()
+            response = self.client.post(reverse('send_otp'), {'phone_number': '9000000001'})
+            self.assertLess(time_module.monotonic() - started, 0.2)
+
+        delivery_id = response.json()['delivery_id']
+        status = self.client.get(reverse('otp_delivery_status', args=[delivery_id])).json()
+        self.assertIn(status['delivery']['status'], ('queued', 'sending'))
+        self.assertTrue(queue.join(timeout=5))
+        status = self.client.get(reverse('otp_delivery_status', args=[delivery_id])).json()
+        self.assertEqual(status['delivery'], {'status': 'sent', 'attempts': 1})
+        self.assertEqual(self.client.get(reverse('otp_delivery_status', args=['unknown'])).status_code, 404)
+
+
+class OTPStoreTests(TestCase):
+    PHONE = '9000000001'
+
+    def setUp(self):
+        cache.clear()
+        Patient.objects.create(phone_number=self.PHONE, name='Patient')
+
+    def test_new_otp_replaces_old_one(self):
+        first = otp_store.issue(self.PHONE)
+        second = otp_store.issue(self.PHONE)
+        self.assertEqual(OTP.objects.filter(phone_number=self.PHONE).count(), 1)
+        if first != second:
+            self.assertEqual(otp_store.verify(self.PHONE, first), 'invalid')
+        self.assertEqual(otp_store.verify(self.PHONE, second), 'ok')
+        # Consumed
+        self.assertEqual(otp_store.verify(self.PHONE, second), 'expired')
+
+    def test_verify_from_cache_and_db_fallback(self):
+        otp = otp_store.issue(self.PHONE)
+        with self.assertNumQueries(1):  # Only marking the row used
+            self.assertEqual(otp_store.verify(self.PHONE, otp), 'ok')
+
+        otp = otp_store.issue(self.PHONE)
+        cache.clear()
+        self.assertEqual(otp_store.verify(self.PHONE, otp), 'ok')
+
+    def test_wrong_guesses_lock_the_otp(self):
+        otp = otp_store.issue(self.PHONE)
+        wrong = '000000' if otp != '000000' else '111111'
+        results = [otp_store.verify(self.PHONE, wrong) for _ in range(otp_store.MAX_ATTEMPTS)]
+        self.assertEqual(results[-1], 'locked')
+        self.assertEqual(otp_store.verify(self.PHONE, otp), 'expired')
+
+    def test_stale_cache_from_another_worker(self):
+        first = otp_store.issue(self.PHONE)
+        stale = cache.get(otp_store.OTP_KEY.format(phone_number=self.PHONE))
+        # Another worker issues a newer OTP; this worker's cache still holds the first
+        second = otp_store.issue(self.PHONE)
+        cache.set(otp_store.OTP_KEY.format(phone_number=self.PHONE), stale)
+        wrong = next(code for code in ('000000', '111111', '222222') if code not in (first, second))
+        self.assertEqual(otp_store.verify(self.PHONE, wrong), 'invalid')
+        # Wrong guesses are counted on the row, where every worker sees them
+        self.assertEqual(OTP.objects.get(phone_number=self.PHONE).attempts, 1)
+        cache.set(otp_store.OTP_KEY.format(phone_number=self.PHONE), stale)
+        self.assertEqual(otp_store.verify(self.PHONE, second), 'ok')
+
+    def test_expired_otp_and_purge(self):
+        otp = otp_store.issue(self.PHONE)
+        later = timezone.now() + otp_store.OTP_VALIDITY + timedelta(seconds=1)
+        with mock.patch('queue_app.otp_store.timezone.now', return_value=later):
+            self.assertEqual(otp_store.verify(self.PHONE, otp), 'expired')
+        OTP.objects.create(phone_number='9000000002', otp='123456', expires_at=timezone.now() + timedelta(minutes=5))
+        self.assertEqual(otp_store.purge(now=later), 2)
+        self.assertFalse(OTP.objects.exists())
+
+    def test_verify_view_does_not_dump_otps(self):
+        with mock.patch('builtins.print') as printed:
+            response = self.client.post(reverse('verify_otp'), {'phone_number': self.PHONE, 'otp': '123456'})
+        self.assertEqual(response.json()['message'], 'OTP expired or not found')
+        printed.assert_not_called()
+
+
+class OTPRateLimitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.queue = sms.DeliveryQueue(sms.FakeGateway())
+        patcher = mock.patch.object(sms, '_queue', self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, phone, ip='10.0.0.1'):
+        return self.client.post(reverse('send_otp'), {'phone_number': phone, 'name': 'Patient'}, REMOTE_ADDR=ip)
+
+    def test_per_phone_limit(self):
+        limit, _ = settings.OTP_RATE_LIMITS['otp_phone']
+        statuses = [self.send('9000000001').status_code for _ in range(limit + 1)]
+        self.assertEqual(statuses, [200] * limit + [429])
+        self.assertTrue(int(self.send('9000000001')['Retry-After']) > 0)
+        # Another phone is not affected
+        self.assertEqual(self.send('9000000002').status_code, 200)
+        self.queue.join(timeout=5)
+        self.assertEqual(len(self.queue.gateway.sent), limit + 1)
+
+    def test_per_ip_limit(self):
+        limit, _ = settings.OTP_RATE_LIMITS['otp_ip']
+        statuses = [self.send(f'{9100000000 + i}').status_code for i in range(limit + 1)]
+        self.assertEqual(statuses[-1], 429)
+        # The rejected request created nothing
+        self.assertEqual(Patient.objects.count(), limit)
+        self.assertEqual(self.send('9200000000', ip='10.0.0.2').status_code, 200)
+        self.queue.join(timeout=5)
+
+
+class StaffPrincipalTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+        self.counter = make_counter(self.service, 'Counter A', current_status='busy')
+        for i in range(5):
+            make_entry(self.counter, f'{9000000000 + i}', status='serving' if i == 0 else 'waiting')
+        self.staff = login_staff(self.client, self.counter)
+
+    def poll(self, **headers):
+        return self.client.get(reverse('get_queue_data'), **headers)
+
+    def test_queries_per_poll(self):
+        etag = self.poll()['ETag']
+        # Session read, counter status, serving patient, waiting list; no session write
+        with self.assertNumQueries(4):
+            self.assertEqual(self.poll(HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.poll(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_admin_edits_invalidate_the_principal(self):
+        self.poll()
+        other = make_counter(self.service, 'Counter B')
+        self.counter.staff = None
+        self.counter.save()
+        self.assertEqual(self.poll().status_code, 403)
+
+        other.staff = self.staff
+        other.save()
+        self.assertEqual(self.poll().json()['counter_name'], 'Counter B')
+
+        self.staff.delete()
+        self.assertEqual(self.poll().status_code, 401)
+
+    def test_status_saves_keep_the_principal(self):
+        self.poll()
+        self.counter.current_status = 'break'
+        self.counter.save(update_fields=['current_status', 'status_updated_at', 'updated_at'])
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.poll().json()
+        self.assertEqual(data['counter_status'], 'break')
+        self.assertFalse(any('queue_app_staff' in q['sql'] for q in ctx.captured_queries))
+
+    def test_unchanged_session_is_refreshed_after_interval(self):
+        self.poll()
+        later = time_module.time() + settings.SESSION_REFRESH_INTERVAL + 1
+        with mock.patch('queue_app.sessions.time.time', return_value=later):
+            with CaptureQueriesContext(connection) as ctx:
+                self.poll()
+        self.assertTrue(any(q['sql'].startswith('UPDATE') and 'django_session' in q['sql'] for q in ctx.captured_queries))
+
+
+class StaffMiddlewareTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+        self.counter = make_counter(self.service, 'Counter A')
+        self.staff = login_staff(self.client, self.counter)
+        session = self.client.session
+        session['tab_id'] = 'tab_1'
+        session['tab_tab_1_staff'] = {'staff_id': self.staff.staff_id, 'session_unique': 'unique-operator1'}
+        session.save()
+        self.handler = SessionTabIsolationMiddleware(StaffSessionMiddleware(lambda request: HttpResponse()))
+
+    def test_other_paths_leave_the_session_alone(self):
+        for path in ['/dashboard/', '/display/screen/data/', '/static/css/style.css']:
+            request = RequestFactory().get(path, {'tab_id': 'tab_1'})
+            request.session = mock.MagicMock()
+            with self.assertNumQueries(0):
+                self.handler(request)
+            self.assertEqual(request.session.mock_calls, [])
+            self.assertIsNone(request.staff)
+
+    def test_staff_paths_get_the_tab_and_principal(self):
+        request = RequestFactory().get('/staff/get_queue_data/', {'tab_id': 'tab_1'})
+        request.session = self.client.session
+        self.handler(request)
+        self.assertEqual(request.staff, self.staff)
+        self.assertEqual(request.counter, self.counter)
+        self.assertEqual(request.tab_session['staff_id'], self.staff.staff_id)
+        self.assertFalse(request.tab_conflict)
+
+    def test_principal_is_resolved_once_per_request(self):
+        with mock.patch('queue_app.principals.resolve_staff', wraps=principals.resolve_staff) as resolve:
+            response = self.client.get(reverse('get_queue_data'), {'tab_id': 'tab_1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(resolve.call_count, 1)
+
+    def test_tab_replaced_by_another_login_is_rejected(self):
+        # A login in another tab flushes the session and with it this tab's entry
+        session = self.client.session
+        session['session_unique'] = 'unique-other-login'
+        del session['tab_tab_1_staff']
+        session.save()
+        response = self.client.get(reverse('get_queue_data'), {'tab_id': 'tab_1'})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.client.get(reverse('get_queue_data')).status_code, 200)
+
+
+class AsyncViewTests(TestCase):
+    """The polled endpoints through the ASGI handler, where the whole middleware stack runs async"""
+
+    def setUp(self):
+        cache.clear()
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+        self.service = make_service()
+        self.counter = make_counter(self.service, 'Counter A', current_status='busy')
+        for i in range(3):
+            entry = make_entry(self.counter, f'{9000000000 + i}', status='serving' if i == 0 else 'waiting')
+            QueueEntry.objects.filter(pk=entry.pk).update(ticket_number=i)
+        self.staff = login_staff(self.client, self.counter)
+        session = self.client.session
+        session['tab_tab_1_staff'] = {'staff_id': self.staff.staff_id, 'session_unique': 'unique-operator1'}
+        session.save()
+        self.async_client = AsyncClient()
+        self.async_client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+
+    def test_middlewares_follow_the_handler(self):
+        async def view(request):
+            return HttpResponse()
+
+        for middleware in (SessionTabIsolationMiddleware, StaffSessionMiddleware, MetricsMiddleware):
+            self.assertTrue(middleware(view).async_mode)
+            self.assertFalse(middleware(lambda request: HttpResponse()).async_mode)
+
+    async def test_staff_poll(self):
+        response = await self.async_client.get(reverse('get_queue_data'), {'tab_id': 'tab_1'})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['serving_patient']['queue_id'], data['queue_count']), ('Q_9000000000', 2))
+        response = await self.async_client.get(reverse('get_queue_data'), headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        # Another login took over the session cookie
+        session = await sync_to_async(lambda: self.client.session)()
+        await session.aset('session_unique', 'unique-other-login')
+        await session.asave()
+        response = await self.async_client.get(reverse('get_queue_data'), {'tab_id': 'tab_1'})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_patient_and_display_polls(self):
+        patient = AsyncClient()
+        self.assertEqual((await patient.get(reverse('get_queue_status'))).status_code, 401)
+        session = SessionStore()
+        await session.aset('patient_phone', '9000000002')
+        await session.asave()
+        patient.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        status = (await patient.get(reverse('get_queue_status'))).json()
+        self.assertEqual((status['queue_status'], status['position']), ('waiting', 2))
+
+        board = json.loads((await patient.get(reverse('display_screen_data'))).content)
+        self.assertEqual(board['counters'][0]['serving_patient']['queue_id'], 'Q_9000000000')
+
+    async def test_queries_are_charged_to_async_requests(self):
+        await self.async_client.get(reverse('get_queue_data'), {'tab_id': 'tab_1'})
+        metrics.registry.reset()
+        await self.async_client.get(reverse('get_queue_data'), {'tab_id': 'tab_1'})
+        queries = metrics.registry.views['get_queue_data'].queries
+        # Session, counter, serving patient, waiting list: all made from the sync thread
+        self.assertEqual(queries.sum, 4)
+
+
+class HistoryArchiveTests(TestCase):
+    def setUp(self):
+        self.service = make_service()
+        self.counter = make_counter(self.service, 'Counter A')
+        self.patient = Patient.objects.create(phone_number='9000000001', name='Patient')
+        self.today = timezone.localdate()
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        self.archive_dir = archive_dir.name
+
+    def add_history(self, days_ago, status='completed', wait_minutes=10):
+        completed_at = timezone.now() - timedelta(days=days_ago)
+        return QueueHistory.objects.create(
+            queue_id=f'Q{QueueHistory.objects.count()}', patient=self.patient, service=self.service,
+            counter=self.counter, current_status=status, created_at=completed_at - timedelta(minutes=wait_minutes),
+            updated_at=completed_at, date=timezone.localdate(completed_at),
+            started_at=(completed_at - timedelta(minutes=2)).replace(microsecond=0), completed_at=completed_at
+        )
+
+    def test_rollup_summarises_a_day_per_counter(self):
+        day = self.add_history(1, wait_minutes=10).date
+        self.add_history(1, wait_minutes=20)
+        self.add_history(1, status='skipped')
+        self.add_history(0)
+
+        history.rollup_day(day)
+        history.rollup_day(day)  # idempotent
+        summary = QueueDaySummary.objects.get()
+        self.assertEqual((summary.date, summary.completed_count, summary.skipped_count), (day, 2, 1))
+        self.assertAlmostEqual(summary.average_wait_seconds, 15 * 60, delta=1)
+        self.assertAlmostEqual(summary.max_wait_seconds, 20 * 60, delta=1)
+
+    def test_archive_moves_old_days_to_files(self):
+        old = [self.add_history(100), self.add_history(100, status='skipped'), self.add_history(95)]
+        recent = self.add_history(5)
+
+        call_command('archive_history', archive_dir=self.archive_dir, stdout=io.StringIO())
+
+        self.assertEqual(list(QueueHistory.objects.all()), [recent])
+        self.assertEqual(QueueDaySummary.objects.count(), 2)
+        archived = []
+        for name in sorted(os.listdir(self.archive_dir)):
+            archived += history.read_archive(os.path.join(self.archive_dir, name))
+        self.assertEqual(sorted(row['id'] for row in archived), sorted(row.pk for row in old))
+        self.assertEqual({row['current_status'] for row in archived}, {'completed', 'skipped'})
+        self.assertEqual(
+            {row['id']: parse_datetime(row['started_at']) for row in archived}, {row.pk: row.started_at for row in old}
+        )
+
+        # Summaries outlive the raw rows
+        history.rollup_day(old[0].date)
+        self.assertEqual(QueueDaySummary.objects.get(date=old[0].date).completed_count, 1)
+
+    def test_late_rows_are_appended_to_the_days_archive(self):
+        first = self.add_history(100)
+        history.archive_before(self.today, self.archive_dir)
+        late = self.add_history(100)
+        history.archive_before(self.today, self.archive_dir)
+
+        path = os.path.join(self.archive_dir, history.ARCHIVE_NAME.format(date=first.date.isoformat()))
+        self.assertEqual([row['id'] for row in history.read_archive(path)], [first.pk, late.pk])
+
+    def test_late_rows_keep_the_days_summary(self):
+        first = self.add_history(100, wait_minutes=10)
+        self.add_history(100, status='skipped')
+        history.archive_before(self.today, self.archive_dir)
+        self.add_history(100, wait_minutes=30)
+        history.archive_before(self.today, self.archive_dir)
+
+        summary = QueueDaySummary.objects.get(date=first.date)
+        self.assertEqual((summary.completed_count, summary.skipped_count), (2, 1))
+        self.assertAlmostEqual(summary.average_wait_seconds, 20 * 60, delta=1)
+
+
+class QuantileSketchTests(TestCase):
+    def test_quantiles_within_relative_accuracy(self):
+        sketch, other = analytics.QuantileSketch(), analytics.QuantileSketch()
+        for seconds in range(1, 5001):
+            sketch.add(seconds)
+            other.add(seconds + 5000)
+        merged = analytics.QuantileSketch(sketch.to_json()).merge(other)
+        self.assertEqual(merged.count, 10000)
+        for q, exact in [(0.5, 5000), (0.9, 9000), (0.99, 9900)]:
+            self.assertAlmostEqual(merged.quantile(q), exact, delta=exact * analytics.RELATIVE_ACCURACY)
+        self.assertLess(len(merged.counts), 300)
+        self.assertIsNone(analytics.QuantileSketch().quantile(0.5))
+
+
+class AnalyticsTests(TestCase):
+    def setUp(self):
+        self.service = make_service()
+        self.counter = make_counter(self.service, 'Counter A')
+
+    def serve_all(self, count):
+        for i in range(count):
+            make_entry(self.counter, f'{9100000000 + i}')
+        with self.captureOnCommitCallbacks(execute=True):
+            transitions.start_serving(self.counter.pk)
+            for _ in range(count - 1):
+                transitions.serve_next(self.counter.pk)
+            serving = QueueEntry.objects.get(current_status='serving')
+            transitions.skip_patient(self.counter.pk, serving.queue_id)
+
+    def test_closures_update_hour_and_day_buckets(self):
+        self.serve_all(4)
+        self.assertEqual(AnalyticsBucket.objects.count(), 4)
+        day = AnalyticsBucket.objects.get(scope='counter', scope_id=self.counter.pk, period='day')
+        self.assertEqual((day.completed_count, day.skipped_count, day.wait_count, day.service_count), (3, 1, 4, 4))
+
+        report = analytics.report('service', self.service.pk)
+        self.assertEqual((report['total']['completed'], report['total']['skipped']), (3, 1))
+        self.assertEqual(report['total']['skip_rate'], 0.25)
+        self.assertEqual(report['peak_hour'], timezone.localtime().hour)
+        self.assertEqual(len(report['series']), 1)
+
+    def test_rebuild_matches_incremental(self):
+        self.serve_all(3)
+        incremental = analytics.report('counter', self.counter.pk, period='hour')
+        self.assertEqual(analytics.rebuild(timezone.now()), 3)
+        self.assertEqual(analytics.report('counter', self.counter.pk, period='hour'), incremental)
+
+    def test_failed_recording_flags_the_day_for_rebuild(self):
+        with mock.patch.object(analytics, '_apply', side_effect=OperationalError('database is locked')) as apply:
+            self.serve_all(2)
+        self.assertEqual(apply.call_count, 2 * analytics.RECORD_ATTEMPTS)
+        self.assertFalse(AnalyticsBucket.objects.exists())
+        self.assertEqual(analytics.first_gap(), timezone.localdate())
+
+        call_command('rebuild_analytics', gaps=True, stdout=io.StringIO())
+        day = AnalyticsBucket.objects.get(scope='counter', scope_id=self.counter.pk, period='day')
+        self.assertEqual((day.completed_count, day.skipped_count), (1, 1))
+        self.assertIsNone(analytics.first_gap())
+
+    def test_rebuild_replays_archived_days(self):
+        self.serve_all(3)
+        incremental = analytics.report('counter', self.counter.pk, period='hour')
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        history.archive_day(timezone.localdate(), archive_dir.name)
+        self.assertFalse(QueueHistory.objects.exists())
+
+        self.assertEqual(analytics.rebuild(timezone.now(), archive_dir.name), 3)
+        self.assertEqual(analytics.report('counter', self.counter.pk, period='hour'), incremental)
+
+    def test_endpoint_reads_buckets_not_history(self):
+        self.serve_all(3)
+        login_staff(self.client, self.counter)
+        url = reverse('service_analytics', args=[self.service.pk])
+        self.client.get(url)
+        QueueHistory.objects.all().delete()
+        # Session, bucket range
+        with self.assertNumQueries(2):
+            data = self.client.get(url, {'period': 'hour', 'days': 30}).json()
+        self.assertEqual(data['total']['completed'], 2)
+        self.assertEqual(self.client.get(url, {'period': 'week'}).status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+    def test_operators_only_read_their_own_counter_and_service(self):
+        other_service = make_service()
+        other = make_counter(other_service, 'Counter B')
+        login_staff(self.client, self.counter)
+        self.assertEqual(self.client.get(reverse('counter_analytics', args=[self.counter.pk])).status_code, 200)
+        self.assertEqual(self.client.get(reverse('service_analytics', args=[self.service.pk])).status_code, 200)
+        self.assertEqual(self.client.get(reverse('counter_analytics', args=[other.pk])).status_code, 403)
+        self.assertEqual(self.client.get(reverse('service_analytics', args=[other_service.pk])).status_code, 403)
+
+        Staff.objects.filter(username='operator1').update(role='supervisor')
+        principals.invalidate_principals()
+        self.assertEqual(self.client.get(reverse('counter_analytics', args=[other.pk])).status_code, 200)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+
+    def test_requests_are_recorded_per_view(self):
+        self.client.get(reverse('get_queue_status'))
+        self.client.get(reverse('display_screen_data'))
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('queue_http_requests_total{view="get_queue_status",status="4xx"} 1', body)
+        self.assertIn('queue_http_request_duration_seconds_count{view="display_screen_data"} 1', body)
+        self.assertRegex(body, r'queue_db_queries_per_request_bucket\{view="display_screen_data",le="\+Inf"\} 1')
+        self.assertIn('queue_outbox_depth ', body)
+
+    def test_nothing_is_recorded_when_sampling_is_off(self):
+        with self.settings(METRICS_SAMPLE_RATE=0):
+            self.client_class().get(reverse('display_screen_data'))
+        self.assertEqual(metrics.registry.views, {})
+
+    def test_websocket_fan_out_is_counted_per_kind_of_group(self):
+        metrics.registry.ws_connected('counter_1')
+        metrics.registry.ws_connected('counter_2')
+        metrics.registry.ws_group_send('counter_1')
+        for _ in range(3):
+            metrics.registry.ws_delivered_to('service_4')
+        body = metrics.registry.render()
+        self.assertIn('queue_ws_connections{group="counter"} 2', body)
+        self.assertIn('queue_ws_group_sends_total{group="counter"} 1', body)
+        self.assertIn('queue_ws_frames_delivered_total{group="service"} 3', body)
+
+
+@override_settings(QUEUE_ENGINE='memory')
+class QueueEngineTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = make_service()
+        self.counter, self.other = [make_counter(self.service, f'Counter {name}', current_status='busy') for name in 'AB']
+        for i in range(3):
+            entry = make_entry(self.counter, f'{9000000000 + i}')
+            QueueEntry.objects.filter(pk=entry.pk).update(ticket_number=transitions.issue_ticket(self.counter.counter_id))
+        # Flushed by hand, on this thread
+        self.engine = engine.QueueEngine(flush_interval=0)
+        patcher = mock.patch.object(engine, 'engine', self.engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def flush(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.engine.flush()
+        return callbacks
+
+    def rows(self):
+        return list(QueueEntry.objects.order_by('queue_id').values_list('queue_id', 'counter_id', 'current_status', 'ticket_number'))
+
+    def test_transitions_run_in_memory_and_are_written_behind(self):
+        self.engine.load()
+        # Warm the service-time estimate the pushes read
+        estimates.get_service_minutes([(self.counter.counter_id, self.service.service_id)])
+        before = self.rows()
+        with self.assertNumQueries(0):
+            _, _, first = self.engine.serve_next(self.counter.counter_id)
+            self.engine.announce_patient(self.counter.counter_id, first.queue_id)
+            _, completed, second = self.engine.serve_next(self.counter.counter_id)
+        self.assertEqual([entry.queue_id for entry in completed], [first.queue_id])
+        self.assertEqual(self.rows(), before)
+
+        self.flush()
+        self.assertEqual(self.rows(), [
+            ('Q_9000000001', self.counter.counter_id, 'serving', 2),
+            ('Q_9000000002', self.counter.counter_id, 'waiting', 3),
+        ])
+        history = QueueHistory.objects.get()
+        self.assertEqual((history.queue_id, history.current_status), (first.queue_id, 'completed'))
+        self.counter.refresh_from_db()
+        self.assertEqual((self.counter.serving_ticket, self.counter.waiting_count, self.counter.last_ticket), (2, 1, 3))
+
+    def test_rebuilds_the_same_queue_from_the_database(self):
+        self.engine.start_serving(self.counter.counter_id)
+        self.engine.redistribute_waiting(self.counter.counter_id)
+        patient = Patient.objects.create(phone_number='9000000009', name='Late')
+        self.engine.join(patient, self.service, 'Q_late')
+        self.flush()
+
+        def queues(current):
+            return {
+                counter_id: ([ticket.queue_id for ticket in counter.serving],
+                             [(ticket.queue_id, ticket.ticket_number) for ticket in counter.waiting])
+                for counter_id, counter in current.counters.items()
+            }
+
+        rebuilt = engine.QueueEngine(flush_interval=0)
+        rebuilt.load()
+        self.assertEqual(queues(rebuilt), queues(self.engine))
+        self.assertEqual(queues(rebuilt)[self.other.counter_id][1], [('Q_9000000001', 1), ('Q_9000000002', 2)])
+        self.assertEqual(rebuilt.patient_status('9000000009'), self.engine.patient_status('9000000009'))
+        self.assertEqual(rebuilt.patient_status('9000000009')['queue_id'], 'Q_late')
+
+    def test_views_go_through_the_engine(self):
+        login_staff(self.client, self.counter)
+        patient_client = self.client_class()
+        Patient.objects.create(phone_number='9000000009', name='Late')
+        session = patient_client.session
+        session['patient_phone'] = '9000000009'
+        session.save()
+
+        with mock.patch('queue_app.views.publish_board_change') as board:
+            queue_id = patient_client.post(reverse('join_queue'), {'service_id': self.service.service_id}).json()['queue_id']
+            self.assertEqual(patient_client.post(reverse('join_queue'), {'service_id': self.service.service_id}).status_code, 400)
+            served = self.client.post(reverse('serve_next')).json()['queue_id']
+            # The board is published once the rows it is built from are written
+            self.assertFalse(board.called)
+            self.assertFalse(QueueEntry.objects.filter(pk=queue_id).exists())
+            self.flush()
+            self.assertEqual([call.args[0] for call in board.call_args_list], ['join', 'serve'])
+
+        self.assertEqual(served, 'Q_9000000000')
+        entry = QueueEntry.objects.get(pk=queue_id)
+        self.assertEqual((entry.counter_id, entry.current_status), (self.other.counter_id, 'waiting'))
+        self.assertEqual(patient_client.get(reverse('get_queue_status')).json()['queue_id'], queue_id)
+
+    def test_failed_flush_is_kept_for_the_next_one(self):
+        self.engine.serve_next(self.counter.counter_id)
+        with mock.patch.object(QueueEntry.objects, 'bulk_update', side_effect=DatabaseError('gone away')):
+            with self.assertRaises(DatabaseError):
+                self.engine.flush()
+        self.assertFalse(QueueEntry.objects.filter(current_status='serving').exists())
+        self.engine.serve_next(self.counter.counter_id)
+        self.flush()
+        self.assertEqual(QueueEntry.objects.get(current_status='serving').queue_id, 'Q_9000000001')
+        self.assertEqual(QueueHistory.objects.get().queue_id, 'Q_9000000000')
+
+    def test_rejected_row_is_dropped_and_the_rest_written(self):
+        for _ in range(3):
+            self.engine.serve_next(self.counter.counter_id)
+        written = []
+        self.engine.after_write(lambda: written.append(True))
+        create = QueueHistory.objects.bulk_create
+
+        def reject_first(rows, *args, **kwargs):
+            # As if the first patient had been deleted in the admin
+            if any(row.queue_id == 'Q_9000000000' for row in rows):
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            return create(rows, *args, **kwargs)
+
+        with mock.patch.object(QueueHistory.objects, 'bulk_create', side_effect=reject_first):
+            self.flush()
+        self.assertEqual(written, [True])
+        self.assertEqual(QueueHistory.objects.get().queue_id, 'Q_9000000001')
+        self.assertEqual(QueueEntry.objects.get(queue_id='Q_9000000002').current_status, 'serving')
+        stats = self.engine.stats()
+        self.assertEqual((stats['dropped'], stats['pending']), (1, 0))
+
+    def test_callbacks_stop_waiting_for_a_failing_database(self):
+        self.engine.serve_next(self.counter.counter_id)
+        written = []
+        self.engine.after_write(lambda: written.append(True))
+        with mock.patch.object(QueueEntry.objects, 'bulk_update', side_effect=DatabaseError('gone away')):
+            for _ in range(engine.MAX_FLUSH_FAILURES):
+                self.assertEqual(written, [])
+                with self.captureOnCommitCallbacks(execute=True), self.assertRaises(DatabaseError):
+                    self.engine.flush()
+        self.assertEqual(written, [True])
+        # The rows themselves are still pending
+        self.flush()
+        self.assertEqual(QueueEntry.objects.get(current_status='serving').queue_id, 'Q_9000000000')
+
+
+class EventLogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        patcher = mock.patch.object(eventlog, '_log', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: eventlog._log and eventlog._log.close())
+
+    def events(self, count, start=0):
+        at = time_module.time()
+        return [
+            eventlog.Event(eventlog.JOIN, at + i, 1, 1, i + 1, queue_id=f'Q_{start + i}', text=f'{9000000000 + start + i}')
+            for i in range(count)
+        ]
+
+    def join(self, service, count):
+        for i in range(count):
+            patient = Patient.objects.create(phone_number=f'{9000000000 + i}', name=f'Patient {i}')
+            patient_client = self.client_class()
+            session = patient_client.session
+            session['patient_phone'] = patient.phone_number
+            session.save()
+            patient_client.post(reverse('join_queue'), {'service_id': service.service_id})
+
+    def test_appends_roll_over_segments_and_read_back_in_order(self):
+        log = eventlog.EventLog(self.directory, segment_bytes=4096, sync_interval=0)
+        log.append(self.events(150))
+        # Another process appending to the same directory carries on the sequence
+        other = eventlog.EventLog(self.directory, segment_bytes=4096, sync_interval=0)
+        self.assertEqual(other.append(self.events(10, start=150)), 160)
+        log.sync()
+        other.close()
+        log.close()
+
+        self.assertGreater(len(eventlog.segment_paths(self.directory)), 1)
+        read = list(eventlog.read_events(self.directory))
+        self.assertEqual([seq for seq, _ in read], list(range(1, 161)))
+        self.assertEqual([event.queue_id for _, event in read], [f'Q_{i}' for i in range(160)])
+        self.assertEqual([seq for seq, _ in eventlog.read_events(self.directory, after=155)], list(range(156, 161)))
+
+    def test_torn_record_ends_the_log(self):
+        log = eventlog.EventLog(self.directory, sync_interval=0)
+        log.append(self.events(3))
+        segment = log._segment
+        # Corrupt the last payload's final byte, as a write cut short would
+        segment.map[segment.end - 1] ^= 0xFF
+        log.close()
+        self.assertEqual([seq for seq, _ in eventlog.read_events(self.directory)], [1, 2])
+
+    def test_views_log_transitions_and_replay_rebuilds_the_queue(self):
+        service = make_service()
+        counter = make_counter(service, 'Counter A')
+        with override_settings(EVENT_LOG_DIR=self.directory, EVENT_LOG_SYNC_INTERVAL=0):
+            self.join(service, 3)
+            login_staff(self.client, counter)
+            self.client.post(reverse('start_serving'))
+            first = QueueEntry.objects.get(current_status='serving').queue_id
+            self.client.post(reverse('announce_patient'), {'queue_id': first})
+            self.client.post(reverse('serve_next'))
+            self.client.post(reverse('update_counter_status'), {'status': 'break'})
+
+        state, snapshot, replayed = eventlog.replay(self.directory)
+        self.assertIsNone(snapshot)
+        # Three joins, a call, an announcement, a completion and the next call, the break
+        self.assertEqual(replayed, 8)
+        live = QueueEntry.objects.order_by('ticket_number')
+        self.assertEqual(state.live_queue(), {counter.counter_id: {
+            'serving': [entry.queue_id for entry in live if entry.current_status == 'serving'],
+            'waiting': [entry.queue_id for entry in live if entry.current_status == 'waiting'],
+        }})
+        stats = state.counter_stats()[counter.counter_id]
+        self.assertEqual((stats['joined'], stats['completed'], stats['announced'], stats['waits']), (3, 1, 1, 2))
+        self.assertEqual(state.counter_status, {counter.counter_id: 'break'})
+
+    def test_restore_writes_lost_changes_back(self):
+        service = make_service()
+        counter = make_counter(service, 'Counter A')
+        with override_settings(EVENT_LOG_DIR=self.directory, EVENT_LOG_SYNC_INTERVAL=0):
+            login_staff(self.client, counter)
+            self.join(service, 3)
+            self.client.post(reverse('start_serving'))
+            self.client.post(reverse('serve_next'))
+        fields = ('queue_id', 'counter_id', 'current_status', 'ticket_number')
+        live = list(QueueEntry.objects.order_by('ticket_number').values_list(*fields))
+        counter.refresh_from_db()
+        figures = (counter.current_status, counter.waiting_count, counter.serving_ticket, counter.last_ticket)
+        completed = QueueHistory.objects.get()
+
+        # Lose the closure, the call and the last join, as a crash before a write-behind flush would
+        QueueHistory.objects.all().delete()
+        QueueEntry.objects.create(queue_id=completed.queue_id, patient_id=completed.patient_id, service=service,
+                                  counter=counter, current_status='serving', ticket_number=1)
+        QueueEntry.objects.filter(queue_id=live[0][0]).update(current_status='waiting', started_at=None)
+        QueueEntry.objects.filter(queue_id=live[1][0]).delete()
+        Counter.objects.filter(pk=counter.pk).update(current_status='available', waiting_count=0, serving_ticket=0)
+
+        counts = eventlog.restore(eventlog.replay(self.directory)[0])
+        self.assertEqual((counts['closed'], counts['updated'], counts['created']), (1, 1, 1))
+        self.assertEqual(list(QueueEntry.objects.order_by('ticket_number').values_list(*fields)), live)
+        self.assertEqual(QueueHistory.objects.get().queue_id, completed.queue_id)
+        counter.refresh_from_db()
+        self.assertEqual(
+            (counter.current_status, counter.waiting_count, counter.serving_ticket, counter.last_ticket), figures
+        )
+
+    def test_writing_needs_posix(self):
+        with mock.patch.object(eventlog, 'fcntl', None):
+            with self.assertRaises(ImproperlyConfigured):
+                eventlog.EventLog(self.directory)
+
+    def test_replay_starts_from_the_latest_snapshot(self):
+        log = eventlog.EventLog(self.directory, sync_interval=0)
+        log.append(self.events(50))
+        seq, _ = eventlog.take_snapshot(self.directory)
+        self.assertEqual(seq, 50)
+        log.append(self.events(20, start=50))
+        log.close()
+
+        state, snapshot, replayed = eventlog.replay(self.directory)
+        self.assertIsNotNone(snapshot)
+        self.assertEqual((replayed, state.seq, len(state.tickets)), (20, 70, 70))
+        self.assertEqual(state.counter_stats()[1]['joined'], 70)
+
+        os.remove(snapshot)
+        full, _, replayed = eventlog.replay(self.directory)
+        self.assertEqual(replayed, 70)
+        self.assertEqual(json.dumps(full.to_dict()), json.dumps(state.to_dict()))
+
+
+
+class EventLogOrderTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        patcher = mock.patch.object(eventlog, '_log', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: eventlog._log and eventlog._log.close())
+        self.counter = make_counter(make_service(), 'Counter A')
+        self.entries = [make_entry(self.counter, f'{9000000000 + i}') for i in range(3)]
+
+    def test_interleaved_transitions_are_logged_in_commit_order(self):
+        record = eventlog.record
+        held = threading.Event()
+
+        def slow_record(events):
+            # Hold up the first append so the other transition reaches the counter in the meantime
+            if events[0].kind != eventlog.JOIN and not held.is_set():
+                held.set()
+                time_module.sleep(0.3)
+            record(events)
+
+        errors = []
+
+        def worker():
+            try:
+                transitions.serve_next(self.counter.counter_id)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        with override_settings(EVENT_LOG_DIR=self.directory, EVENT_LOG_SYNC_INTERVAL=0), \
+                mock.patch.object(eventlog, 'record', slow_record):
+            for entry in self.entries:
+                eventlog.log_join(entry)
+            threads = [threading.Thread(target=worker) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        state = eventlog.replay(self.directory)[0]
+        live = QueueEntry.objects.order_by('ticket_number', 'created_at')
+        self.assertEqual(state.live_queue(), {self.counter.counter_id: {
+            'serving': [entry.queue_id for entry in live if entry.current_status == 'serving'],
+            'waiting': [entry.queue_id for entry in live if entry.current_status == 'waiting'],
+        }})
+        self.assertEqual(list(state.closed), [self.entries[0].queue_id])
@@ -0,0 +1,92 @@
+# queue_app/tickets.py
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import TicketSequence
+
+DEFAULT_BLOCK_SIZE = 20
+
+
+# Ticket numbering
+#
+# Queue ids read '<service><service id>-<yymmdd>-<number>', e.g.
+# OPD3-250826-042. The number counts up per service and day in
+# TicketSequence, so an id is unique without looking at the queue and a join
+# never retries. Each worker process reserves a block of numbers at a time
+# and hands them out from memory, so joins reach the sequence once every
+# TICKET_BLOCK_SIZE patients; numbers still in a block when a worker stops
+# are skipped. A block is reserved in its own transaction and committed
+# straight away. Called inside another transaction, which could still roll
+# the reservation back, a single number is taken as part of it instead.
+
+def queue_id_prefix(service):
+    letters = ''.join(char for char in service.service_name.upper() if char.isalnum())[:3] or 'Q'
+    return f"{letters}{service.service_id}"
+
+
+def format_queue_id(service, day, number):
+    return f"{queue_id_prefix(service)}-{day:%y%m%d}-{number:03d}"
+
+
+def reserve(service_id, day, count):
+    """Reserve the next `count` numbers of a service's sequence for `day`; returns the first"""
+    with transaction.atomic():
+        sequence = TicketSequence.objects.filter(service_id=service_id, date=day)
+        if not sequence.update(last_number=F('last_number') + count):
+            try:
+                with transaction.atomic():
+                    TicketSequence.objects.create(service_id=service_id, date=day, last_number=count)
+                return 1
+            except IntegrityError:
+                # Another worker started the day's sequence first
+                sequence.update(last_number=F('last_number') + count)
+        # The update holds the row until commit, so this is still our block's end
+        return sequence.values_list('last_number', flat=True).get() - count + 1
+
+
+class TicketAllocator:
+    """Hands out ticket numbers from blocks reserved for this process"""
+
+    def __init__(self, block_size=None):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        # (service_id, day) -> [next number, last number]
+        self._blocks = {}
+
+    def reset(self):
+        """Drop the reserved blocks; their unused numbers are skipped"""
+        with self._lock:
+            self._blocks = {}
+
+    def next_number(self, service_id, day=None):
+        day = day or timezone.localdate()
+        if connection.in_atomic_block:
+            return reserve(service_id, day, 1)
+
+        with self._lock:
+            block = self._blocks.get((service_id, day))
+            if block is None or block[0] > block[1]:
+                size = self.block_size or getattr(settings, 'TICKET_BLOCK_SIZE', DEFAULT_BLOCK_SIZE)
+                first = reserve(service_id, day, size)
+                # Earlier days' blocks will never be used again
+                self._blocks = {key: value for key, value in self._blocks.items() if key[1] == day}
+                block = self._blocks[(service_id, day)] = [first, first + size - 1]
+            number = block[0]
+            block[0] += 1
+        return number
+
+    def next_queue_id(self, service, day=None):
+        day = day or timezone.localdate()
+        return format_queue_id(service, day, self.next_number(service.service_id, day))
+
+
+allocator = TicketAllocator()
+
+
+def next_queue_id(service):
+    """A new, unique queue id for a patient joining `service` today"""
+    return allocator.next_queue_id(service)
@@ -0,0 +1,269 @@
+# queue_app/transitions.py
+import heapq
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import analytics, estimates, eventlog, patient_updates
+from .assignment import lock_service, open_counters
+from .models import Counter, QueueEntry, QueueHistory
+
+# Patients are skipped once they have been announced this many times
+MAX_ANNOUNCEMENTS = 3
+
+
+# Queue transitions
+#
+# Every serve/skip/announce/start on a counter runs in one transaction that
+# first locks the counter row, so a double click or two open tabs are applied
+# one after the other instead of both promoting the same patient. Every
+# patient whose status or place in line changed is pushed their new state
+# (patient_updates.py), sent once the transaction commits. The events go to
+# the event log while the lock is held, so it has them in commit order.
+
+def lock_counter(counter_id):
+    """Lock the counter row for the rest of the transaction and return it"""
+    if connection.features.has_select_for_update:
+        return Counter.objects.select_for_update().get(pk=counter_id)
+    # SQLite has no row locks; writing first takes the database write lock up front instead
+    Counter.objects.filter(pk=counter_id).update(updated_at=timezone.now())
+    return Counter.objects.get(pk=counter_id)
+
+
+def issue_ticket(counter_id):
+    """Take the next ticket number at a counter for a new waiting patient (call inside a transaction)"""
+    Counter.objects.filter(pk=counter_id).update(
+        last_ticket=F('last_ticket') + 1,
+        waiting_count=F('waiting_count') + 1
+    )
+    return Counter.objects.filter(pk=counter_id).values_list('last_ticket', flat=True).get()
+
+
+def _release_waiting(counter_id, count=1):
+    # Clamped so a count that drifted (e.g. entries deleted in the admin) cannot go negative
+    Counter.objects.filter(pk=counter_id).update(waiting_count=Greatest(F('waiting_count') - count, 0))
+
+
+def _set_counter_status(counter, status, now):
+    if counter.current_status != status:
+        Counter.objects.filter(pk=counter.pk).update(current_status=status, status_updated_at=now, updated_at=now)
+        counter.current_status = status
+
+
+def _close_entries(entries, status, now):
+    """Move entries into QueueHistory with the given status and drop them from the live queue"""
+    QueueHistory.objects.bulk_create([
+        QueueHistory(
+            queue_id=entry.queue_id,
+            patient_id=entry.patient_id,
+            service_id=entry.service_id,
+            counter_id=entry.counter_id,
+            current_status=status,
+            skipped_at=now if status == 'skipped' else None,
+            created_at=entry.created_at,
+            updated_at=now,
+            date=timezone.localdate(now),
+            started_at=entry.started_at,
+            completed_at=now
+        )
+        for entry in entries
+    ])
+    QueueEntry.objects.filter(pk__in=[entry.pk for entry in entries]).delete()
+
+    # Feed the service-time averages and the analytics once the history rows are durable
+    for entry in entries:
+        transaction.on_commit(
+            lambda entry=entry: estimates.record_completion(entry.counter_id, entry.service_id, now)
+        )
+    closures = [
+        (entry.service_id, entry.counter_id, status, entry.created_at, entry.started_at, now)
+        for entry in entries
+    ]
+    transaction.on_commit(lambda: analytics.record_closures(closures))
+
+
+def _next_waiting(counter_id):
+    return QueueEntry.objects.filter(
+        counter_id=counter_id,
+        current_status='waiting'
+    ).select_related('patient').order_by('ticket_number', 'created_at').first()
+
+
+def _start(counter, entry, now):
+    QueueEntry.objects.filter(pk=entry.pk).update(current_status='serving', started_at=now, updated_at=now)
+    entry.current_status = 'serving'
+    entry.started_at = now
+    # Move the now-serving cursor along with the status
+    Counter.objects.filter(pk=counter.pk).update(
+        current_status='busy',
+        serving_ticket=entry.ticket_number,
+        waiting_count=Greatest(F('waiting_count') - 1, 0),
+        status_updated_at=now,
+        updated_at=now
+    )
+    counter.current_status = 'busy'
+    counter.serving_ticket = entry.ticket_number
+
+
+def _promote_next(counter, now):
+    """Start serving the counter's longest-waiting patient; the counter is available if there is none"""
+    next_entry = _next_waiting(counter.pk)
+    if next_entry:
+        _start(counter, next_entry, now)
+    else:
+        _set_counter_status(counter, 'available', now)
+    return next_entry
+
+
+def _serving_entries(counter_id, queue_id=None):
+    entries = QueueEntry.objects.filter(counter_id=counter_id, current_status='serving').select_related('patient')
+    if queue_id is not None:
+        entries = entries.filter(queue_id=queue_id)
+    return list(entries)
+
+
+def serve_next(counter_id):
+    """
+    Complete whoever the counter is serving and promote the next waiting patient.
+    Returns (counter, completed_entries, next_entry).
+    """
+    with transaction.atomic():
+        counter = lock_counter(counter_id)
+        now = timezone.now()
+        # Normally at most one, but close every stray serving row so the invariant heals itself
+        completed = _serving_entries(counter_id)
+        if completed:
+            _close_entries(completed, 'completed', now)
+            patient_updates.push_closed(counter, completed, 'completed')
+        next_entry = _promote_next(counter, now)
+        patient_updates.push_counter(counter)
+        eventlog.log_serve(counter, completed, next_entry)
+    return counter, completed, next_entry
+
+
+def skip_patient(counter_id, queue_id):
+    """
+    Skip the patient the counter is serving and promote the next one.
+    Returns (counter, skipped_entry, next_entry); skipped_entry is None if
+    queue_id is not being served at this counter.
+    """
+    with transaction.atomic():
+        counter = lock_counter(counter_id)
+        serving = _serving_entries(counter_id, queue_id)
+        if not serving:
+            return counter, None, None
+        now = timezone.now()
+        _close_entries(serving, 'skipped', now)
+        patient_updates.push_closed(counter, serving, 'skipped')
+        next_entry = _promote_next(counter, now)
+        patient_updates.push_counter(counter)
+        eventlog.log_skip(counter, serving[0], next_entry)
+    return counter, serving[0], next_entry
+
+
+def start_serving(counter_id):
+    """
+    Start serving the next waiting patient if the counter is idle.
+    Returns (counter, already_serving, next_entry).
+    """
+    with transaction.atomic():
+        counter = lock_counter(counter_id)
+        serving = _serving_entries(counter_id)
+        if serving:
+            return counter, serving[0], None
+        next_entry = _next_waiting(counter_id)
+        if next_entry:
+            _start(counter, next_entry, timezone.now())
+            patient_updates.push_counter(counter)
+            eventlog.log_start(counter, next_entry)
+    return counter, None, next_entry
+
+
+def announce_patient(counter_id, queue_id):
+    """
+    Count an announcement for the serving patient, skipping them after
+    MAX_ANNOUNCEMENTS. Returns (counter, entry, skipped, next_entry); entry is
+    None if queue_id is not being served at this counter.
+    """
+    with transaction.atomic():
+        counter = lock_counter(counter_id)
+        serving = _serving_entries(counter_id, queue_id)
+        if not serving:
+            return counter, None, False, None
+
+        entry = serving[0]
+        now = timezone.now()
+        entry.announcement_count += 1
+        if entry.announcement_count < MAX_ANNOUNCEMENTS:
+            QueueEntry.objects.filter(pk=entry.pk).update(announcement_count=entry.announcement_count, updated_at=now)
+            # Nobody else's place changed
+            patient_updates.push_entries(counter, [entry])
+            eventlog.log_announce(counter, entry, False, None)
+            return counter, entry, False, None
+
+        _close_entries([entry], 'skipped', now)
+        patient_updates.push_closed(counter, [entry], 'skipped')
+        next_entry = _promote_next(counter, now)
+        patient_updates.push_counter(counter)
+        eventlog.log_announce(counter, entry, True, next_entry)
+    return counter, entry, True, next_entry
+
+
+def redistribute_waiting(counter_id):
+    """
+    Move everyone waiting at a counter to the other open counters of its
+    service, in ticket order, each to whichever queue is shortest at that
+    point. Returns [(entry, new_counter)]; empty if nobody could be moved.
+    """
+    with transaction.atomic():
+        counter = lock_counter(counter_id)
+        # Joins take the service lock too, so the targets' tickets cannot move under the plan
+        lock_service(counter.service_id)
+        entries = list(
+            QueueEntry.objects.filter(counter_id=counter_id, current_status='waiting')
+            .select_related('patient').order_by('ticket_number', 'created_at')
+        )
+        targets = {target.counter_id: target for target in open_counters(counter.service_id, exclude=[counter_id])}
+        if not entries or not targets:
+            return []
+
+        # Plan in memory: always hand the next patient to the shortest queue
+        shortest = [(target.waiting_count, target_id) for target_id, target in targets.items()]
+        heapq.heapify(shortest)
+        issued = dict.fromkeys(targets, 0)
+        now = timezone.now()
+        moves = []
+        for entry in entries:
+            waiting, target_id = heapq.heappop(shortest)
+            target = targets[target_id]
+            issued[target_id] += 1
+            entry.counter = target
+            entry.ticket_number = target.last_ticket + issued[target_id]
+            moves.append((entry, target))
+            heapq.heappush(shortest, (waiting + 1, target_id))
+
+        QueueEntry.objects.bulk_update(entries, ['counter', 'ticket_number'])
+        QueueEntry.objects.filter(pk__in=[entry.pk for entry in entries]).update(updated_at=now)
+        for target_id, count in issued.items():
+            if count:
+                Counter.objects.filter(pk=target_id).update(
+                    last_ticket=F('last_ticket') + count,
+                    waiting_count=F('waiting_count') + count
+                )
+        _release_waiting(counter_id, len(entries))
+
+        # Moved patients join the back of their new queues, so only they need telling
+        patient_updates.push_moves(moves)
+        eventlog.log_moves(moves)
+    return moves
+
+
+def set_counter_status(counter_id, status):
+    """Set a counter's status (available, busy or break) from its dashboard. Returns the counter."""
+    with transaction.atomic():
+        counter = lock_counter(counter_id)
+        _set_counter_status(counter, status, timezone.now())
+        eventlog.log_status(counter, status)
+    return counter
@@ -15,6 +15,7 @@ urlpatterns = [
     # OTP URLs
     path('api/send-otp/', views.send_otp_view, name='send_otp'),
     path('api/verify-otp/', views.verify_otp_view, name='verify_otp'),
+    path('api/otp-status/<str:delivery_id>/', views.otp_delivery_status, name='otp_delivery_status'),
     
     # Patient Flow URLs
     path('staff/announce_patient/', views.announce_patient, name='announce_patient'),
@@ -32,6 +33,8 @@ urlpatterns = [
     path('staff/serve_next/', views.serve_next, name='serve_next'),
     path('staff/handle_break/', views.handle_counter_break, name='handle_break'),
     path('staff/start_serving/', views.start_serving, name='start_serving'),
+    path('staff/analytics/service/<int:service_id>/', views.service_analytics, name='service_analytics'),
+    path('staff/analytics/counter/<int:counter_id>/', views.counter_analytics, name='counter_analytics'),
     
     path('ws/queue/updates/', consumers.QueueUpdatesConsumer.as_asgi()),
     # Display Screen URL
@@ -46,4 +49,6 @@ urlpatterns = [
     path('debug/counters/', views.debug_counters, name='debug_counters'),
     path('staff/debug_session/', views.debug_session, name='debug_session'),
     path('debug/staff_counters/', views.debug_staff_counters, name='debug_staff_counters'),
+    path('debug/outbox/', views.debug_outbox, name='debug_outbox'),
+    path('metrics', views.prometheus_metrics, name='metrics'),
 ]
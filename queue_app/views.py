@@ -6,26 +6,92 @@ from django.contrib.auth import authenticate, login
 from django.conf import settings
 from django.contrib.auth import login
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from .models import Patient, OTP, Service, QueueEntry, Counter, QueueHistory, Staff
-from .utils import send_otp
-import string
+from .sms import get_delivery_status, send_otp
+from .utils import generate_queue_id
+from . import analytics, eventlog, otp_store, ratelimit
+from .metrics import registry
+from .principals import aget_request_principal, get_request_principal
+from . import transitions
+from .engine import AlreadyQueued, after_write, live_engine, queue_transitions
+from .assignment import assign_counter
+from .estimates import estimate_wait_minutes
+from .notifications import notify_counter, notify_service
+from .patient_updates import apatient_status, queue_position
+from .outbox import outbox
+from .board import aget_board_payload, aget_counter_version, build_board_snapshot, publish_board_change
 from datetime import date
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.views.decorators.http import require_POST
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.views.decorators.cache import cache_control
 from django.contrib.humanize.templatetags.humanize import naturaltime
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, iscoroutinefunction
 import logging
 import uuid
 import time 
-from django.db.models import Count, Q
+from django.db import transaction
 logger = logging.getLogger(__name__)
 from functools import wraps
 from django.http import JsonResponse
 
+# Async views
+#
+# The endpoints every open page polls (get_queue_data, display_screen_data,
+# get_queue_status) are async views, so under Daphne they wait on the
+# database in the event loop instead of each holding the sync thread for the
+# whole request. Their queries go through the async ORM, sessions through the
+# async session API and the cache through its async API (a database or Redis
+# cache blocks like any query). They compute their ETags themselves: @condition
+# calls its etag_func synchronously, on the event loop.
+
+def _not_modified(request, etag):
+    """The 304 for a request whose If-None-Match still matches etag (already quoted), else None"""
+    return get_conditional_response(request, etag=etag)
+
+
+def _tagged(request, response, etag):
+    if request.method in ('GET', 'HEAD'):
+        response.headers.setdefault('ETag', etag)
+    return response
+
+
+def _staff_counter(request, counter):
+    # Verify this staff member is assigned to a counter
+    if counter is None:
+        return JsonResponse({
+            'status': 'error', 
+            'message': 'No counter assigned to staff'
+        }, status=403)
+    request.counter = counter
+    return None
+
+
 def validate_staff_session(view_func):
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def _wrapped_async_view(request, *args, **kwargs):
+            session = request.session
+            if not await session.ahas_key('staff_id'):
+                return JsonResponse({'status': 'error', 'message': 'Session expired'}, status=401)
+            if not await session.aget('session_unique'):
+                await session.aflush()
+                return JsonResponse({'status': 'error', 'message': 'Invalid session'}, status=401)
+            if getattr(request, 'tab_conflict', False):
+                return JsonResponse({'status': 'error', 'message': 'Logged in from another tab'}, status=401)
+            try:
+                staff, counter = await aget_request_principal(request)
+            except Staff.DoesNotExist:
+                await session.aflush()
+                return JsonResponse({'status': 'error', 'message': 'Invalid session'}, status=401)
+            request.staff = staff
+            return _staff_counter(request, counter) or await view_func(request, *args, **kwargs)
+        return _wrapped_async_view
+
     @wraps(view_func)
     def _wrapped_view(request, *args, **kwargs):
         if 'staff_id' not in request.session:
@@ -36,30 +102,22 @@ def validate_staff_session(view_func):
             request.session.flush()
             return JsonResponse({'status': 'error', 'message': 'Invalid session'}, status=401)
         
-        # Verify staff exists
+        # Another tab logged in since this tab did (see SessionTabIsolationMiddleware)
+        if getattr(request, 'tab_conflict', False):
+            return JsonResponse({'status': 'error', 'message': 'Logged in from another tab'}, status=401)
+        
+        # Verify staff exists (cached per session, see principals.py)
         try:
-            staff = Staff.objects.get(staff_id=request.session['staff_id'])
-            request.staff = staff
-            
-            # Verify this staff member is assigned to a counter
-            try:
-                counter = Counter.objects.get(staff=staff)
-                request.counter = counter
-            except Counter.DoesNotExist:
-                return JsonResponse({
-                    'status': 'error', 
-                    'message': 'No counter assigned to staff'
-                }, status=403)
-                
+            staff, counter = get_request_principal(request)
         except Staff.DoesNotExist:
             request.session.flush()
             return JsonResponse({'status': 'error', 'message': 'Invalid session'}, status=401)
+        request.staff = staff
         
-        return view_func(request, *args, **kwargs)
+        return _staff_counter(request, counter) or view_func(request, *args, **kwargs)
     return _wrapped_view
 
 
-
 @csrf_exempt
 def send_otp_view(request):
     if request.method == 'POST':
@@ -70,6 +128,18 @@ def send_otp_view(request):
         if not phone_number or len(phone_number) != 10 or not phone_number.isdigit():
             return JsonResponse({'status': 'error', 'message': 'Invalid phone number'}, status=400)
         
+        # Throttle before touching the database or the SMS gateway
+        for scope, identifier in (('otp_phone', phone_number), ('otp_ip', ratelimit.client_ip(request))):
+            limit, period = settings.OTP_RATE_LIMITS[scope]
+            allowed, retry_after = ratelimit.hit(scope, identifier, limit, period)
+            if not allowed:
+                response = JsonResponse({
+                    'status': 'error',
+                    'message': f'Too many OTP requests. Try again in {retry_after} seconds.'
+                }, status=429)
+                response['Retry-After'] = str(retry_after)
+                return response
+        
         try:
             # Check if patient exists
             patient = Patient.objects.get(phone_number=phone_number)
@@ -88,31 +158,17 @@ def send_otp_view(request):
             )
             is_new_patient = True
         
-        # Generate OTP
-        otp = str(random.randint(100000, 999999))
-        expires_at = timezone.now() + timedelta(minutes=5)
+        # Generate OTP (replaces any earlier one for this phone)
+        otp = otp_store.issue(phone_number)
         
-        # Store OTP in database
-        OTP.objects.create(
-            phone_number=phone_number,
-            otp=otp,
-            expires_at=expires_at
-        )
-        
-        # Send OTP via SMS using TextLocal
-        sms_sent = False
-        try:
-            from .utils import send_otp
-            sms_sent = send_otp(phone_number, otp)
-        except Exception as e:
-            print(f"SMS sending error: {str(e)}")
-            # Even if there's an error, the OTP is still generated and stored
+        # Queue the SMS; the page polls otp_delivery_status for the outcome
+        delivery_id = send_otp(phone_number, otp)
         
         return JsonResponse({
             'status': 'success',
             'is_new_patient': is_new_patient,
-            'sms_sent': sms_sent,
-            'message': 'OTP sent successfully via SMS' if sms_sent else 'OTP generated but SMS failed. OTP is still valid.'
+            'delivery_id': delivery_id,
+            'message': 'OTP is being sent via SMS'
         })
     
     return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
@@ -123,39 +179,30 @@ def verify_otp_view(request):
         phone_number = request.POST.get('phone_number')
         otp = request.POST.get('otp')
         
-        try:
-            # Use timezone.now() consistently
-            now = timezone.now()
-            otp_record = OTP.objects.filter(
-                phone_number=phone_number,
-                is_used=False,
-                expires_at__gte=now  # Compare with current timezone-aware datetime
-            ).latest('created_at')
+        result = otp_store.verify(phone_number, otp)
+        if result == 'ok':
+            patient = Patient.objects.get(phone_number=phone_number)
+            patient.is_verified = True
+            patient.save()
             
-            if otp_record.otp == otp:
-                otp_record.is_used = True
-                otp_record.save()
-                
-                patient = Patient.objects.get(phone_number=phone_number)
-                patient.is_verified = True
-                patient.save()
-                
-                request.session['patient_phone'] = phone_number
-                return JsonResponse({'status': 'success'})
-            else:
-                return JsonResponse({'status': 'error', 'message': 'Invalid OTP'})
-                
-        except OTP.DoesNotExist:
-            # Add debug logging
-            print(f"No valid OTP found for {phone_number} at {now}")
-            print(f"Existing OTPs: {OTP.objects.filter(phone_number=phone_number).values()}")
-            return JsonResponse({
-                'status': 'error', 
-                'message': 'OTP expired or not found'
-            })
+            request.session['patient_phone'] = phone_number
+            return JsonResponse({'status': 'success'})
+        
+        error_messages = {
+            'invalid': 'Invalid OTP',
+            'expired': 'OTP expired or not found',
+            'locked': 'Too many wrong attempts. Please request a new OTP.'
+        }
+        return JsonResponse({'status': 'error', 'message': error_messages[result]})
     
     return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
 
+def otp_delivery_status(request, delivery_id):
+    delivery = get_delivery_status(delivery_id)
+    if delivery is None:
+        return JsonResponse({'status': 'error', 'message': 'Unknown delivery'}, status=404)
+    return JsonResponse({'status': 'success', 'delivery': delivery})
+
 def patient_login(request):
     return render(request, 'patient_login.html')
 
@@ -164,11 +211,19 @@ def patient_dashboard(request):
         return redirect('patient_login')
     
     patient = Patient.objects.get(phone_number=request.session['patient_phone'])
-    queue_entry = QueueEntry.objects.filter(patient=patient, current_status__in=['waiting', 'serving']).first()
+    queue_entry = QueueEntry.objects.filter(
+        patient=patient,
+        current_status__in=['waiting', 'serving']
+    ).select_related('counter', 'service').first()
+    position = get_position_in_queue(queue_entry)
     
     return render(request, 'patient_dashboard.html', {
         'patient': patient,
-        'queue_entry': queue_entry
+        'queue_entry': queue_entry,
+        'position': position,
+        'estimated_wait_minutes': estimate_wait_minutes(
+            position, queue_entry.counter_id, queue_entry.counter.service_id
+        ) if position else None
     })
 
 @ensure_csrf_cookie
@@ -182,15 +237,8 @@ def service_selection(request):
         'services': available_services
     })
 
-def generate_queue_id(service, counter=None):
-    prefix = service.service_name[:3].upper()
-    counter_num = counter.counter_id if counter else "000"
-    random_part = ''.join(random.choices(string.digits, k=4))
-    return f"{prefix}_{counter_num}_{random_part}"
-
 @csrf_exempt
 def join_queue(request):
-    print("--- Starting join_queue function ---")
     if 'patient_phone' not in request.session:
         return JsonResponse({'status': 'error', 'message': 'Not authenticated'}, status=401)
     
@@ -203,66 +251,44 @@ def join_queue(request):
             return JsonResponse({'status': 'error', 'message': 'Service ID required'}, status=400)
         
         patient = Patient.objects.get(phone_number=request.session['patient_phone'])
+        engine = live_engine()
         
         # Check if already in queue
-        if QueueEntry.objects.filter(patient=patient, current_status__in=['waiting', 'serving']).exists():
+        if engine:
+            already_queued = engine.live_ticket(patient.phone_number) is not None
+        else:
+            already_queued = QueueEntry.objects.filter(patient=patient, current_status__in=['waiting', 'serving']).exists()
+        if already_queued:
             return JsonResponse({'status': 'error', 'message': 'You are already in queue'}, status=400)
         
         service = Service.objects.get(service_id=service_id, is_active=True)
         
-        # FIXED: Remove is_active filter since Counter model doesn't have this field
-        counter = Counter.objects.filter(
-            service=service,
-            current_status__in=['available', 'busy']  # Only available/busy counters
-        ).annotate(
-            waiting_count=Count('queueentry', filter=Q(queueentry__current_status='waiting'))
-        ).order_by('waiting_count', 'counter_id').first()
-
-        if not counter:
-            return JsonResponse({'status': 'error', 'message': 'No counters available for this service'}, status=400)
-        
-        print(f"DEBUG: Selected counter: {counter.counter_name} with {getattr(counter, 'waiting_count', 0)} waiting patients")
-        
-        # Generate unique queue ID
-        queue_id = f"{service.service_name[:3].upper()}_{counter.counter_id}_{random.randint(1000, 9999)}"
+        # Taken before the transaction, so it comes from this worker's reserved block
+        queue_id = generate_queue_id(service)
         
-        # Create queue entry
-        QueueEntry.objects.create(
-            queue_id=queue_id,
-            patient=patient,
-            service=service,
-            counter=counter,
-            current_status='waiting'
-        )
-        
-        # Update counter status if it was available
-        if counter.current_status == 'available':
-            counter.current_status = 'busy'
-            counter.save()
-            print(f"DEBUG: Updated counter {counter.counter_name} status to 'busy'")
+        if engine:
+            # Assigned, numbered and marked busy in memory
+            try:
+                entry = engine.join(patient, service, queue_id)
+            except AlreadyQueued:
+                return JsonResponse({'status': 'error', 'message': 'You are already in queue'}, status=400)
+        else:
+            entry = _join_counter(patient, service, queue_id)
+        if not entry:
+            return JsonResponse({'status': 'error', 'message': 'No counters available for this service'}, status=400)
         
-        # Send WebSocket notification
-        try:
-            from channels.layers import get_channel_layer
-            from asgiref.sync import async_to_sync
-            
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                "staff_updates",
-                {
-                    "type": "send_update",
-                    "message": {
-                        "action": "new_patient",
-                        "queue_id": queue_id,
-                        "patient_name": patient.name,
-                        "service_name": service.service_name,
-                        "counter_name": counter.counter_name,
-                        "timestamp": str(timezone.now())
-                    }
-                }
-            )
-        except Exception as ws_error:
-            print(f"WebSocket error: {ws_error}")
+        counter = entry.counter
+        after_write(publish_board_change, 'join', counter.counter_id)
+        
+        # Notify only the staff of the assigned counter, once their queue data has the patient
+        after_write(notify_counter, counter.counter_id, {
+            "action": "new_patient",
+            "queue_id": queue_id,
+            "patient_name": patient.name,
+            "service_name": service.service_name,
+            "counter_name": counter.counter_name,
+            "timestamp": str(timezone.now())
+        })
         
         return JsonResponse({
             'status': 'success',
@@ -271,21 +297,39 @@ def join_queue(request):
         })
         
     except Exception as e:
-        print(f"join_queue error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("join_queue.failed")
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
-       
-def calculate_wait_time():
-    """Calculate average wait time based on queue length"""
-    from django.db.models import Avg
-    from datetime import timedelta
-    avg_wait = QueueHistory.objects.filter(
-        completed_at__gte=timezone.now()-timedelta(hours=1)
-    ).aggregate(Avg('completed_at'-'created_at'))['created_at__avg']
-    return avg_wait.total_seconds() / 60 if avg_wait else 5  # Default 5 minutes
 
 
+def _join_counter(patient, service, queue_id):
+    """Queue the patient at the counter assign_counter picks; returns the new entry, or None if no counter is open"""
+    # Pick a counter and take its next ticket in one transaction, so
+    # concurrent joins see each other's waiting counts
+    with transaction.atomic():
+        counter = assign_counter(service.service_id)
+        if not counter:
+            return None
+        
+        logger.debug("join_queue.assigned counter=%s waiting=%s", counter.counter_id, counter.waiting_count)
+        
+        entry = QueueEntry.objects.create(
+            queue_id=queue_id,
+            patient=patient,
+            service=service,
+            counter=counter,
+            current_status='waiting',
+            ticket_number=transitions.issue_ticket(counter.counter_id)
+        )
+        # Logged while the counter row is locked by the ticket update, as the transitions do
+        eventlog.log_join(entry)
+    
+    # Update counter status if it was available
+    if counter.current_status == 'available':
+        counter.current_status = 'busy'
+        counter.save(update_fields=['current_status', 'status_updated_at', 'updated_at'])
+        logger.debug("counter.status counter=%s status=busy", counter.counter_id)
+    return entry
+       
 from django.contrib.auth.hashers import check_password
 
 
@@ -343,9 +387,7 @@ def staff_login(request):
                     except:
                         pass
                 
-                print(f"LOGIN DEBUG: New Session Key: {request.session.session_key}")
-                print(f"LOGIN DEBUG: Staff ID: {staff.staff_id}, Username: {staff.username}")
-                print(f"LOGIN DEBUG: Tab ID: {tab_id}")
+                logger.info("staff.login staff=%s username=%s tab=%s", staff.staff_id, staff.username, tab_id)
                 
                 return redirect('staff_dashboard')
             else:
@@ -363,19 +405,15 @@ from .models import Counter, QueueEntry, Staff
 def staff_dashboard(request):
     try:
         staff = request.staff
-        counter = Counter.objects.get(staff=staff)
+        counter = Counter.objects.select_related('service').get(pk=request.counter.counter_id)
         
-        # DEBUG: Print session information
-        print(f"SESSION DEBUG: Session Key: {request.session.session_key}")
-        print(f"SESSION DEBUG: Staff ID in session: {request.session.get('staff_id')}")
-        print(f"SESSION DEBUG: Session Unique: {request.session.get('session_unique')}")
-        print(f"SESSION DEBUG: Actual staff: {staff.staff_id}, Counter: {counter.counter_name}")
+        logger.debug("staff_dashboard staff=%s counter=%s", staff.staff_id, counter.counter_id)
         
         # Only show patients assigned to THIS specific counter
         queue_entries = QueueEntry.objects.filter(
             counter=counter,
             current_status='waiting'
-        ).order_by('created_at')
+        ).order_by('ticket_number', 'created_at')
         
         # Only show patient being served by THIS counter
         serving_patient = QueueEntry.objects.filter(
@@ -420,58 +458,23 @@ def serve_next(request):
         return JsonResponse({'status': 'error', 'message': 'Not authenticated'}, status=401)
     
     try:
-        staff = request.staff
-        counter = Counter.objects.get(staff=staff)
-        
-        # Complete current serving patient if exists - FIXED: Only from THIS counter
-        current_serving = QueueEntry.objects.filter(
-            counter=counter,  # FIXED: Only THIS counter
-            current_status='serving'
-        ).first()
-        
-        if current_serving:
-            # Move to history
-            QueueHistory.objects.create(
-                queue_id=current_serving.queue_id,
-                patient=current_serving.patient,
-                service=current_serving.service,
-                counter=current_serving.counter,
-                current_status='completed',
-                created_at=current_serving.created_at,
-                updated_at=timezone.now(),
-                date=date.today(),
-                completed_at=timezone.now()
-            )
-            current_serving.delete()
-        
-        # FIXED: Get next patient assigned to THIS counter only
-        next_patient = QueueEntry.objects.filter(
-            counter=counter,  # FIXED: Only THIS counter's patients
-            current_status='waiting'
-        ).order_by('created_at').first()
+        # Completes the current patient and promotes the next one atomically
+        counter, completed, next_patient = queue_transitions().serve_next(request.counter.counter_id)
+        after_write(publish_board_change, 'serve', counter.counter_id)
         
         if next_patient:
-            next_patient.current_status = 'serving'
-            next_patient.save()
-            
-            # Update counter status
-            counter.current_status = 'busy'
-            counter.save()
-            
             return JsonResponse({
                 'status': 'success',
                 'patient_name': next_patient.patient.name,
                 'queue_id': next_patient.queue_id
             })
         else:
-            # No more patients, mark counter as available
-            counter.current_status = 'available'
-            counter.save()
             return JsonResponse({'status': 'empty', 'message': 'No patients in queue'})
             
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
+
 @validate_staff_session
 @csrf_exempt
 @require_POST
@@ -484,7 +487,6 @@ def update_counter_status(request):
         counter = Counter.objects.get(staff=staff)
 
         new_status = request.POST.get('status')
-        print(f"Update status request for counter {counter.counter_name}: {new_status}")
         
         if new_status not in ['available', 'busy', 'break']:
             return JsonResponse({
@@ -497,10 +499,16 @@ def update_counter_status(request):
             redistribute_patients_on_break(counter)  # Pass the specific counter
         
         # FIXED: Update only THIS counter's status
-        counter.current_status = new_status
-        counter.save()
-        
-        print(f"Counter {counter.counter_id} status updated to {new_status}")
+        counter = queue_transitions().set_counter_status(counter.counter_id, new_status)
+        after_write(publish_board_change, 'status', counter.counter_id)
+        notify_service(counter.service_id, {
+            "action": "counter_status_update",
+            "counter_id": counter.counter_id,
+            "counter_name": counter.counter_name,
+            "current_status": new_status
+        }, key=f"counter_status:{counter.counter_id}")  # Only the latest status matters
+        
+        logger.info("counter.status counter=%s status=%s", counter.counter_id, new_status)
         return JsonResponse({'status': 'success', 'message': 'Status updated'})
         
     except Staff.DoesNotExist:
@@ -530,110 +538,39 @@ def skip_patient(request):
         if not queue_id:
             return JsonResponse({'status': 'error', 'message': 'Queue ID required'}, status=400)
         
-        staff = request.staff  # Use staff from decorator
-        counter = Counter.objects.get(staff=staff)
+        # Only skips a patient being served by THIS counter
+        counter, skipped, next_patient = queue_transitions().skip_patient(request.counter.counter_id, queue_id)
         
-        # FIXED: Only skip patients being served by THIS counter
-        current_serving = QueueEntry.objects.filter(
-            counter=counter,  # FIXED: Only THIS counter
-            current_status='serving',
-            queue_id=queue_id
-        ).first()
+        if not skipped:
+            return JsonResponse({'status': 'error', 'message': 'No matching patient being served'})
         
-        if current_serving:
-            # Move to history as skipped
-            QueueHistory.objects.create(
-                queue_id=current_serving.queue_id,
-                patient=current_serving.patient,
-                service=current_serving.service,
-                counter=counter,
-                current_status='skipped',
-                skipped_at=timezone.now(),
-                created_at=current_serving.created_at,
-                updated_at=timezone.now(),
-                date=timezone.now().date(),
-                completed_at=timezone.now()
-            )
-            current_serving.delete()
-            
-            # FIXED: Get next patient from THIS counter only
-            next_patient = QueueEntry.objects.filter(
-                counter=counter,  # FIXED: Only THIS counter
-                current_status='waiting'
-            ).order_by('created_at').first()
-            
-            if next_patient:
-                next_patient.current_status = 'serving'
-                next_patient.save()
-                return JsonResponse({'status': 'success', 'message': 'Patient skipped'})
-            else:
-                counter.current_status = 'available'
-                counter.save()
-                return JsonResponse({'status': 'success', 'message': 'Patient skipped, no more in queue'})
+        after_write(publish_board_change, 'skip', counter.counter_id)
+        if next_patient:
+            return JsonResponse({'status': 'success', 'message': 'Patient skipped'})
         else:
-            return JsonResponse({'status': 'error', 'message': 'No matching patient being served'})
+            return JsonResponse({'status': 'success', 'message': 'Patient skipped, no more in queue'})
             
     except Exception as e:
-        print(f"skip_patient error: {str(e)}")
+        logger.exception("skip_patient.failed")
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
 
 def display_screen(request):
     """Display screen showing all counters in tabular format"""
-    counters = Counter.objects.filter(is_active=True).order_by('counter_id')
-    
-    # Get currently serving patients for each counter
-    serving_data = {}
-    for counter in counters:
-        serving_patient = QueueEntry.objects.filter(
-            counter=counter,
-            current_status='serving'
-        ).select_related('patient').first()
-        
-        if serving_patient:
-            serving_data[counter.counter_id] = {
-                'queue_id': serving_patient.queue_id,
-                'patient_name': serving_patient.patient.name,
-                'service_name': serving_patient.service.service_name,
-                'announcement_count': serving_patient.announcement_count
-            }
-    
     return render(request, 'display_screen.html', {
-        'counters': counters,
-        'serving_data': serving_data,
+        'counters': build_board_snapshot(),
         'current_time': timezone.now().strftime('%Y-%m-%d %H:%M:%S')
     })
 
 
 @csrf_exempt
-def display_screen_data(request):
-    """API endpoint for display screen data"""
-    counters = Counter.objects.filter(is_active=True).order_by('counter_id')
-    
-    counter_data = []
-    for counter in counters:
-        serving_patient = QueueEntry.objects.filter(
-            counter=counter,
-            current_status='serving'
-        ).select_related('patient', 'service').first()
-        
-        counter_data.append({
-            'counter_id': counter.counter_id,
-            'counter_name': counter.counter_name,
-            'service_name': counter.service.service_name,
-            'current_status': counter.current_status,
-            'serving_patient': {
-                'queue_id': serving_patient.queue_id,
-                'patient_name': serving_patient.patient.name,
-                'service_name': serving_patient.service.service_name,
-                'announcement_count': serving_patient.announcement_count
-            } if serving_patient else None
-        })
-    
-    return JsonResponse({
-        'counters': counter_data,
-        'timestamp': timezone.now().isoformat()
-    })
+@cache_control(no_cache=True)
+async def display_screen_data(request):
+    """API endpoint for display screen data, answered from the versioned board cache"""
+    version, payload = await aget_board_payload()
+    etag = quote_etag(f"board-{version}")
+    response = _not_modified(request, etag) or HttpResponse(payload, content_type='application/json')
+    return _tagged(request, response, etag)
 
 def home_redirect(request):
     """Redirect to appropriate dashboard based on session"""
@@ -651,33 +588,40 @@ def check_patient(request):
         return JsonResponse({'exists': exists})
     return JsonResponse({'error': 'Invalid phone'}, status=400)
 
+async def counter_etag(request):
+    # naturaltime() waiting times drift, so the tag also rolls over every minute
+    counter_id = request.counter.counter_id
+    return f"counter-{counter_id}-{await aget_counter_version(counter_id)}-{int(time.time() // 60)}"
+
+
 @validate_staff_session
 @csrf_exempt
-def get_queue_data(request):
+@cache_control(no_cache=True)
+async def get_queue_data(request):
     """FIXED: AJAX endpoint for queue updates - Only show data for THIS staff's counter"""
+    etag = quote_etag(await counter_etag(request))
+    return _tagged(request, _not_modified(request, etag) or await _queue_data(request), etag)
+
+
+async def _queue_data(request):
     try:
-        # Use request.staff from the decorator
-        staff = request.staff
-        
-        # FIXED: Get counter using the reverse relationship
-        # The Counter model has a OneToOneField to Staff, so we query Counter
-        counter = Counter.objects.get(staff=staff)
+        # Live status of the session's counter (request.counter is the cached identity)
+        counter = await Counter.objects.select_related('service').aget(pk=request.counter.counter_id)
         
-        print(f"DEBUG: Staff {staff.username}, Counter {counter.counter_name}, Service: {counter.service.service_name}")
         
         # FIXED: Get currently serving patient for THIS counter ONLY
-        serving_patient = QueueEntry.objects.filter(
+        serving_patient = await QueueEntry.objects.filter(
             counter=counter,  # Only THIS counter
             current_status='serving'
-        ).first()
+        ).select_related('patient', 'service').afirst()
         
         # FIXED: Get waiting patients assigned to THIS counter only
-        waiting_patients = QueueEntry.objects.filter(
+        waiting_patients = [entry async for entry in QueueEntry.objects.filter(
             counter=counter,  # Only THIS counter's patients
             current_status='waiting'
-        ).select_related('patient', 'service').order_by('created_at')
+        ).select_related('patient', 'service').order_by('ticket_number', 'created_at')]
         
-        print(f"DEBUG: Found {waiting_patients.count()} waiting patients for counter {counter.counter_name}")
+        logger.debug("get_queue_data counter=%s waiting=%s", counter.counter_id, len(waiting_patients))
         
         response_data = {
             'status': 'success',
@@ -686,7 +630,7 @@ def get_queue_data(request):
             'service_name': counter.service.service_name,
             'serving_patient': None,
             'waiting_patients': [],
-            'queue_count': waiting_patients.count()
+            'queue_count': len(waiting_patients)
         }
         
         # Add waiting patients data
@@ -695,7 +639,7 @@ def get_queue_data(request):
                 'queue_id': patient.queue_id,
                 'name': patient.patient.name,
                 'waiting_time': naturaltime(patient.created_at),
-                'counter_name': patient.counter.counter_name,
+                'counter_name': counter.counter_name,
                 'service_name': patient.service.service_name,
                 'is_my_counter': True,  # All patients shown are from this counter
             })
@@ -715,9 +659,10 @@ def get_queue_data(request):
     except Counter.DoesNotExist:
         return JsonResponse({'status': 'error', 'message': 'No counter assigned to staff'}, status=404)
     except Exception as e:
-        print(f"Error in get_queue_data: {str(e)}")
+        logger.exception("get_queue_data.failed")
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
     
+@validate_staff_session
 @csrf_exempt
 def start_serving(request):
     """FIXED: Start serving the next patient assigned to THIS counter"""
@@ -725,14 +670,7 @@ def start_serving(request):
         return JsonResponse({'status': 'error', 'message': 'Not authenticated'}, status=401)
     
     try:
-        staff = request.staff  # Use staff from decorator
-        counter = Counter.objects.get(staff=staff)
-        
-        # Check if already serving someone
-        currently_serving = QueueEntry.objects.filter(
-            counter=counter,
-            current_status='serving'
-        ).first()
+        counter, currently_serving, next_patient = queue_transitions().start_serving(request.counter.counter_id)
         
         if currently_serving:
             return JsonResponse({
@@ -740,22 +678,9 @@ def start_serving(request):
                 'message': 'Already serving a patient'
             })
         
-        # FIXED: Get next patient assigned to THIS counter only
-        next_patient = QueueEntry.objects.filter(
-            counter=counter,  # FIXED: Only THIS counter's patients
-            current_status='waiting'
-        ).order_by('created_at').first()
-        
         if next_patient:
-            # Mark as serving
-            next_patient.current_status = 'serving'
-            next_patient.save()
-            
-            # Update counter status
-            counter.current_status = 'busy'
-            counter.save()
-            
-            print(f"DEBUG: Started serving {next_patient.patient.name} ({next_patient.queue_id})")
+            after_write(publish_board_change, 'serve', counter.counter_id)
+            logger.debug("start_serving counter=%s queue_id=%s", counter.counter_id, next_patient.queue_id)
             
             return JsonResponse({
                 'status': 'success',
@@ -772,7 +697,7 @@ def start_serving(request):
             })
             
     except Exception as e:
-        print(f"start_serving error: {str(e)}")
+        logger.exception("start_serving.failed")
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
 
@@ -788,77 +713,33 @@ def announce_patient(request):
         if not queue_id:
             return JsonResponse({'status': 'error', 'message': 'Queue ID required'}, status=400)
         
-        staff = request.staff
-        counter = Counter.objects.get(staff=staff)
-        
-        patient = QueueEntry.objects.filter(
-            queue_id=queue_id,
-            counter=counter,
-            current_status='serving'
-        ).first()
+        # Counts the announcement, skipping the patient after the third one
+        counter, patient, skipped, next_patient = queue_transitions().announce_patient(request.counter.counter_id, queue_id)
         
         if not patient:
             return JsonResponse({'status': 'error', 'message': 'Patient not found'}, status=404)
         
-        patient.announcement_count += 1
-        patient.save()
-        
-        # Send WebSocket update to refresh display screens
-        try:
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                "display_updates",
-                {
-                    "type": "display_update",
-                    "message": {
-                        "action": "announcement",
-                        "counter_id": counter.counter_id,
-                        "queue_id": patient.queue_id,
-                        "patient_name": patient.patient.name,
-                        "announcement_count": patient.announcement_count
-                    }
-                }
-            )
-        except Exception as e:
-            print(f"WebSocket error: {e}")
+        # Push the announcement to display screens
+        after_write(
+            publish_board_change,
+            'skip' if skipped else 'announcement',
+            counter.counter_id,
+            announcement={
+                'counter_id': counter.counter_id,
+                'queue_id': patient.queue_id,
+                'patient_name': patient.patient.name,
+                'announcement_count': patient.announcement_count
+            }
+        )
         
-        if patient.announcement_count >= 3:
-            # Skip patient after 3 announcements
-            QueueHistory.objects.create(
-                queue_id=patient.queue_id,
-                patient=patient.patient,
-                service=patient.service,
-                counter=patient.counter,
-                current_status='skipped',
-                skipped_at=timezone.now(),
-                created_at=patient.created_at,
-                updated_at=timezone.now(),
-                date=timezone.now().date(),
-                completed_at=timezone.now()
-            )
-            patient.delete()
-            
-            # Get next patient
-            next_patient = QueueEntry.objects.filter(
-                counter=counter,
-                current_status='waiting'
-            ).order_by('created_at').first()
-            
-            if next_patient:
-                next_patient.current_status = 'serving'
-                next_patient.save()
-                
-                return JsonResponse({
-                    'status': 'skipped',
-                    'next_patient': {
-                        'name': next_patient.patient.name,
-                        'queue_id': next_patient.queue_id
-                    }
-                })
-            else:
-                counter.current_status = 'available'
-                counter.save()
-                return JsonResponse({'status': 'skipped', 'next_patient': None})
+        if skipped:
+            return JsonResponse({
+                'status': 'skipped',
+                'next_patient': {
+                    'name': next_patient.patient.name,
+                    'queue_id': next_patient.queue_id
+                } if next_patient else None
+            })
         
         return JsonResponse({
             'status': 'announced',
@@ -869,31 +750,23 @@ def announce_patient(request):
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
 
-def get_queue_status(request):
-    if 'patient_phone' not in request.session:
+async def get_queue_status(request):
+    phone_number = await request.session.aget('patient_phone')
+    if phone_number is None:
         return JsonResponse({'status': 'error'}, status=401)
     
-    patient = Patient.objects.get(phone_number=request.session['patient_phone'])
-    queue_entry = QueueEntry.objects.filter(patient=patient).first()
-    
-    return JsonResponse({
-        'queue_status': queue_entry.current_status if queue_entry else 'none',
-        'position': None  # Temporarily disable until function is fixed
-    })
+    # The same payload ws/patient/updates/ pushes
+    engine = live_engine()
+    if engine:
+        return JsonResponse(await engine.apatient_status(phone_number))
+    return JsonResponse(await apatient_status(phone_number))
 
 def get_position_in_queue(queue_entry):
-    """Calculate patient's position in the queue"""
-    if not queue_entry or queue_entry.current_status != 'waiting':
+    """Patient's position in their counter's queue: their ticket minus the ticket being served"""
+    if not queue_entry or queue_entry.current_status != 'waiting' or not queue_entry.counter:
         return None
     
-    # Count how many patients are ahead in the same counter
-    ahead_count = QueueEntry.objects.filter(
-        counter=queue_entry.counter,
-        current_status='waiting',
-        created_at__lt=queue_entry.created_at
-    ).count()
-    
-    return ahead_count + 1  # +1 because position starts from 1
+    return queue_position(queue_entry.ticket_number, queue_entry.counter.serving_ticket)
 
 @csrf_exempt
 @require_POST
@@ -922,58 +795,28 @@ def redistribute_patients_on_break(breaking_counter):
     FIXED: Redistribute patients from a counter going on break to other counters
     in the SAME SERVICE only
     """
-    print(f"DEBUG: Redistributing patients from {breaking_counter.counter_name} ({breaking_counter.service.service_name})")
-    
-    # Get all waiting patients from the breaking counter
-    waiting_patients = QueueEntry.objects.filter(
-        counter=breaking_counter,
-        current_status='waiting'
-    )
-    
-    redistributed_count = 0
-    
-    for patient_entry in waiting_patients:
-        # FIXED: Remove is_active filter since Counter model doesn't have this field
-        alternative_counter = Counter.objects.filter(
-            service=breaking_counter.service,  # Same service only
-            current_status__in=['available', 'busy']  # Only available/busy counters
-        ).exclude(counter_id=breaking_counter.counter_id).annotate(
-            waiting_count=Count('queueentry', filter=Q(queueentry__current_status='waiting'))
-        ).order_by('waiting_count', 'counter_id').first()
-        
-        if alternative_counter:
-            print(f"DEBUG: Moving {patient_entry.patient.name} from {breaking_counter.counter_name} to {alternative_counter.counter_name}")
-            
-            # Update the patient's counter
-            patient_entry.counter = alternative_counter
-            patient_entry.save()
-            redistributed_count += 1
-            
-            # Send WebSocket update
-            try:
-                from channels.layers import get_channel_layer
-                from asgiref.sync import async_to_sync
-                
-                channel_layer = get_channel_layer()
-                async_to_sync(channel_layer.group_send)(
-                    "staff_updates",
-                    {
-                        "type": "send_update",
-                        "message": {
-                            "action": "patient_redistributed",
-                            "queue_id": patient_entry.queue_id,
-                            "old_counter": breaking_counter.counter_name,
-                            "new_counter": alternative_counter.counter_name,
-                            "patient_name": patient_entry.patient.name,
-                            "service_name": breaking_counter.service.service_name
-                        }
-                    }
-                )
-            except Exception as e:
-                print(f"DEBUG: WebSocket error during redistribution: {e}")
+    # The whole plan is applied in one transaction
+    moves = queue_transitions().redistribute_waiting(breaking_counter.counter_id)
+    if not moves:
+        return 0
+    
+    new_counter_ids = sorted({counter.counter_id for _, counter in moves})
+    after_write(publish_board_change, 'redistribute', breaking_counter.counter_id, *new_counter_ids)
+    
+    # One message for the whole batch to the service's staff, the old counter's
+    # included; the moved patients were pushed their new counters by the transition
+    after_write(notify_service, breaking_counter.service_id, {
+        "action": "patients_redistributed",
+        "old_counter": breaking_counter.counter_name,
+        "service_name": breaking_counter.service.service_name,
+        "moves": [
+            {"queue_id": entry.queue_id, "new_counter": counter.counter_name, "patient_name": entry.patient.name}
+            for entry, counter in moves
+        ]
+    })
     
-    print(f"DEBUG: Redistributed {redistributed_count} patients from {breaking_counter.counter_name}")
-    return redistributed_count
+    logger.info("redistribute counter=%s moved=%s", breaking_counter.counter_id, len(moves))
+    return len(moves)
 
 # Add to views.py
 @csrf_exempt
@@ -1047,3 +890,65 @@ def debug_staff_counters(request):
         })
     
     return JsonResponse({'staff_counters': staff_data})
+
+@csrf_exempt
+def debug_outbox(request):
+    """Notification outbox depth and dispatch lag"""
+    return JsonResponse(outbox.stats())
+
+
+def prometheus_metrics(request):
+    """Request, database and WebSocket metrics of this process, for a Prometheus scrape"""
+    stats = outbox.stats()
+    extra = [
+        ('queue_metrics_sample_rate', 'gauge', 'Fraction of requests recorded', getattr(settings, 'METRICS_SAMPLE_RATE', 1.0)),
+        ('queue_outbox_depth', 'gauge', 'Notifications waiting to be sent', stats['depth']),
+        ('queue_outbox_failed_total', 'counter', 'Notifications the channel layer refused', stats['failed']),
+    ]
+    engine = live_engine()
+    if engine:
+        writes = engine.stats()
+        extra += [
+            ('queue_engine_pending_rows', 'gauge', 'Queue changes not yet written to the database', writes['pending']),
+            ('queue_engine_flush_failures_total', 'counter', 'Write-behind flushes that failed', writes['failures']),
+            ('queue_engine_dropped_rows_total', 'counter', 'Rows the database rejected and the engine dropped',
+             writes['dropped']),
+        ]
+    return HttpResponse(registry.render(extra), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Supervisors and admins see every service and counter; operators see their own
+ANALYTICS_ROLES = ('supervisor', 'admin')
+
+
+def _may_read_analytics(staff, counter, scope, scope_id):
+    if staff.role in ANALYTICS_ROLES:
+        return True
+    if counter is None:
+        return False
+    return scope_id == (counter.counter_id if scope == 'counter' else counter.service_id)
+
+
+def _analytics_view(request, scope, scope_id):
+    # request.staff is set by StaffSessionMiddleware for any logged-in staff, counter or not
+    if request.staff is None:
+        return JsonResponse({'status': 'error', 'message': 'Session expired'}, status=401)
+    if not _may_read_analytics(request.staff, request.counter, scope, scope_id):
+        return JsonResponse({'status': 'error', 'message': 'Not allowed'}, status=403)
+    period = request.GET.get('period', 'day')
+    try:
+        days = int(request.GET.get('days', 7))
+        report = analytics.report(scope, scope_id, period=period, days=days)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid period or days'}, status=400)
+    return JsonResponse({'status': 'success', **report})
+
+
+def service_analytics(request, service_id):
+    """Per-hour or per-day throughput, waits and skip rate of a service (?period=hour|day&days=7)"""
+    return _analytics_view(request, 'service', service_id)
+
+
+def counter_analytics(request, counter_id):
+    """Per-hour or per-day throughput, waits and skip rate of a counter (?period=hour|day&days=7)"""
+    return _analytics_view(request, 'counter', counter_id)
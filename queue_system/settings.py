@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -47,12 +48,18 @@ SESSION_COOKIE_NAME = 'queuesystem_staff_session'
 SESSION_COOKIE_AGE = 3600  # 1 hour
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 SESSION_SAVE_EVERY_REQUEST = True
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+# queue_app.sessions.db skips the per-request session write when nothing
+# changed. With a cache shared by all workers (Redis/Memcached) use
+# queue_app.sessions.cached_db to skip the read as well, or
+# django.contrib.sessions.backends.signed_cookies for no session storage at all.
+SESSION_ENGINE = os.environ.get('SESSION_ENGINE', 'queue_app.sessions.db')
+SESSION_REFRESH_INTERVAL = 300  # Seconds between expiry refreshes of an unchanged session
 SESSION_COOKIE_HTTPONLY = True
 SESSION_COOKIE_SECURE = False  # Set to True in production with HTTPS
 SESSION_COOKIE_SAMESITE = 'Lax'
 
 MIDDLEWARE = [
+    'queue_app.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -90,6 +97,19 @@ TWILIO_ACCOUNT_SID = ''
 TWILIO_AUTH_TOKEN = ''    
 TWILIO_PHONE_NUMBER = ''  
 
+# OTP texts are sent in the background by SMS_MAX_CONCURRENCY workers, each
+# tried up to SMS_MAX_ATTEMPTS times. SMS_GATEWAY overrides the sender (Twilio
+# when configured above, else printed to the console), e.g.
+# 'queue_app.sms.FakeGateway' with SMS_GATEWAY_OPTIONS = {'latency': 0.2}.
+SMS_MAX_CONCURRENCY = 4
+SMS_MAX_ATTEMPTS = 3
+
+# OTP requests allowed per (count, seconds) window, by phone and by client IP
+OTP_RATE_LIMITS = {
+    'otp_phone': (3, 10 * 60),
+    'otp_ip': (20, 10 * 60),
+}
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
@@ -106,18 +126,132 @@ DATABASES = {
 
 # Channels
 ASGI_APPLICATION = 'queue_system.asgi.application'
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-        'CONFIG': {
-            'groups': {
-                'staff_updates': {},
-                'display_updates': {},
-            }
-        }    
+
+# The in-memory layer only reaches sockets held by the same process. Running
+# more than one ASGI worker needs a shared layer:
+#   CHANNEL_LAYER_BACKEND=redis  (set CHANNEL_REDIS_URL, needs channels-redis)
+#   CHANNEL_LAYER_BACKEND=sqlite (single host / CI, no server needed)
+CHANNEL_LAYER_BACKEND = os.environ.get('CHANNEL_LAYER_BACKEND', 'memory')
+
+if CHANNEL_LAYER_BACKEND == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [os.environ.get('CHANNEL_REDIS_URL', 'redis://127.0.0.1:6379/0')],
+            },
+        },
+    }
+elif CHANNEL_LAYER_BACKEND == 'sqlite':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'queue_app.channel_layers.SQLiteChannelLayer',
+            'CONFIG': {
+                'path': os.environ.get('CHANNEL_SQLITE_PATH', str(BASE_DIR / 'channel_layer.sqlite3')),
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+# The cache holds state every worker must agree on: board versions and
+# delta frames, OTPs and rate limits, staff principals, SMS delivery status
+# and the service-time estimates. It follows the channel layer unless
+# CACHE_BACKEND says otherwise:
+#   CACHE_BACKEND=redis    (CACHE_REDIS_URL, default CHANNEL_REDIS_URL)
+#   CACHE_BACKEND=database (single host / CI; run `manage.py createcachetable`
+#                           once, and note its incr() is not atomic)
+#   CACHE_BACKEND=locmem   (per process, so a single worker only)
+# `manage.py check` refuses a per-process cache behind a shared channel layer.
+CACHE_BACKEND = os.environ.get(
+    'CACHE_BACKEND', {'redis': 'redis', 'sqlite': 'database'}.get(CHANNEL_LAYER_BACKEND, 'locmem')
+)
+
+if CACHE_BACKEND == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get(
+                'CACHE_REDIS_URL', os.environ.get('CHANNEL_REDIS_URL', 'redis://127.0.0.1:6379/0')
+            ),
+        },
+    }
+elif CACHE_BACKEND == 'database':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'queue_cache',
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
+# How join_queue picks a counter among a service's open counters:
+# least_waiting, least_estimated_time or round_robin
+QUEUE_ASSIGNMENT_POLICY = os.environ.get('QUEUE_ASSIGNMENT_POLICY', 'least_waiting')
+
+# Fraction of requests MetricsMiddleware records for /metrics (0 turns it off)
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', 1.0))
+
+# Log lines are "event key=value ..."; LOG_LEVEL=DEBUG shows per-request detail
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'keyvalue': {
+            'format': 'ts=%(asctime)s level=%(levelname)s logger=%(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'keyvalue',
+        },
+    },
+    'loggers': {
+        'queue_app': {
+            'handlers': ['console'],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
     },
 }
 
+# Days of raw QueueHistory kept in the database; older days are rolled up into
+# QueueDaySummary and moved to gzip'd JSONL files in QUEUE_HISTORY_ARCHIVE_DIR
+# by `manage.py archive_history`
+QUEUE_HISTORY_RETENTION_DAYS = int(os.environ.get('QUEUE_HISTORY_RETENTION_DAYS', 90))
+QUEUE_HISTORY_ARCHIVE_DIR = os.environ.get('QUEUE_HISTORY_ARCHIVE_DIR', str(BASE_DIR / 'archive' / 'queue_history'))
+
+# Ticket numbers each worker process reserves from a service's daily sequence
+# at a time (see queue_app/tickets.py)
+TICKET_BLOCK_SIZE = int(os.environ.get('TICKET_BLOCK_SIZE', 20))
+
+# Where the live queue is kept: 'database' (every transition is a transaction)
+# or 'memory' (queue_app/engine.py: transitions run in this process and the
+# rows are written behind every QUEUE_ENGINE_FLUSH_INTERVAL seconds; needs a
+# single ASGI worker)
+QUEUE_ENGINE = os.environ.get('QUEUE_ENGINE', 'database')
+QUEUE_ENGINE_FLUSH_INTERVAL = float(os.environ.get('QUEUE_ENGINE_FLUSH_INTERVAL', 0.05))
+
+# Directory of the binary queue event log every transition is appended to
+# (queue_app/eventlog.py; empty turns it off). Segments are preallocated to
+# EVENT_LOG_SEGMENT_BYTES, msync'd every EVENT_LOG_SYNC_INTERVAL seconds, and
+# a snapshot is taken every EVENT_LOG_SNAPSHOT_EVERY events; replay a day with
+# `manage.py replay_events`
+EVENT_LOG_DIR = os.environ.get('EVENT_LOG_DIR', '')
+EVENT_LOG_SEGMENT_BYTES = int(os.environ.get('EVENT_LOG_SEGMENT_BYTES', 64 * 1024 * 1024))
+EVENT_LOG_SYNC_INTERVAL = float(os.environ.get('EVENT_LOG_SYNC_INTERVAL', 0.2))
+EVENT_LOG_SNAPSHOT_EVERY = int(os.environ.get('EVENT_LOG_SNAPSHOT_EVERY', 10000))
 
 
 # Password validation